@@ -2,28 +2,114 @@ import os
 import config
 import json
 import time
-import datetime
 import csv
+import datetime
 import io
 import uuid
+import math
+import hashlib
+import base64
+import codecs
+import logging
 
 from functools import wraps
-from flask import Flask, request, session, send_from_directory, redirect, make_response, render_template, Response
+from flask import Flask, abort, request, session, send_from_directory, redirect, make_response, render_template, Response, stream_with_context
 from flask_sslify import SSLify
-from werkzeug import secure_filename
-from email.utils import parseaddr
+from urllib.parse import urlencode
 from utils.db import RedemptionCodeDB
 from utils.rest import OktaUtil
+from utils.mail import MailDispatcher
+from utils.cache import TTLCache
+from utils.auth import OktaTokenValidator, TokenValidationError, JWKSUnavailableError
+from utils.logs import configure_logging, LazyJson, set_request_id, clear_request_id, get_request_id, DroppingQueueHandler
+from utils import metrics
+from utils.ratelimit import RedemptionRateLimiter
+from utils.bloom import RedemptionCodeFilter
+from utils.redemption import json_converter, validate_redemption_request, map_redemption_code_record, \
+    get_redemption_response, get_redemption_recipients, apply_redemption_status, set_redemption_success, \
+    get_rate_limited_response, check_redemption_code_issued, check_cached_redemption_status, get_redemption_code
 
 """
 GLOBAL VARIABLES ########################################################################################################
 """
+configure_logging(config.logging["level"], config.logging["format"], config.logging["queue_size"])
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.debug = False
 app.config.update({
-    "SECRET_KEY": "6w_#w*~AVts3!*yd&C]jP0(x_1ssd]MVgzfAw8%fF+c@|ih0s1H&yZQC&-u~O[--"  # For the session
+    "SECRET_KEY": "6w_#w*~AVts3!*yd&C]jP0(x_1ssd]MVgzfAw8%fF+c@|ih0s1H&yZQC&-u~O[--",  # For the session
+    "MAX_CONTENT_LENGTH": config.app["max_upload_size"]  # Uploads larger than this are rejected with a 413
 })
-sslify = SSLify(app, permanent=True, subdomains=True)
+sslify = SSLify(app, permanent=True, subdomains=True, skips=["health", "ready"])  # load balancer checks use plain http
+mail_dispatcher = MailDispatcher.from_config()
+redemption_rate_limiter = RedemptionRateLimiter.from_config(config.rate_limit)
+redemption_code_filter = RedemptionCodeFilter.from_config(config.bloom)
+RedemptionCodeDB.CODE_FILTER = redemption_code_filter
+introspection_cache = TTLCache(config.auth["introspection_cache_size"], config.auth["introspection_cache_ttl"])
+token_validator = None
+
+if config.auth["mode"] == "local":
+    token_validator = OktaTokenValidator.from_config(config.auth)
+
+
+def start_background_services():
+    """ Starts the threads this process runs besides request handling, gunicorn calls it again in each worker """
+    if config.mail["dispatcher_enabled"]:
+        mail_dispatcher.start()
+
+    redemption_code_filter.start()
+
+
+def stop_background_services():
+    mail_dispatcher.stop(timeout=10)
+    redemption_code_filter.stop(timeout=10)
+    RedemptionCodeDB.close_pool()
+
+
+if config.app["start_background_services"]:
+    start_background_services()
+
+
+def collect_runtime_metrics():
+    """ Reports the statistics kept by the pool, breakers, caches and dispatcher as /metrics gauges and counters """
+    for name, value in RedemptionCodeDB.get_pool_stats().items():
+        metric_type = "gauge" if name in ["in_use", "min_size", "max_size"] else "counter"
+        suffix = "" if metric_type == "gauge" else "_total"
+        yield ("db_pool_{0}{1}".format(name, suffix), metric_type, "", {}, value)
+
+    for upstream, endpoint_stats in OktaUtil.get_endpoint_stats().items():
+        breaker_stats = endpoint_stats["breaker"]
+        yield ("upstream_circuit_open", "gauge", "1 while the upstream's circuit breaker rejects calls",
+               {"upstream": upstream}, 0 if breaker_stats["state"] == "CLOSED" else 1)
+        yield ("upstream_circuit_rejected_total", "counter", "", {"upstream": upstream}, breaker_stats["rejected"])
+        yield ("upstream_retries_total", "counter", "", {"upstream": upstream}, endpoint_stats["retries"])
+
+    cache_stats = introspection_cache.get_stats()
+    for name in ["hits", "misses", "evictions", "expirations"]:
+        yield ("introspection_cache_{0}_total".format(name), "counter", "", {}, cache_stats[name])
+    yield ("introspection_cache_size", "gauge", "", {}, cache_stats["size"])
+
+    cache_stats = RedemptionCodeDB.get_code_cache_stats()
+    for name in ["hits", "misses", "evictions", "expirations"]:
+        yield ("code_cache_{0}_total".format(name), "counter", "", {}, cache_stats[name])
+    yield ("code_cache_size", "gauge", "", {}, cache_stats["size"])
+    yield ("code_cache_hit_ratio", "gauge", "Share of redemption code lookups answered from the cache", {}, cache_stats["hit_ratio"])
+
+    for name, value in mail_dispatcher.stats.items():
+        yield ("mail_dispatcher_{0}_total".format(name), "counter", "", {}, value)
+
+    filter_stats = redemption_code_filter.get_stats()
+    yield ("redemption_code_filter_ready", "gauge", "1 once the Bloom filter of issued codes is built", {}, int(filter_stats["ready"]))
+    yield ("redemption_code_filter_checks_total", "counter", "", {}, filter_stats["checks"])
+    yield ("redemption_code_filter_rejected_total", "counter", "Codes rejected as never issued", {}, filter_stats["rejected"])
+    yield ("redemption_code_filter_rechecked_total", "counter", "Filter misses sent to the database while the filter caught up with new codes", {},
+           filter_stats["rechecked"])
+
+    yield ("log_records_dropped_total", "counter", "", {}, DroppingQueueHandler.dropped)
+
+
+metrics.REGISTRY.register_collector(collect_runtime_metrics)
 
 
 """
@@ -31,11 +117,63 @@ UTILS ##########################################################################
 """
 
 
+@app.before_request
+def start_request_logging():
+    """ Tags every log record for this request with the caller's X-Request-ID, or a new one """
+    set_request_id(request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex)
+    metrics.start_request(request.endpoint)
+
+
+@app.after_request
+def add_request_id_header(response):
+    if get_request_id():
+        response.headers["X-Request-ID"] = get_request_id()
+
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    """ Feeds the request duration into /metrics and logs the phase breakdown of requests over the slow threshold """
+    request_state = metrics.end_request()
+
+    if request_state:
+        elapsed = time.time() - request_state["started_at"]
+        labels = {
+            "endpoint": request_state["endpoint"],
+            "method": request.method,
+            "status": response.status_code
+        }
+        metrics.REGISTRY.histogram("http_request_duration_seconds", "Time to handle each request", **labels).observe(elapsed)
+
+        slow_request_threshold = config.metrics["slow_request_threshold"]
+        if slow_request_threshold and elapsed >= slow_request_threshold:
+            logger.warning(
+                "Slow request %s %s took %.3fs", request.method, request.path, elapsed,
+                extra={
+                    "duration": elapsed,
+                    "status": response.status_code,
+                    "phases": request_state["phases"],
+                    "db_round_trips": request_state["db_round_trips"],
+                    "db_checkout_seconds": request_state["db_checkout_seconds"],
+                    "upstream_calls": request_state["upstream_calls"],
+                    "upstream_seconds": request_state["upstream_seconds"]
+                })
+
+    return response
+
+
+@app.teardown_request
+def end_request_logging(exception=None):
+    clear_request_id()
+    metrics.end_request()
+
+
 def authorized(f):
     @wraps(f)
     def decorated_function(*args, **kws):
         """ Decorator fucntion to make endpoint authorization checks easier for scopes defined in Okta """
-        print("authorized()")
+        logger.debug("authorized()")
         authorization_header = None
         has_access = False
         authorization_token = None
@@ -48,12 +186,8 @@ def authorized(f):
             authorization_token = request.cookies.get("token")
 
         if authorization_token:
-            introspection_response = okta_util.introspect_oauth_token(authorization_token)
-            print("introspection_response: {0}".format(json.dumps(introspection_response, indent=4, sort_keys=True)))
-            if "active" in introspection_response:
-                if introspection_response["active"]:
-                    # Add scope checks here if you like
-                    has_access = True
+            with metrics.phase("authorize"):
+                has_access = is_token_active(okta_util, authorization_token)
 
         # print "authorization_header: {0}".format(authorization_header)
 
@@ -69,132 +203,337 @@ def authorized(f):
     return decorated_function
 
 
-def json_converter(o):
-    if isinstance(o, datetime.datetime):
-        return o.__str__()
+def is_token_active(okta_util, authorization_token):
+    """
+    In "local" auth mode the access token is validated against the cached JWKS without a network call, Okta
+    introspection is only used when the signing keys cannot be loaded.  Otherwise every check is an introspection
+    """
+    logger.debug("is_token_active()")
+
+    if token_validator:
+        try:
+            token_validator.validate(authorization_token)
+            # Add scope checks here if you like
+            return True
+        except JWKSUnavailableError as ex:
+            logger.warning("Local token validation unavailable: %s", ex)
+            if not config.auth["introspection_fallback"]:
+                return False
+        except TokenValidationError as ex:
+            logger.info("Token rejected: %s", ex)
+            return False
+
+    introspection_response = get_introspection_response(okta_util, authorization_token)
+    if "active" in introspection_response:
+        if introspection_response["active"]:
+            # Add scope checks here if you like
+            return True
+
+    return False
+
+
+def get_introspection_response(okta_util, authorization_token):
+    """
+    Introspects the token through introspection_cache, keyed by a hash so raw tokens are never held in memory.
+    Active results are cached until the token's exp (capped by the configured ttl), inactive ones for a short while
+    """
+    logger.debug("get_introspection_response()")
+    token_hash = hashlib.sha256(authorization_token.encode("UTF-8")).hexdigest()
+    introspection_response = introspection_cache.get(token_hash)
+
+    if introspection_response is None:
+        introspection_response = okta_util.introspect_oauth_token(authorization_token)
+        logger.debug("introspection_response: %s", LazyJson(introspection_response, indent=4, sort_keys=True))
+
+        if introspection_response.get("active"):
+            ttl = config.auth["introspection_cache_ttl"]
+            if "exp" in introspection_response:
+                ttl = min(ttl, introspection_response["exp"] - time.time())
+        else:
+            ttl = config.auth["introspection_negative_ttl"]
 
+        introspection_cache.set(token_hash, introspection_response, ttl)
 
-def validate_not_null(json, response, name, has_validation_error):
-    print("validate_not_null()")
-    result_message = ""
+    return introspection_response
 
-    if json[name] is None or json[name] == "":
-        has_validation_error = True
-        response["message"] += "\n{0} is required.".format(name)
 
-    return has_validation_error
+def claim_redemption_code(response, request_json, has_validation_error):
+    logger.debug("claim_redemption_code()")
+    redemption_code_db = RedemptionCodeDB()
+    redemption_code_record = {}
+    map_redemption_code_record(request_json, redemption_code_record)
 
+    with redemption_code_db.connection() as conn:
+        # Claiming and checking happen in one statement so two requests for the same code cannot both succeed
+        with metrics.phase("claim"):
+            redemption_status, redemption_code_record = redemption_code_db.claim_redemption_code(redemption_code_record, conn)
 
-def validate_email(response, email, has_validation_error):
-    print("validate_email()")
+        has_validation_error = apply_redemption_status(response, redemption_status) or has_validation_error
 
-    if '@' not in parseaddr(email)[1]:
-        has_validation_error = True
-        response["message"] += "\nEmail is not properly formatted."
+        if not has_validation_error:
+            # Queued in the same transaction as the claim, the dispatcher sends it once both commit
+            with metrics.phase("enqueue_mail"):
+                redemption_code_db.enqueue_mail(
+                    os.environ["SPARKPOST_THANK_TEMPLATE_ID"], get_redemption_recipients(request_json), conn=conn)
 
-    return has_validation_error
+    if not has_validation_error:
+        mail_dispatcher.wake()
 
+    return has_validation_error, redemption_code_record
 
-def validate_redemption_code(response, redeemCode, has_validation_error):
-    print("validate_redemption_code()")
-    redemption_code_db = RedemptionCodeDB()
-    redemption_code_record = redemption_code_db.get_redemption_code_by_code(redeemCode)
 
-    # First check if it exsists then check that is had not been used already
-    if(not redemption_code_record):
-        has_validation_error = True
-        response["message"] += "\nInvalid redemption code."
-    else:
-        print("redemption_code_record['email'] = {0}".format(redemption_code_record["email"]))
-        if redemption_code_record["email"]: #If it has an email assume it was used
-            has_validation_error = True
-            response["message"] += "\nRedemption code has already been used."
+def encode_page_token(current_page, direction, page_key, key_columns=None):
+    """
+    Opaque cursor for keyset paging, carries the boundary row's key, the sort columns it belongs to and the page
+    number for display
+    """
+    token_json = json.dumps(
+        {"page": current_page, "direction": direction, "columns": key_columns, "key": page_key}, default=json_converter)
 
-    return has_validation_error, redemption_code_record
+    return base64.urlsafe_b64encode(token_json.encode("UTF-8")).decode("UTF-8").rstrip("=")
 
 
-def get_paging_info(active_tab, current_page=0, rows_per_page=0, total_rows=0):
-    print("get_paging_info()")
+def parse_page_key(page_key, key_columns):
     """
-    Paging function:
-    - Display 5 pages at a time with controls to navigate up or down by 5
-    - If you are at the beginning or if there are 5 or less pages, the "Previous 5" nav will be disabled
-    - If there are 5 or less pages left on the other end, the "Next 5" nav will be disabled
-    - If there are less than 5 pages to display currently, only the remaining number of pages will be displayed
-    - Of the pages being displayed, it will default to the first page (closest to the previous nav)
-    - If another page is selected, the current range of pages will remain with the currently selected pages denoted
+    Returns the page key with one value per sort column, timestamps parsed back from their json_converter() strings.
+    Raises ValueError for anything else, which would otherwise fail in the keyset query
     """
-    print("active_tab: {0}".format(active_tab))
-    print("current_page: {0}".format(current_page))
-    print("rows_per_page: {0}".format(rows_per_page))
-    print("total_rows: {0}".format(total_rows))
-
-    pages_per_display = config.app["default_pages_per_display"]
-    print("pages_per_display: {0}".format(pages_per_display))
-    start_page = current_page % pages_per_display
-    print("start_page: {0}".format(start_page))
-    # end page
-    max_end_page = 0
+    if not isinstance(page_key, list) or len(page_key) != len(key_columns):
+        raise ValueError("Unexpected page_token key")
+
+    values = []
+    for column, value in zip(key_columns, page_key):
+        if value is not None and not isinstance(value, str):
+            raise ValueError("Unexpected page_token key value")
+
+        if value is not None and column in RedemptionCodeDB.TIMESTAMP_KEY_COLUMNS:
+            value = datetime.datetime.fromisoformat(value)
+
+        values.append(value)
+
+    return values
+
+
+def decode_page_token(page_token, key_columns=None):
+    """
+    Returns (current_page, direction, page_key), anything missing or malformed falls back to the first page.
+    key_columns are the sort columns of the tab the token is used on, a token built for other columns is rejected
+    """
+    if not page_token:
+        return 1, None, None
+
+    try:
+        token_json = base64.urlsafe_b64decode((page_token + "=" * (-len(page_token) % 4)).encode("UTF-8"))
+        token = json.loads(token_json.decode("UTF-8"))
+
+        if token["direction"] not in (RedemptionCodeDB.PAGE_NEXT, RedemptionCodeDB.PAGE_PREVIOUS):
+            raise ValueError("Unexpected page_token direction")
+
+        page_key = None
+        if key_columns is not None:
+            if token["columns"] != key_columns:
+                raise ValueError("page_token is for other sort columns")
+            page_key = parse_page_key(token["key"], key_columns)
+
+        return max(int(token["page"]), 1), token["direction"], page_key
+    except (ValueError, TypeError, KeyError, AttributeError):
+        logger.info("Invalid page_token: %s", page_token)
+        return 1, None, None
+
+
+def get_paging_request(key_columns=None):
+    """
+    Reads the paging parameters shared by the admin page and its tabs from the query string, tabs pass their
+    keyset sort columns so a page_token built for another tab falls back to the first page
+    """
+    rows_per_page = safe_cast(request.args.get("rows_per_page"), int, config.app["default_rows_per_page"])
+    page_token = request.args.get("page_token")
+    current_page, direction, page_key = decode_page_token(page_token, key_columns)
+
+    return {
+        "rows_per_page": min(max(rows_per_page, 1), config.app["max_rows_per_page"]),
+        "page_token": page_token,
+        "current_page": current_page,
+        "direction": direction,
+        "page_key": page_key,
+        "key_columns": key_columns
+    }
 
-    if rows_per_page != 0:
-        max_end_page = (total_rows / rows_per_page)
 
-    tab_paging_nav_items = []
+def get_paging_info(active_tab, paging_request, total_rows=0, page=None):
+    logger.debug("get_paging_info()")
+    """
+    Paging function for keyset (cursor) paging:
+    - "First" always returns to the start of the tab, "Previous" and "Next" carry a page_token built from the first or
+      last row on the current page, so every page costs the same to load no matter how deep it is
+    - Navigation that would run off either end of the results is disabled
+    - as_query_params keeps the current page_token so reloading the admin page reopens the same page of the tab
+    """
+    current_page = paging_request["current_page"]
+    rows_per_page = paging_request["rows_per_page"]
+    logger.debug("active_tab: %s current_page: %s rows_per_page: %s total_rows: %s", active_tab, current_page, rows_per_page, total_rows)
+
+    if page is None:
+        page = {
+            "has_next": False,
+            "has_previous": False,
+            "first_key": None,
+            "last_key": None
+        }
 
-    for i in range(pages_per_display):
-        page = i + 1 # Need to add the offset
-        tab_paging_nav_items.append({
-            "as_query_params": "?tab={0}&current_page={1}&rows_per_page={2}".format(active_tab, page, rows_per_page),
-            "page_number": page,
-            "is_active": page == current_page
-        })
+    def as_query_params(page_token=None):
+        query_params = {
+            "tab": active_tab,
+            "rows_per_page": rows_per_page
+        }
+        if page_token:
+            query_params["page_token"] = page_token
+
+        return "?{0}".format(urlencode(query_params))
+
+    tab_paging_nav_items = [
+        {
+            "label": "First",
+            "as_query_params": as_query_params(),
+            "is_enabled": current_page > 1 or page["has_previous"]
+        },
+        {
+            "label": "Previous",
+            "as_query_params": as_query_params(
+                encode_page_token(current_page - 1, RedemptionCodeDB.PAGE_PREVIOUS, page["first_key"], paging_request["key_columns"])),
+            "is_enabled": page["has_previous"]
+        },
+        {
+            "label": "Next",
+            "as_query_params": as_query_params(
+                encode_page_token(current_page + 1, RedemptionCodeDB.PAGE_NEXT, page["last_key"], paging_request["key_columns"])),
+            "is_enabled": page["has_next"]
+        }
+    ]
 
+    total_pages = 0
+    if rows_per_page != 0:
+        total_pages = int(math.ceil(total_rows / float(rows_per_page)))
 
     paging_info = {
         "active_tab": active_tab,
         "current_page": current_page,
         "rows_per_page": rows_per_page,
-        "as_query_params": "?tab={0}&current_page={1}&rows_per_page={2}".format(active_tab, current_page, rows_per_page),
+        "as_query_params": as_query_params(paging_request["page_token"]),
         "tab_paging_nav_items": tab_paging_nav_items,
-        "total_rows": total_rows
+        "total_rows": total_rows,
+        "total_pages": total_pages
     }
 
     return paging_info
 
 
 def safe_cast(val, to_type, default=None):
-    print("safe_cast()")
+    logger.debug("safe_cast()")
     try:
         return to_type(val)
     except (ValueError, TypeError):
         return default
 
 
-def map_redemption_code_record(request_json, redemption_code_record):
-    print("map_redemption_code_record()")
+def get_tracking_recipient(redemption_code_record, tracking):
+    """ SparkPost recipient carrying its own tracking number so many shipments can share one transmission """
+    return {
+        "address": {
+            "email": redemption_code_record["email"],
+            "name": "{0} {1}".format(redemption_code_record["firstName"], redemption_code_record["lastName"])
+        },
+        "substitution_data": {
+            "tracking": tracking
+        }
+    }
+
+
+def enqueue_tracking_mail(redemption_code_db, recipients, conn=None):
+    """ Pass conn to queue the mail in that transaction, the caller then wakes the dispatcher once it committed """
+    logger.debug("enqueue_tracking_mail()")
+    max_recipients = config.mail["max_recipients_per_transmission"]
+
+    for start in range(0, len(recipients), max_recipients):
+        redemption_code_db.enqueue_mail(os.environ["SPARKPOST_TRACK_TEMPLATE_ID"], recipients[start:start + max_recipients], conn=conn)
+
+    if recipients and conn is None:
+        mail_dispatcher.wake()
+
+
+def get_upload_csv_reader():
+    """
+    Returns a csv.DictReader that decodes the upload as it is read, or None when there is no upload.
+    The admin page posts the raw file as text/csv so rows are parsed straight off the request stream, a multipart
+    "codeUploadFile" field is still accepted for scripted uploads
+    """
+    logger.debug("get_upload_csv_reader()")
+    upload_stream = None
+
+    # MAX_CONTENT_LENGTH is only enforced when Werkzeug parses a form, not on request.stream
+    if request.content_length is not None and request.content_length > config.app["max_upload_size"]:
+        abort(413)
+
+    if request.mimetype == "text/csv":
+        upload_stream = request.stream
+    elif "codeUploadFile" in request.files:
+        upload_stream = request.files["codeUploadFile"].stream
 
-    #print("redemption_code_record: {0}".format(json.dumps(redemption_code_record, indent=4, sort_keys=True, default=json_converter)))
+    if upload_stream is None:
+        return None
 
-    redemption_code_record["redeemCode"] = request_json["redeemCode"]
-    redemption_code_record["firstName"] = request_json["firstName"]
-    redemption_code_record["lastName"] = request_json["lastName"]
-    redemption_code_record["address1"] = request_json["address1"]
-    redemption_code_record["address2"] = request_json["address2"]
-    redemption_code_record["city"] = request_json["city"]
-    redemption_code_record["state"] = request_json["state"]
-    redemption_code_record["postalCode"] = request_json["postalCode"]
-    redemption_code_record["phone"] = request_json["phone"]
-    redemption_code_record["email"] = request_json["email"]
+    return csv.DictReader(codecs.getreader("utf-8-sig")(upload_stream))
 
-    #print("redemption_code_record: {0}".format(json.dumps(redemption_code_record, indent=4, sort_keys=True, default=json_converter)))
+
+def log_upload_progress(line_count):
+    if line_count % config.app["upload_progress_interval"] == 0:
+        logger.info("upload progress: %s rows read", line_count - 1)
+
+
+def get_code_rows(csv_reader, invalid_rows):
+    """
+    Yields (line, redeemCode, productRef) for the bulk code insert.  Rows without either are counted in
+    invalid_rows["count"], the first upload_results_sample_size of them are kept in invalid_rows["rows"] for display
+    """
+    line_count = 1  # The header is line 1
+    for row in csv_reader:
+        line_count += 1
+        log_upload_progress(line_count)
+        redeem_code = row.get("RedemptionCode")
+        product_ref = row.get("ProductRef")
+
+        if not redeem_code or not product_ref:
+            invalid_rows["count"] += 1
+            if len(invalid_rows["rows"]) < config.app["upload_results_sample_size"]:
+                invalid_rows["rows"].append({
+                    "line": line_count,
+                    "redeemCode": redeem_code,
+                    "status": "INVALID"
+                })
+        else:
+            yield line_count, redeem_code.strip(), product_ref.strip()
+
+
+def get_tracking_rows(csv_reader):
+    """ Yields (line, redeemCode, tracking) for the bulk tracking update, rows without either are reported as INVALID by it """
+    line_count = 1  # The header is line 1
+    for row in csv_reader:
+        line_count += 1
+        log_upload_progress(line_count)
+
+        yield line_count, (row.get("RedemptionCode") or "").strip(), (row.get("Tracking") or "").strip()
+
+
+def get_upload_summary(status_counts):
+    return ", ".join(["{0} {1}".format(count, status.lower()) for status, count in sorted(status_counts.items()) if count])
 
 
 def get_oauth_token(oauth_code):
-    print("get_oauth_token()")
+    logger.debug("get_oauth_token()")
     okta_util = OktaUtil(request.headers)
 
     oauth_token_response_json = okta_util.get_oauth_token(oauth_code)
-    print("oauth_token_response_json: {0}".format(json.dumps(oauth_token_response_json), indent=4, sort_keys=True))
+    logger.debug("oauth_token_response_json: %s", LazyJson(oauth_token_response_json, indent=4, sort_keys=True))
 
     return oauth_token_response_json["access_token"]
 
@@ -214,7 +553,7 @@ def serve_static_html(filename):
 @app.route('/')
 def index():
     """ handler for the root url path of the app """
-    print("index()")
+    logger.debug("index()")
     message = ""
 
     response = make_response(render_template("index.html", app_config=config.app, message=message))
@@ -225,7 +564,7 @@ def index():
 @app.route('/order-confirmation')
 def order_confirmation():
     """ handler for the order confirmation url path of the app """
-    print("order_confirmation()")
+    logger.debug("order_confirmation()")
     message = ""
 
     response = make_response(render_template("order_confirmation.html", app_config=config.app, message=message))
@@ -236,55 +575,43 @@ def order_confirmation():
 @app.route('/redeemCode', methods=["POST"])
 def redeem_code():
     """ handler for the redeeming the code of the app """
-    print("redeem_code()")
-    print("request.form: {0}".format(request.form))
+    logger.debug("redeem_code()")
     request_json = request.get_json()
-    print("request.get_json(): {0}".format(request_json))
+    logger.debug("request.get_json(): %s", request_json)
 
-    has_validation_error = False
+    # Shed bots and overload before anything touches the database
+    client_ip = redemption_rate_limiter.get_client_ip(request.headers.get("X-Forwarded-For"), request.remote_addr)
+    rejected_reason, retry_after = redemption_rate_limiter.admit(client_ip, get_redemption_code(request_json))
+    if rejected_reason:
+        logger.info("Rejected /redeemCode from %s: %s", client_ip, rejected_reason)
+        response = make_response(json.dumps(get_rate_limited_response(request_json)), 429)
+        response.headers["Retry-After"] = str(int(math.ceil(retry_after)))
 
-    response = {
-        "status": "FAILED",
-        "message": "Please correct the following: ",
-        "request_json": request_json
-    }
+        return response
 
-    # Validate Request
-    has_validation_error = validate_not_null(request_json, response, "redeemCode", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "firstName", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "lastName", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "address1", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "city", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "state", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "phone", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "postalCode", has_validation_error)
-    has_validation_error = validate_not_null(request_json, response, "email", has_validation_error)
-    has_validation_error = validate_email(response, request_json["email"], has_validation_error)
-    has_validation_error, redemption_code_record = validate_redemption_code(response, request_json["redeemCode"], has_validation_error)
+    try:
+        response = get_redemption_response(request_json)
 
-    if not has_validation_error:
-        redemption_code_db = RedemptionCodeDB()
-        #print("redemption_code_record: {0}".format(json.dumps(redemption_code_record, indent=4, sort_keys=True, default=json_converter)))
-        map_redemption_code_record(request_json, redemption_code_record)
-        #print("redemption_code_record: {0}".format(json.dumps(redemption_code_record, indent=4, sort_keys=True, default=json_converter)))
-        redemption_code_record_updated = redemption_code_db.update_redemption_code(redemption_code_record)
+        # Validate Request
+        with metrics.phase("validate"):
+            has_validation_error = validate_redemption_request(request_json, response)
 
-        print("redemption_code_record_updated: {0}".format(json.dumps(redemption_code_record_updated, indent=4, sort_keys=True, default=json_converter)))
-        okta_util = OktaUtil(request.headers)
-        recipients = [
-            {
-                "address": {
-                    "email": request_json["email"],
-                    "name": "{0} {1}".format(request_json["firstName"], request_json["lastName"])
-                }
-            }
-        ]
-        mail_response = okta_util.send_mail(os.environ["SPARKPOST_THANK_TEMPLATE_ID"], recipients)
+            if not has_validation_error:
+                has_validation_error = check_redemption_code_issued(redemption_code_filter, request_json, response)
 
-        response["status"] = "SUCCESS"
-        response["message"] = "Your request is being processed.  Please check your email for a status update."
+            if not has_validation_error:
+                has_validation_error = check_cached_redemption_status(request_json, response)
 
-    # else respond with error by default
+        if not has_validation_error:
+            has_validation_error, redemption_code_record_updated = claim_redemption_code(response, request_json, has_validation_error)
+
+        if not has_validation_error:
+            logger.debug("redemption_code_record_updated: %s", LazyJson(redemption_code_record_updated, indent=4, sort_keys=True, default=json_converter))
+            set_redemption_success(response)
+
+        # else respond with error by default
+    finally:
+        redemption_rate_limiter.release()
 
     return json.dumps(response)
 
@@ -292,24 +619,24 @@ def redeem_code():
 @app.route('/oidc', methods=["POST"])
 def oidc():
     """ handler for the oidc call back of the app """
-    print("oidc()")
-    # print(request.form)
+    logger.debug("oidc()")
+    # logger.debug("request.form: %s", request.form)
 
     if "error" in request.form:
-        print("ERROR: {0}, MESSAGE: {1}".format(request.form["error"], request.form["error_description"]))
+        logger.error("ERROR: %s, MESSAGE: %s", request.form["error"], request.form["error_description"])
 
     # Check Nonce
-    # print("state: '{0}'".format(session["state"]))
-    # print("nonce: '{0}'".format(session["nonce"]))
+    # logger.debug("state: '%s'", session["state"])
+    # logger.debug("nonce: '%s'", session["nonce"])
     if session["state"] == request.form["state"]:
         oidc_code = request.form["code"]
-        print("oidc_code: {0}".format(oidc_code))
+        logger.debug("oidc_code: %s", oidc_code)
         oauth_token = get_oauth_token(oidc_code)
         redirect_url = os.environ["APP_AUTH_URL"]
         response = make_response(redirect(redirect_url))
         response.set_cookie('token', oauth_token)
     else:
-        print("FAILED TO MATCH STATE!!!")
+        logger.warning("FAILED TO MATCH STATE!!!")
         response = make_response(redirect(os.environ["APP_AUTH_URL"]))
 
     session.pop("state", None)
@@ -322,12 +649,10 @@ def oidc():
 @authorized
 def admin():
     """ handler for the admmin url path of the app """
-    print("admin()")
+    logger.debug("admin()")
     message = ""
     active_tab = safe_cast(request.args.get("tab"), int, 0)
-    current_page = safe_cast(request.args.get("current_page"), int, 1)
-    rows_per_page = safe_cast(request.args.get("rows_per_page"), int, config.app["default_rows_per_page"])
-    paging_info = get_paging_info(active_tab, current_page, rows_per_page)
+    paging_info = get_paging_info(active_tab, get_paging_request())
     response = make_response(render_template("admin.html", app_config=config.app, message=message, paging_info=paging_info))
 
     return response
@@ -336,93 +661,178 @@ def admin():
 @app.route('/admin/codefileupload', methods=["POST"])
 @authorized
 def code_file_upload():
-    print("code_file_upload()")
+    logger.debug("code_file_upload()")
+    message = ""
+    upload_results = []
 
-    if "codeUploadFile" in request.files:
-        message="Upload completed!"
-        uploadedFile = request.files["codeUploadFile"]
-        print("fileName: {0}".format(uploadedFile.filename))
+    csv_reader = get_upload_csv_reader()
 
-        fileLocation = "{0}/{1}".format(config.app["temp_file_path"], secure_filename(uploadedFile.filename))
-        print("fileLocation: {0}".format(fileLocation))
+    if csv_reader:
+        redemption_code_db = RedemptionCodeDB()
+        invalid_rows = {
+            "count": 0,
+            "rows": []
+        }
 
-        uploadedFile.save(fileLocation)
+        # Rows flow from the request straight into COPY, duplicates against the table and within the file are
+        # resolved by the database in one pass
+        with metrics.phase("import"):
+            code_results = redemption_code_db.bulk_create_redemption_code(get_code_rows(csv_reader, invalid_rows))
 
-        redemption_code_db = RedemptionCodeDB()
+        upload_results = invalid_rows["rows"]
+        code_results["INVALID"] += invalid_rows["count"]
+        message = "Upload completed! {0} inserted, {1} already existed, {2} duplicated in the file, {3} invalid.".format(
+            code_results["INSERTED"],
+            code_results["EXISTING"],
+            code_results["DUPLICATE_IN_FILE"],
+            code_results["INVALID"])
 
-        arg_list = []
-        duplicate_list = []
+        duplicate_list = code_results["codes"].get("EXISTING", []) + code_results["codes"].get("DUPLICATE_IN_FILE", [])
+        if(len(duplicate_list) != 0):
+            message = "{0} Duplicate codes detected. {1}".format(message, duplicate_list)
 
-        with open(fileLocation, mode='r', encoding='utf-8-sig') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-            line_count = 0
+        if invalid_rows["count"] > len(upload_results):
+            message = "{0} Showing the first {1} rows without a code or product.".format(message, len(upload_results))
 
-            conn = redemption_code_db.get_connection()
+    active_tab = safe_cast(request.args.get("tab"), int, 0)
+    paging_info = get_paging_info(active_tab, get_paging_request())
 
-            for row in csv_reader:
-                print(row)
-                # Check for duplicates
+    response = make_response(
+        render_template(
+            "admin.html",
+            app_config=config.app,
+            message=message,
+            paging_info=paging_info,
+            upload_results=upload_results))
 
-                dupeCheckRow = redemption_code_db.get_redemption_code_by_code(row["RedemptionCode"], conn)
+    return response
 
-                if dupeCheckRow:
-                    print("Duplicate!  Handle it!")
-                    duplicate_list.append(row["RedemptionCode"])
-                    message="Upload completed! Duplicate codes detected."
-                else:
-                    arg_list.append([row["RedemptionCode"],row["ProductRef"]])
 
-            if(len(duplicate_list) != 0):
-                message="Upload completed! Duplicate codes detected. {0}".format(duplicate_list)
+@app.route('/admin/trackingfileupload', methods=["POST"])
+@authorized
+def tracking_file_upload():
+    logger.debug("trackingfileupload()")
+    message = ""
+    upload_results = []
 
-            redemption_code_db.commit_close_connection(conn)
+    csv_reader = get_upload_csv_reader()
+
+    if csv_reader:
+        redemption_code_db = RedemptionCodeDB()
+        sample_size = config.app["upload_results_sample_size"]
+
+        def enqueue_updated_batch(updated_rows, conn):
+            # One outbox entry per transmission instead of one SparkPost call per row, committed with the update
+            recipients = [get_tracking_recipient(row, row["tracking"]) for row in updated_rows if row["email"]]
+            enqueue_tracking_mail(redemption_code_db, recipients, conn=conn)
+
+        # Every row is staged and applied in one pass, only the counts and a sample of the rows that were not
+        # updated come back, the updated ones are streamed to the outbox a transmission at a time
+        with metrics.phase("import"):
+            tracking_results = redemption_code_db.bulk_update_tracking(
+                get_tracking_rows(csv_reader),
+                on_updated=enqueue_updated_batch,
+                batch_size=config.mail["max_recipients_per_transmission"],
+                sample_size=sample_size)
+
+        if tracking_results["UPDATED"]:
+            mail_dispatcher.wake()
+
+        upload_results = tracking_results.pop("rows")
+        message = "Upload completed! {0}".format(get_upload_summary(tracking_results))
+        if len(upload_results) < sum([count for status, count in tracking_results.items() if status != "UPDATED"]):
+            message = "{0}. Showing the first {1} rows that were not updated.".format(message, sample_size)
 
-        redemption_code_db.batch_create_redemption_code(arg_list)
-        
-    
     active_tab = safe_cast(request.args.get("tab"), int, 0)
-    current_page = safe_cast(request.args.get("current_page"), int, 1)
-    rows_per_page = safe_cast(request.args.get("rows_per_page"), int, config.app["default_rows_per_page"])
-    paging_info = get_paging_info(active_tab, current_page, rows_per_page)
+    paging_info = get_paging_info(active_tab, get_paging_request())
 
-    response = make_response(render_template("admin.html", app_config=config.app, message=message, paging_info=paging_info))
+    response = make_response(
+        render_template(
+            "admin.html",
+            app_config=config.app,
+            message=message,
+            paging_info=paging_info,
+            upload_results=upload_results))
 
     return response
 
 
-@app.route('/admin/trackingfileupload', methods=["POST"])
+@app.route('/admin/recountstatus', methods=["POST"])
 @authorized
-def tracking_file_upload():
-    print("trackingfileupload()")
+def recount_status():
+    """ handler to rebuild the cached tab counts if they drift from the table """
+    logger.debug("recount_status()")
+    redemption_code_db = RedemptionCodeDB()
 
-    if "codeUploadFile" in request.files:
-        message="Upload completed!"
-        uploadedFile = request.files["codeUploadFile"]
-        print("fileName: {0}".format(uploadedFile.filename))
+    status_counts = redemption_code_db.recount_redemption_code_status()
+    message = "Counts rebuilt! {0}".format(
+        ", ".join(["{0}: {1}".format(status, total) for status, total in sorted(status_counts.items())]))
 
-        fileLocation = "{0}/{1}".format(config.app["temp_file_path"], secure_filename(uploadedFile.filename))
-        print("fileLocation: {0}".format(fileLocation))
+    active_tab = safe_cast(request.args.get("tab"), int, 0)
+    paging_info = get_paging_info(active_tab, get_paging_request())
 
-        uploadedFile.save(fileLocation)
+    response = make_response(render_template("admin.html", app_config=config.app, message=message, paging_info=paging_info))
 
-        redemption_code_db = RedemptionCodeDB()
+    return response
 
-        with open(fileLocation, mode='r', encoding='utf-8-sig') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-            line_count = 0
-            for row in csv_reader:
-                print(row)
-                # Check for duplicates
-                rowFound = redemption_code_db.get_redemption_code_by_code(row["RedemptionCode"])
 
-                if rowFound:
-                    print(updateTracking(row["RedemptionCode"], row["Tracking"]))
-                else:
-                    message="Upload completed! Some codes were missing."
+@app.route('/health')
+def health():
+    """ Liveness check, answers as long as the process can serve requests """
+    response = make_response(json.dumps({"status": "OK"}))
+    response.headers["Content-Type"] = "application/json"
+
+    return response
+
 
+@app.route('/ready')
+def ready():
+    """ Readiness check, only reports ready when a pooled database connection answers """
+    status_code = 200
+    readiness = {"status": "READY"}
 
+    try:
+        RedemptionCodeDB().check_connection()
+    except Exception as ex:
+        logger.warning("Readiness check failed: %s", ex)
+        status_code = 503
+        readiness = {"status": "NOT_READY", "database": ex.__class__.__name__}  # details only go to the log
 
-    response = make_response(render_template("admin.html", app_config=config.app, message=message))
+    response = make_response(json.dumps(readiness), status_code)
+    response.headers["Content-Type"] = "application/json"
+
+    return response
+
+
+@app.route('/admin/stats')
+@authorized
+def admin_stats():
+    """ handler that reports the connection pool, outbound HTTP and cache statistics as json """
+    logger.debug("admin_stats()")
+    stats = {
+        "database_pool": RedemptionCodeDB.get_pool_stats(),
+        "rest_endpoints": OktaUtil.get_endpoint_stats(),
+        "introspection_cache": introspection_cache.get_stats(),
+        "mail_dispatcher": dict(mail_dispatcher.stats),
+        "redemption_rate_limiter": redemption_rate_limiter.get_stats(),
+        "redemption_code_filter": redemption_code_filter.get_stats(),
+        "code_cache": RedemptionCodeDB.get_code_cache_stats()
+    }
+
+    response = make_response(json.dumps(stats, indent=4, sort_keys=True))
+    response.headers["Content-Type"] = "application/json"
+
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """ handler for Prometheus scrapes, every worker process reports its own numbers """
+    if not config.metrics["enabled"]:
+        return make_response("Not Found", 404)
+
+    response = make_response(metrics.REGISTRY.render())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
 
     return response
 
@@ -431,17 +841,18 @@ def tracking_file_upload():
 @authorized
 def available_codes_tab():
     """ handler for the admmin availablecodestab url path of the app """
-    print("available_codes_tab()")
+    logger.debug("available_codes_tab()")
     redemption_code_db = RedemptionCodeDB()
 
-    active_tab = 2
-    current_page = safe_cast(request.args.get("current_page"), int, 1)
-    rows_per_page = safe_cast(request.args.get("rows_per_page"), int, config.app["default_rows_per_page"])
+    active_tab = 2 # TODO: Need to define the tab better
+    paging_request = get_paging_request(RedemptionCodeDB.AVAILABLE_KEY_COLUMNS)
 
     message = ""
-    unused_codes, total_rows = redemption_code_db.get_unused_redemption_codes(rows_per_page, current_page)
-    active_tab = 2 # TODO: Need to define the tab better
-    paging_info = get_paging_info(active_tab, current_page, rows_per_page, total_rows)
+    unused_codes, total_rows, page = redemption_code_db.get_unused_redemption_codes(
+        paging_request["rows_per_page"],
+        paging_request["page_key"],
+        paging_request["direction"])
+    paging_info = get_paging_info(active_tab, paging_request, total_rows, page)
 
     response = make_response(
         render_template(
@@ -458,16 +869,18 @@ def available_codes_tab():
 @authorized
 def pending_shipping_tab():
     """ handler for the admmin pendingshippingtab url path of the app """
-    print("available_codes_tab()")
+    logger.debug("pending_shipping_tab()")
     redemption_code_db = RedemptionCodeDB()
-    
+
     active_tab = 0
-    current_page = safe_cast(request.args.get("current_page"), int, 1)
-    rows_per_page = safe_cast(request.args.get("rows_per_page"), int, config.app["default_rows_per_page"])
+    paging_request = get_paging_request(RedemptionCodeDB.REDEEMED_KEY_COLUMNS)
 
     message = ""
-    pending_shipping_items, total_rows = redemption_code_db.get_pending_shipping_redemption_codes(rows_per_page, current_page)
-    paging_info = get_paging_info(active_tab, current_page, rows_per_page, total_rows)
+    pending_shipping_items, total_rows, page = redemption_code_db.get_pending_shipping_redemption_codes(
+        paging_request["rows_per_page"],
+        paging_request["page_key"],
+        paging_request["direction"])
+    paging_info = get_paging_info(active_tab, paging_request, total_rows, page)
 
     response = make_response(
         render_template(
@@ -484,14 +897,18 @@ def pending_shipping_tab():
 @authorized
 def shipped_tab():
     """ handler for the admmin shipped_tab url path of the app """
-    print("shipped_tab()")
+    logger.debug("shipped_tab()")
     redemption_code_db = RedemptionCodeDB()
 
+    active_tab = 1
+    paging_request = get_paging_request(RedemptionCodeDB.REDEEMED_KEY_COLUMNS)
+
     message = ""
-    shipped_items = redemption_code_db.get_shipped_redemption_codes()
-    paging_info = {
-        "total_rows": len(shipped_items)
-    }
+    shipped_items, total_rows, page = redemption_code_db.get_shipped_redemption_codes(
+        paging_request["rows_per_page"],
+        paging_request["page_key"],
+        paging_request["direction"])
+    paging_info = get_paging_info(active_tab, paging_request, total_rows, page)
 
     response = make_response(
         render_template(
@@ -508,14 +925,18 @@ def shipped_tab():
 @authorized
 def all_tab():
     """ handler for the admmin all_tab url path of the app """
-    print("all_tab()")
+    logger.debug("all_tab()")
     redemption_code_db = RedemptionCodeDB()
 
+    active_tab = 3
+    paging_request = get_paging_request(RedemptionCodeDB.REDEEMED_KEY_COLUMNS)
+
     message = ""
-    all_items = redemption_code_db.get_all_used_redemption_codes()
-    paging_info = {
-        "total_rows": len(all_items)
-    }
+    all_items, total_rows, page = redemption_code_db.get_all_used_redemption_codes(
+        paging_request["rows_per_page"],
+        paging_request["page_key"],
+        paging_request["direction"])
+    paging_info = get_paging_info(active_tab, paging_request, total_rows, page)
 
     response = make_response(
         render_template(
@@ -532,20 +953,10 @@ def all_tab():
 @authorized
 def export_all(status=None):
     """ handler for the admmin export_all url path of the app """
-    print("export_all()")
+    logger.debug("export_all()")
     redemption_code_db = RedemptionCodeDB()
 
-    message = ""
-    all_items = None
-    if status == "pending":
-        all_items = redemption_code_db.get_pending_shipping_redemption_codes()
-    elif status == "shipped":
-        all_items = redemption_code_db.get_shipped_redemption_codes()
-    else:
-        all_items = redemption_code_db.get_all_used_redemption_codes()
-
     #prep csv conversion for output
-    csv_data_io = io.StringIO()
     csv_columns = [
         "productRef",
         "redeemCode",
@@ -563,14 +974,32 @@ def export_all(status=None):
         "updated",
         "status"
     ]
-    cw = csv.DictWriter(csv_data_io, fieldnames=csv_columns, dialect='excel')
-    cw.writeheader()
-    row_count = 0
-    for item in all_items:
-        cw.writerow(item)
+
+    def generate_csv():
+        """ Writes the export in chunks as rows come off the cursor so memory stays flat regardless of row count """
+        csv_data_io = io.StringIO()
+        cw = csv.DictWriter(csv_data_io, fieldnames=csv_columns, dialect='excel')
+        cw.writeheader()
+        yield csv_data_io.getvalue()  # Send the header before the query runs so the download starts right away
+
+        row_count = 0
+        csv_data_io.seek(0)
+        csv_data_io.truncate()
+
+        for item in redemption_code_db.iterate_export_redemption_codes(status, config.app["export_chunk_rows"]):
+            cw.writerow(item)
+            row_count += 1
+
+            if row_count % config.app["export_chunk_rows"] == 0:
+                yield csv_data_io.getvalue()
+                csv_data_io.seek(0)
+                csv_data_io.truncate()
+
+        yield csv_data_io.getvalue()
+        logger.info("export_all() rows exported: %s", row_count)
 
     response = Response(
-        csv_data_io.getvalue(),
+        stream_with_context(generate_csv()),
         mimetype="text/csv",
         headers={"Content-disposition":
                  "attachment; filename=export.csv"})
@@ -582,7 +1011,7 @@ def export_all(status=None):
 @authorized
 def updateTracking(redeem_code, tracking):
     """ handler for the redeeming the code of the app """
-    print("updateTracking()")
+    logger.debug("updateTracking()")
     has_validation_error =  False
 
     response = {
@@ -596,29 +1025,29 @@ def updateTracking(redeem_code, tracking):
     if tracking is None or tracking == "":
         has_validation_error = True
 
+    if tracking is not None and len(tracking) > 100:
+        has_validation_error = True
+
     if not has_validation_error:
         redemption_code_db = RedemptionCodeDB()
-        redemption_code_record = redemption_code_db.get_redemption_code_by_code(redeem_code)
-        redemption_code_record["tracking"] = tracking
-        redemption_code_record_updated = redemption_code_db.update_redemption_code(redemption_code_record)
-        print("redemption_code_record_updated: {0}".format(json.dumps(redemption_code_record_updated, indent=4, sort_keys=True, default=json_converter)))
 
-        okta_util = OktaUtil(request.headers)
-        recipients = [
-            {
-                "address": {
-                    "email": redemption_code_record["email"],
-                    "name": "{0} {1}".format(redemption_code_record["firstName"], redemption_code_record["lastName"])
-                }
-            }
-        ]
-        substitution = {
-            "tracking": tracking
-        }
-        mail_response = okta_util.send_mail(os.environ["SPARKPOST_TRACK_TEMPLATE_ID"], recipients, substitution)
+        # The tracking number and its mail commit together, the dispatcher sends it once both are in
+        with redemption_code_db.connection() as conn:
+            redemption_code_record_updated = redemption_code_db.update_tracking(redeem_code, tracking, conn)
+            logger.debug("redemption_code_record_updated: %s", LazyJson(redemption_code_record_updated, indent=4, sort_keys=True, default=json_converter))
+
+            if redemption_code_record_updated and redemption_code_record_updated["email"]:
+                enqueue_tracking_mail(redemption_code_db, [get_tracking_recipient(redemption_code_record_updated, tracking)], conn=conn)
 
-        response["status"] = "SUCCESS"
-        response["message"] = "Updated successfully!"
+        if redemption_code_record_updated:
+            redemption_code_db.invalidate_cached_codes([redeem_code])
+            if redemption_code_record_updated["email"]:
+                mail_dispatcher.wake()
+
+            response["status"] = "SUCCESS"
+            response["message"] = "Updated successfully!"
+        else:
+            response["message"] = "Unknown redemption code: {0}".format(redeem_code)
 
     return json.dumps(response)
 
@@ -627,5 +1056,5 @@ MAIN ###########################################################################
 """
 if __name__ == "__main__":
     # This is to run on c9.io.. you may need to change or make your own runner
-    print( "config.app: {0}".format(json.dumps(config.app, indent=4, sort_keys=True, default=json_converter)) )
+    logger.info("config.app: %s", LazyJson(config.app, indent=4, sort_keys=True, default=json_converter))
     app.run(host=os.getenv("IP", "0.0.0.0"), port=int(os.getenv("PORT", 8080)))
\ No newline at end of file
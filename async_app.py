@@ -0,0 +1,280 @@
+import os
+import config
+import json
+import time
+import uuid
+import math
+import asyncio
+import logging
+import jinja2
+
+from aiohttp import web
+from utils.db import RedemptionCodeDB
+from utils.async_db import AsyncRedemptionCodeDB
+from utils.mail import MailDispatcher
+from utils.logs import configure_logging, LazyJson, set_request_id, get_request_id, restart_logging_after_fork
+from utils import metrics
+from utils.ratelimit import RedemptionRateLimiter
+from utils.bloom import RedemptionCodeFilter
+from utils.redemption import json_converter, validate_redemption_request, map_redemption_code_record, \
+    get_redemption_response, get_redemption_recipients, apply_redemption_status, set_redemption_success, \
+    get_rate_limited_response, check_redemption_code_issued, check_cached_redemption_status, get_redemption_code
+
+"""
+asyncio server for the public pages and /redeemCode, for launches where thousands of redemptions are in flight at once.
+Each request only holds a database connection while its claim runs, and the thank you mail goes through the same
+outbox as app.py, so nothing here waits on SparkPost.  The admin pages stay on app.py.
+
+    python3 async_app.py
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker
+"""
+
+"""
+GLOBAL VARIABLES ########################################################################################################
+"""
+configure_logging(config.logging["level"], config.logging["format"], config.logging["queue_size"])
+logger = logging.getLogger(__name__)
+
+IMPORT_PID = os.getpid()
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+PLAIN_HTTP_PATHS = ["/health", "/ready"]  # load balancer checks use plain http
+
+mail_dispatcher = MailDispatcher.from_config()
+redemption_rate_limiter = RedemptionRateLimiter.from_config(config.rate_limit)
+redemption_code_filter = RedemptionCodeFilter.from_config(config.bloom)
+RedemptionCodeDB.CODE_FILTER = redemption_code_filter
+template_environment = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(ROOT_DIR, "templates")), autoescape=True)
+
+"""
+UTILS ###################################################################################################################
+"""
+
+
+def render_page(template_name):
+    """ The public pages do not vary per request, so each is rendered once """
+    return template_environment.get_template(template_name).render(app_config=config.app, message="")
+
+
+@web.middleware
+async def request_middleware(request, handler):
+    """ The before/after request hooks of app.py: request ids, https redirects and request metrics """
+    if config.async_app["force_https"] and request.path not in PLAIN_HTTP_PATHS and \
+            request.headers.get("X-Forwarded-Proto", request.scheme) != "https":
+        raise web.HTTPMovedPermanently(request.url.with_scheme("https"))
+
+    set_request_id(request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex)
+    metrics.start_request(request.match_info.route.name)
+
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        request_state = metrics.end_request()
+        elapsed = time.time() - request_state["started_at"]
+        labels = {
+            "endpoint": request_state["endpoint"],
+            "method": request.method,
+            "status": status
+        }
+        metrics.REGISTRY.histogram("http_request_duration_seconds", "Time to handle each request", **labels).observe(elapsed)
+
+        slow_request_threshold = config.metrics["slow_request_threshold"]
+        if slow_request_threshold and elapsed >= slow_request_threshold:
+            logger.warning(
+                "Slow request %s %s took %.3fs", request.method, request.path, elapsed,
+                extra={
+                    "duration": elapsed,
+                    "status": status,
+                    "phases": request_state["phases"],
+                    "db_round_trips": request_state["db_round_trips"],
+                    "db_checkout_seconds": request_state["db_checkout_seconds"]
+                })
+
+    response.headers["X-Request-ID"] = get_request_id()
+    if config.async_app["force_https"]:
+        response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
+
+    return response
+
+
+async def start_background_services(app):
+    """ Runs in each process after any fork, so the pool, mail dispatcher and log writer belong to this process """
+    if os.getpid() != IMPORT_PID:
+        # gunicorn --preload imported this module in the master
+        restart_logging_after_fork()
+        RedemptionCodeDB.reset_pool()
+
+    try:
+        await AsyncRedemptionCodeDB.open_pool(
+            config.async_app["pool_min_size"], config.async_app["pool_max_size"], config.async_app["command_timeout"])
+    except Exception as ex:
+        # Keep serving, the pool is opened on first use and /ready reports 503 until then
+        logger.warning("AsyncRedemptionCodeDB.open_pool() failed: %s", ex)
+
+    if config.mail["dispatcher_enabled"]:
+        mail_dispatcher.start()
+
+    redemption_code_filter.start()
+
+
+async def stop_background_services(app):
+    await asyncio.get_event_loop().run_in_executor(None, mail_dispatcher.stop, 10)
+    await asyncio.get_event_loop().run_in_executor(None, redemption_code_filter.stop, 10)
+    RedemptionCodeDB.close_pool()
+    await AsyncRedemptionCodeDB.close_pool()
+
+
+def json_response(body, status=200, headers=None, content_type="application/json"):
+    return web.Response(text=json.dumps(body), status=status, headers=headers, content_type=content_type)
+
+
+"""
+ROUTES ##################################################################################################################
+"""
+
+
+async def index(request):
+    """ handler for the root url path of the app """
+    logger.debug("index()")
+
+    return web.Response(body=request.app["pages"]["index.html"], content_type="text/html")
+
+
+async def order_confirmation(request):
+    """ handler for the order confirmation url path of the app """
+    logger.debug("order_confirmation()")
+
+    return web.Response(body=request.app["pages"]["order_confirmation.html"], content_type="text/html")
+
+
+async def redeem_code(request):
+    """ handler for the redeeming the code of the app """
+    logger.debug("redeem_code()")
+    try:
+        request_json = await request.json()
+    except ValueError:
+        return json_response({"status": "FAILED", "message": "The request body must be JSON."}, 400)
+
+    logger.debug("request.json(): %s", request_json)
+
+    # Shed bots and overload before anything touches the database
+    client_ip = redemption_rate_limiter.get_client_ip(request.headers.get("X-Forwarded-For"), request.remote)
+    rejected_reason, retry_after = redemption_rate_limiter.admit(client_ip, get_redemption_code(request_json))
+    if rejected_reason:
+        logger.info("Rejected /redeemCode from %s: %s", client_ip, rejected_reason)
+        return json_response(
+            get_rate_limited_response(request_json), 429, headers={"Retry-After": str(int(math.ceil(retry_after)))})
+
+    try:
+        response = get_redemption_response(request_json)
+
+        # Validate Request
+        with metrics.phase("validate"):
+            has_validation_error = validate_redemption_request(request_json, response)
+
+            if not has_validation_error:
+                has_validation_error = check_redemption_code_issued(redemption_code_filter, request_json, response)
+
+            if not has_validation_error:
+                has_validation_error = check_cached_redemption_status(request_json, response)
+
+        if not has_validation_error:
+            redemption_code_record = {}
+            map_redemption_code_record(request_json, redemption_code_record)
+
+            with metrics.phase("claim"):
+                redemption_status, redemption_code_record_updated = await AsyncRedemptionCodeDB(
+                    config.async_app["pool_checkout_timeout"]).claim_redemption_code(
+                        redemption_code_record, os.environ["SPARKPOST_THANK_TEMPLATE_ID"],
+                        get_redemption_recipients(request_json))
+
+            has_validation_error = apply_redemption_status(response, redemption_status)
+
+        if not has_validation_error:
+            mail_dispatcher.wake()
+            logger.debug("redemption_code_record_updated: %s", LazyJson(redemption_code_record_updated, indent=4, sort_keys=True, default=json_converter))
+            set_redemption_success(response)
+
+        # else respond with error by default
+    finally:
+        redemption_rate_limiter.release()
+
+    # Same content type as app.py, the form's script parses the body itself
+    return json_response(response, content_type="text/html")
+
+
+async def health(request):
+    """ Liveness check, answers as long as the event loop is serving requests """
+    return json_response({"status": "OK"})
+
+
+async def ready(request):
+    """ Readiness check, only reports ready when a pooled database connection answers """
+    try:
+        await AsyncRedemptionCodeDB(config.async_app["pool_checkout_timeout"]).check_connection()
+    except Exception as ex:
+        logger.warning("Readiness check failed: %s", ex)
+        return json_response({"status": "NOT_READY", "database": ex.__class__.__name__}, 503)  # details only go to the log
+
+    return json_response({"status": "READY"})
+
+
+async def prometheus_metrics(request):
+    """ handler for Prometheus scrapes, every worker process reports its own numbers """
+    if not config.metrics["enabled"]:
+        raise web.HTTPNotFound()
+
+    return web.Response(
+        text=metrics.REGISTRY.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+def collect_async_runtime_metrics():
+    for name, value in sorted(AsyncRedemptionCodeDB.get_pool_stats().items()):
+        yield ("async_db_pool_" + name, "gauge", "asyncpg pool statistics", {}, value)
+
+    cache_stats = RedemptionCodeDB.get_code_cache_stats()
+    for name in ["hits", "misses", "evictions", "expirations"]:
+        yield ("code_cache_{0}_total".format(name), "counter", "", {}, cache_stats[name])
+    yield ("code_cache_size", "gauge", "", {}, cache_stats["size"])
+    yield ("code_cache_hit_ratio", "gauge", "Share of redemption code lookups answered from the cache", {}, cache_stats["hit_ratio"])
+
+    filter_stats = redemption_code_filter.get_stats()
+    yield ("redemption_code_filter_ready", "gauge", "1 once the Bloom filter of issued codes is built", {}, int(filter_stats["ready"]))
+    yield ("redemption_code_filter_checks_total", "counter", "", {}, filter_stats["checks"])
+    yield ("redemption_code_filter_rejected_total", "counter", "Codes rejected as never issued", {}, filter_stats["rejected"])
+    yield ("redemption_code_filter_rechecked_total", "counter", "Filter misses sent to the database while the filter caught up with new codes", {},
+           filter_stats["rechecked"])
+
+
+def create_app():
+    app = web.Application(middlewares=[request_middleware])
+    app["pages"] = dict([(name, render_page(name).encode("utf-8")) for name in ["index.html", "order_confirmation.html"]])
+
+    app.router.add_get("/", index, name="index")
+    app.router.add_get("/order-confirmation", order_confirmation, name="order_confirmation")
+    app.router.add_post("/redeemCode", redeem_code, name="redeem_code")
+    app.router.add_get("/health", health, name="health")
+    app.router.add_get("/ready", ready, name="ready")
+    app.router.add_get("/metrics", prometheus_metrics, name="prometheus_metrics")
+    app.router.add_static("/", os.path.join(ROOT_DIR, "static"), name="serve_static_html")
+
+    app.on_startup.append(start_background_services)
+    app.on_cleanup.append(stop_background_services)
+    metrics.REGISTRY.register_collector(collect_async_runtime_metrics)
+
+    return app
+
+
+app = create_app()
+
+"""
+MAIN ##################################################################################################################
+"""
+if __name__ == "__main__":
+    logger.info("config.async_app: %s", LazyJson(config.async_app, indent=4, sort_keys=True))
+    web.run_app(app, host=os.getenv("IP", "0.0.0.0"), port=int(os.getenv("PORT", 8080)), access_log=None)
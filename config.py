@@ -1,5 +1,112 @@
+import os
+
 app = {
-    "temp_file_path": "./temp",
     "default_rows_per_page": 10,
-    "default_pages_per_display": 5
-}
\ No newline at end of file
+    "max_rows_per_page": 500,
+    "max_upload_size": int(os.getenv("MAX_UPLOAD_SIZE", 100 * 1024 * 1024)),  # bytes
+    "upload_progress_interval": int(os.getenv("UPLOAD_PROGRESS_INTERVAL", 10000)),  # log every this many rows
+    "upload_results_sample_size": int(os.getenv("UPLOAD_RESULTS_SAMPLE_SIZE", 100)),  # rejected code or tracking rows listed on the admin page
+    "export_chunk_rows": int(os.getenv("EXPORT_CHUNK_ROWS", 2000)),  # rows fetched and written per export chunk
+    # gunicorn.conf.py turns this off and starts the background threads in each worker after the fork
+    "start_background_services": os.getenv("START_BACKGROUND_SERVICES", "true").lower() == "true"
+}
+
+logging = {
+    "level": os.getenv("LOG_LEVEL", "INFO"),  # DEBUG adds the per call traces and payload dumps
+    "format": os.getenv("LOG_FORMAT", "json"),  # "json" or "text"
+    "queue_size": int(os.getenv("LOG_QUEUE_SIZE", 10000))  # records buffered for the writer thread before dropping
+}
+
+metrics = {
+    "enabled": os.getenv("METRICS_ENABLED", "true").lower() == "true",  # serve /metrics
+    "slow_request_threshold": float(os.getenv("SLOW_REQUEST_THRESHOLD", 1))  # seconds, 0 turns the slow request log off
+}
+
+database = {
+    "sslmode": os.getenv("DATABASE_SSLMODE", "require"),  # libpq sslmode, e.g. disable for a local database
+    "pool_min_size": int(os.getenv("DATABASE_POOL_MIN_SIZE", 1)),
+    "pool_max_size": int(os.getenv("DATABASE_POOL_MAX_SIZE", 10)),
+    "pool_checkout_timeout": float(os.getenv("DATABASE_POOL_CHECKOUT_TIMEOUT", 5)),  # seconds to wait for a free connection
+    "pool_health_check_idle": float(os.getenv("DATABASE_POOL_HEALTH_CHECK_IDLE", 30)),  # ping connections idle longer than this
+    "code_cache_size": int(os.getenv("CODE_CACHE_SIZE", 10000)),  # redemption codes cached per process
+    "code_cache_ttl": float(os.getenv("CODE_CACHE_TTL", 30)),  # seconds for redeemed codes
+    "code_cache_negative_ttl": float(os.getenv("CODE_CACHE_NEGATIVE_TTL", 10))  # seconds for codes that do not exist
+}
+
+# Admission control for /redeemCode, see utils/ratelimit.py
+rate_limit = {
+    "enabled": os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true",
+    "backend": os.getenv("RATE_LIMIT_BACKEND", "memory"),  # "memory" per process, or package.module:Class for a shared one
+    "max_keys": int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000)),  # buckets kept by the memory backend
+    "ip_rate": float(os.getenv("RATE_LIMIT_IP_RATE", 0.5)),  # requests per second per client IP
+    "ip_burst": float(os.getenv("RATE_LIMIT_IP_BURST", 10)),
+    "code_prefix_length": int(os.getenv("RATE_LIMIT_CODE_PREFIX_LENGTH", 0)),  # 0 (the default) turns the per prefix bucket off
+    "code_prefix_rate": float(os.getenv("RATE_LIMIT_CODE_PREFIX_RATE", 10)),  # requests per second per code prefix
+    "code_prefix_burst": float(os.getenv("RATE_LIMIT_CODE_PREFIX_BURST", 50)),
+    "max_in_flight": int(os.getenv("REDEEM_MAX_IN_FLIGHT", 200)),  # per process, 0 for no cap
+    "trusted_proxies": int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", 1))  # proxies appending to X-Forwarded-For, Heroku's router is one
+}
+
+# Bloom filter of issued codes that lets /redeemCode reject made up codes without a query, see utils/bloom.py
+bloom = {
+    "enabled": os.getenv("BLOOM_ENABLED", "true").lower() == "true",
+    "error_rate": float(os.getenv("BLOOM_ERROR_RATE", 0.001)),  # share of unknown codes still sent to the database
+    "min_capacity": int(os.getenv("BLOOM_MIN_CAPACITY", 100000)),
+    "capacity_headroom": float(os.getenv("BLOOM_CAPACITY_HEADROOM", 1.25)),  # sized for this many times the current codes
+    "refresh_interval": float(os.getenv("BLOOM_REFRESH_INTERVAL", 1)),  # seconds between reads of the code watermark
+    "rebuild_interval": float(os.getenv("BLOOM_REBUILD_INTERVAL", 3600)),  # seconds, rebuilt at least this often
+    "batch_size": int(os.getenv("BLOOM_BATCH_SIZE", 10000))  # codes read per round trip while building
+}
+
+# async_app.py, the asyncio server for the public pages and /redeemCode
+async_app = {
+    "pool_min_size": int(os.getenv("ASYNC_DATABASE_POOL_MIN_SIZE", 5)),
+    "pool_max_size": int(os.getenv("ASYNC_DATABASE_POOL_MAX_SIZE", 20)),  # shared by every in flight request of the process
+    "pool_checkout_timeout": float(os.getenv("ASYNC_DATABASE_POOL_CHECKOUT_TIMEOUT", 10)),  # seconds to wait for a free connection
+    "command_timeout": float(os.getenv("ASYNC_DATABASE_COMMAND_TIMEOUT", 10)),  # seconds per statement
+    "force_https": os.getenv("ASYNC_FORCE_HTTPS", "true").lower() == "true"  # redirect plain http like SSLify does for app.py
+}
+
+auth = {
+    "mode": os.getenv("AUTH_MODE", "introspect"),  # "introspect" asks Okta on every cache miss, "local" validates JWTs here
+    "introspection_fallback": os.getenv("AUTH_INTROSPECTION_FALLBACK", "true").lower() == "true",  # when JWKS is unavailable
+    "issuer": os.getenv("OKTA_ISSUER"),  # defaults to OKTA_ORG_URL/oauth2/OKTA_AUTHSERVER_ID
+    "audience": os.getenv("OKTA_AUDIENCE", "api://default"),
+    "jwks_url": os.getenv("OKTA_JWKS_URL"),  # defaults to the issuer's /v1/keys, file:// paths are allowed
+    "jwks_cache_ttl": float(os.getenv("OKTA_JWKS_CACHE_TTL", 3600)),
+    "jwks_min_refresh_interval": float(os.getenv("OKTA_JWKS_MIN_REFRESH_INTERVAL", 60)),
+    "leeway": float(os.getenv("OKTA_JWT_LEEWAY", 30)),  # seconds of clock skew allowed on exp/iat/nbf
+    "introspection_cache_size": int(os.getenv("INTROSPECTION_CACHE_SIZE", 1000)),
+    "introspection_cache_ttl": float(os.getenv("INTROSPECTION_CACHE_TTL", 300)),  # upper bound, never past the token's exp
+    "introspection_negative_ttl": float(os.getenv("INTROSPECTION_NEGATIVE_TTL", 30))  # for inactive or invalid tokens
+}
+
+rest = {
+    "connect_timeout": float(os.getenv("REST_CONNECT_TIMEOUT", 3.05)),
+    "read_timeout": float(os.getenv("REST_READ_TIMEOUT", 10)),
+    "retries": int(os.getenv("REST_RETRIES", 2)),  # only for idempotent methods
+    "retry_backoff_factor": float(os.getenv("REST_RETRY_BACKOFF_FACTOR", 0.3)),
+    "retry_backoff_max": float(os.getenv("REST_RETRY_BACKOFF_MAX", 5)),
+    "breaker_failure_threshold": int(os.getenv("REST_BREAKER_FAILURE_THRESHOLD", 5)),  # consecutive failures to open
+    "breaker_reset_timeout": float(os.getenv("REST_BREAKER_RESET_TIMEOUT", 30)),  # seconds before a trial call
+    "pool_connections": int(os.getenv("REST_POOL_CONNECTIONS", 4)),  # distinct hosts kept alive, Okta and SparkPost
+    "pool_maxsize": int(os.getenv("REST_POOL_MAXSIZE", 20))  # keep-alive connections per host
+}
+
+# (connect, read) timeouts per upstream, e.g. REST_SPARKPOST_READ_TIMEOUT, falling back to the defaults above
+rest["timeouts"] = dict([(
+    endpoint,
+    (float(os.getenv("REST_{0}_CONNECT_TIMEOUT".format(endpoint.upper()), rest["connect_timeout"])),
+     float(os.getenv("REST_{0}_READ_TIMEOUT".format(endpoint.upper()), rest["read_timeout"]))))
+    for endpoint in ["okta", "okta_oauth", "sparkpost"]])
+
+mail = {
+    "dispatcher_enabled": os.getenv("MAIL_DISPATCHER_ENABLED", "true").lower() == "true",  # run the outbox dispatcher inside the web process
+    "batch_size": int(os.getenv("MAIL_BATCH_SIZE", 100)),
+    "max_recipients_per_transmission": int(os.getenv("MAIL_MAX_RECIPIENTS_PER_TRANSMISSION", 1000)),
+    "poll_interval": float(os.getenv("MAIL_POLL_INTERVAL", 5)),
+    "max_attempts": int(os.getenv("MAIL_MAX_ATTEMPTS", 8)),  # after this many failures a message is moved to DEAD
+    "backoff_base": float(os.getenv("MAIL_BACKOFF_BASE", 2)),
+    "backoff_max": float(os.getenv("MAIL_BACKOFF_MAX", 900)),
+    "lease_timeout": float(os.getenv("MAIL_LEASE_TIMEOUT", 300))
+}
@@ -0,0 +1,58 @@
+import os
+import multiprocessing
+
+"""
+gunicorn settings for production, used by the Procfile:
+
+    gunicorn --config gunicorn.conf.py app:app
+
+Every setting can be overridden from the environment.  kill -HUP <master pid> replaces the workers gracefully with
+ones running the current code (unless GUNICORN_PRELOAD_APP=true), letting in flight requests finish first.
+"""
+
+# The mail dispatcher thread would not survive the fork, each worker starts its own in post_worker_init
+os.environ.setdefault("START_BACKGROUND_SERVICES", "false")
+
+bind = "{0}:{1}".format(os.getenv("IP", "0.0.0.0"), os.getenv("PORT", 8080))
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Threads let a worker keep serving while a request waits on PostgreSQL or Okta, keep
+# DATABASE_POOL_MAX_SIZE >= threads so they do not queue for connections
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))  # uploads and exports stream for a while, keep this above them
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))  # recycle workers after this many requests, 0 never
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 0))
+preload_app = os.getenv("GUNICORN_PRELOAD_APP", "false").lower() == "true"
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "*")  # Heroku's router sets X-Forwarded-*
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    """
+    With preload_app the worker inherits the master's imported modules.  Connections opened before the fork are
+    shared with the master, so drop them without closing and let the worker open its own
+    """
+    from utils.db import RedemptionCodeDB
+    from utils.rest import OktaUtil
+    from utils.logs import restart_logging_after_fork
+
+    RedemptionCodeDB.reset_pool()
+    OktaUtil.reset_session()
+    restart_logging_after_fork()
+
+
+def post_worker_init(worker):
+    from app import start_background_services
+
+    start_background_services()
+
+
+def worker_exit(server, worker):
+    from app import stop_background_services
+    from utils.logs import stop_logging
+
+    stop_background_services()
+    stop_logging()
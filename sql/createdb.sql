@@ -16,9 +16,109 @@ create table redemption_code (
     "tracking" varchar(100),
     "created" timestamp default CURRENT_TIMESTAMP,
     "updated" timestamp default CURRENT_TIMESTAMP,
-    primary key ("redeemCode")
+    "codeStatus" varchar(20) not null default 'AVAILABLE', -- AVAILABLE, PENDING SHIPPING or SHIPPED, see redemption_code_set_status()
+    primary key ("redeemCode"),
+    constraint redemption_code_status_check check ("codeStatus" in ('AVAILABLE', 'PENDING SHIPPING', 'SHIPPED'))
 );
 
+create or replace function redemption_code_set_status() returns trigger as $$
+begin
+    NEW."codeStatus" := CASE
+        WHEN coalesce(NEW."tracking", '') <> '' THEN 'SHIPPED'
+        WHEN NEW."firstName" is not null and NEW."state" is not null THEN 'PENDING SHIPPING'
+        ELSE 'AVAILABLE'
+    END;
+    return NEW;
+end;
+$$ language plpgsql;
+
+create trigger redemption_code_status_trg
+    before insert or update on redemption_code
+    for each row execute procedure redemption_code_set_status();
+
+-- One index per admin tab, matching its filter and keyset sort order
+create index redemption_code_available_idx on redemption_code ("productRef", "redeemCode") where "codeStatus" = 'AVAILABLE';
+create index redemption_code_pending_idx on redemption_code ("created", "redeemCode") where "codeStatus" = 'PENDING SHIPPING';
+create index redemption_code_shipped_idx on redemption_code ("created", "redeemCode") where "codeStatus" = 'SHIPPED';
+create index redemption_code_used_idx on redemption_code ("created", "redeemCode") where "codeStatus" <> 'AVAILABLE';
+-- Newest "created", part of the unknown code filter's watermark, see utils/bloom.py
+create index redemption_code_created_idx on redemption_code ("created");
+
+-- Per status row counts for the admin tabs, spread over 16 shards per status and summed by readers
+create table redemption_code_status_count (
+    "codeStatus" varchar(20) not null,
+    "shard" integer not null,
+    "total" bigint not null default 0,
+    primary key ("codeStatus", "shard")
+);
+
+create or replace function redemption_code_count_insert() returns trigger as $$
+begin
+    insert into redemption_code_status_count ("codeStatus", "shard", "total")
+    select "codeStatus", floor(random() * 16)::integer, count(*) from new_rows group by "codeStatus"
+    on conflict ("codeStatus", "shard") do update set "total" = redemption_code_status_count."total" + excluded."total";
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function redemption_code_count_update() returns trigger as $$
+begin
+    insert into redemption_code_status_count ("codeStatus", "shard", "total")
+    select "codeStatus", floor(random() * 16)::integer, sum("delta") from (
+        select "codeStatus", 1 as "delta" from new_rows
+        union all
+        select "codeStatus", -1 as "delta" from old_rows
+    ) changes
+    group by "codeStatus"
+    having sum("delta") <> 0
+    on conflict ("codeStatus", "shard") do update set "total" = redemption_code_status_count."total" + excluded."total";
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function redemption_code_count_delete() returns trigger as $$
+begin
+    insert into redemption_code_status_count ("codeStatus", "shard", "total")
+    select "codeStatus", floor(random() * 16)::integer, -count(*) from old_rows group by "codeStatus"
+    on conflict ("codeStatus", "shard") do update set "total" = redemption_code_status_count."total" + excluded."total";
+    return null;
+end;
+$$ language plpgsql;
+
+create trigger redemption_code_count_insert_trg
+    after insert on redemption_code
+    referencing new table as new_rows
+    for each statement execute procedure redemption_code_count_insert();
+
+create trigger redemption_code_count_update_trg
+    after update on redemption_code
+    referencing old table as old_rows new table as new_rows
+    for each statement execute procedure redemption_code_count_update();
+
+create trigger redemption_code_count_delete_trg
+    after delete on redemption_code
+    referencing old table as old_rows
+    for each statement execute procedure redemption_code_count_delete();
+
+create table mail_outbox (
+    "id" bigserial,
+    "templateId" varchar(255) not null,
+    "recipients" jsonb not null,
+    "substitutionData" jsonb,
+    "status" varchar(20) not null default 'PENDING', -- PENDING, SENDING, SENT or DEAD
+    "attempts" integer not null default 0,
+    "nextAttempt" timestamp default CURRENT_TIMESTAMP,
+    "lastError" text,
+    "created" timestamp default CURRENT_TIMESTAMP,
+    "updated" timestamp default CURRENT_TIMESTAMP,
+    primary key ("id")
+);
+
+create index mail_outbox_due_idx on mail_outbox ("status", "nextAttempt") where "status" in ('PENDING', 'SENDING');
+
 create user coupon_redemption_admin with password '<PASSWORD HERE>';
 
 grant select, insert, update, delete on table redemption_code to coupon_redemption_admin;
+grant select, insert, update, delete on table redemption_code_status_count to coupon_redemption_admin;
+grant select, insert, update, delete on table mail_outbox to coupon_redemption_admin;
+grant usage on sequence mail_outbox_id_seq to coupon_redemption_admin;
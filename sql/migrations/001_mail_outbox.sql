@@ -0,0 +1,19 @@
+-- Outbox of SparkPost transmissions sent by the background mail dispatcher (utils/mail.py)
+create table mail_outbox (
+    "id" bigserial,
+    "templateId" varchar(255) not null,
+    "recipients" jsonb not null,
+    "substitutionData" jsonb,
+    "status" varchar(20) not null default 'PENDING', -- PENDING, SENDING, SENT or DEAD
+    "attempts" integer not null default 0,
+    "nextAttempt" timestamp default CURRENT_TIMESTAMP,
+    "lastError" text,
+    "created" timestamp default CURRENT_TIMESTAMP,
+    "updated" timestamp default CURRENT_TIMESTAMP,
+    primary key ("id")
+);
+
+create index mail_outbox_due_idx on mail_outbox ("status", "nextAttempt") where "status" in ('PENDING', 'SENDING');
+
+grant select, insert, update, delete on table mail_outbox to coupon_redemption_admin;
+grant usage on sequence mail_outbox_id_seq to coupon_redemption_admin;
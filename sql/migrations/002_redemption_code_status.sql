@@ -0,0 +1,44 @@
+-- Explicit lifecycle status for redemption codes so the admin tabs read partial indexes instead of scanning the table.
+-- Run with psql without -1/--single-transaction: create index concurrently cannot run inside a transaction block.
+
+alter table redemption_code add column "codeStatus" varchar(20);
+
+create or replace function redemption_code_set_status() returns trigger as $$
+begin
+    NEW."codeStatus" := CASE
+        WHEN coalesce(NEW."tracking", '') <> '' THEN 'SHIPPED'
+        WHEN NEW."firstName" is not null and NEW."state" is not null THEN 'PENDING SHIPPING'
+        ELSE 'AVAILABLE'
+    END;
+    return NEW;
+end;
+$$ language plpgsql;
+
+create trigger redemption_code_status_trg
+    before insert or update on redemption_code
+    for each row execute procedure redemption_code_set_status();
+
+-- Backfill existing rows in batches, committing each one to keep row locks short. The trigger derives the status.
+do $$
+begin
+    loop
+        update redemption_code set "codeStatus" = null
+        where "redeemCode" in (select "redeemCode" from redemption_code where "codeStatus" is null limit 50000);
+        exit when not found;
+        commit;
+    end loop;
+end;
+$$;
+
+alter table redemption_code alter column "codeStatus" set default 'AVAILABLE';
+alter table redemption_code alter column "codeStatus" set not null;
+alter table redemption_code add constraint redemption_code_status_check
+    check ("codeStatus" in ('AVAILABLE', 'PENDING SHIPPING', 'SHIPPED'));
+
+-- One index per admin tab, matching its filter and keyset sort order
+create index concurrently redemption_code_available_idx on redemption_code ("productRef", "redeemCode") where "codeStatus" = 'AVAILABLE';
+create index concurrently redemption_code_pending_idx on redemption_code ("created", "redeemCode") where "codeStatus" = 'PENDING SHIPPING';
+create index concurrently redemption_code_shipped_idx on redemption_code ("created", "redeemCode") where "codeStatus" = 'SHIPPED';
+create index concurrently redemption_code_used_idx on redemption_code ("created", "redeemCode") where "codeStatus" <> 'AVAILABLE';
+
+analyze redemption_code;
@@ -0,0 +1,68 @@
+-- Per status row counts for the admin tabs, kept current by statement level triggers so a page load reads a few
+-- counter rows instead of counting the table. Each status is spread over 16 shards so concurrent redemptions
+-- rarely wait on the same counter row; readers sum the shards.
+
+create table redemption_code_status_count (
+    "codeStatus" varchar(20) not null,
+    "shard" integer not null,
+    "total" bigint not null default 0,
+    primary key ("codeStatus", "shard")
+);
+
+create or replace function redemption_code_count_insert() returns trigger as $$
+begin
+    insert into redemption_code_status_count ("codeStatus", "shard", "total")
+    select "codeStatus", floor(random() * 16)::integer, count(*) from new_rows group by "codeStatus"
+    on conflict ("codeStatus", "shard") do update set "total" = redemption_code_status_count."total" + excluded."total";
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function redemption_code_count_update() returns trigger as $$
+begin
+    insert into redemption_code_status_count ("codeStatus", "shard", "total")
+    select "codeStatus", floor(random() * 16)::integer, sum("delta") from (
+        select "codeStatus", 1 as "delta" from new_rows
+        union all
+        select "codeStatus", -1 as "delta" from old_rows
+    ) changes
+    group by "codeStatus"
+    having sum("delta") <> 0
+    on conflict ("codeStatus", "shard") do update set "total" = redemption_code_status_count."total" + excluded."total";
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function redemption_code_count_delete() returns trigger as $$
+begin
+    insert into redemption_code_status_count ("codeStatus", "shard", "total")
+    select "codeStatus", floor(random() * 16)::integer, -count(*) from old_rows group by "codeStatus"
+    on conflict ("codeStatus", "shard") do update set "total" = redemption_code_status_count."total" + excluded."total";
+    return null;
+end;
+$$ language plpgsql;
+
+create trigger redemption_code_count_insert_trg
+    after insert on redemption_code
+    referencing new table as new_rows
+    for each statement execute procedure redemption_code_count_insert();
+
+create trigger redemption_code_count_update_trg
+    after update on redemption_code
+    referencing old table as old_rows new table as new_rows
+    for each statement execute procedure redemption_code_count_update();
+
+create trigger redemption_code_count_delete_trg
+    after delete on redemption_code
+    referencing old table as old_rows
+    for each statement execute procedure redemption_code_count_delete();
+
+grant select, insert, update, delete on table redemption_code_status_count to coupon_redemption_admin;
+
+-- Seed the counters, the same statement backs the admin "Recount" action
+begin;
+lock table redemption_code in share mode;
+delete from redemption_code_status_count;
+insert into redemption_code_status_count ("codeStatus", "shard", "total")
+select "codeStatus", 0, count(*) from redemption_code group by "codeStatus";
+commit;
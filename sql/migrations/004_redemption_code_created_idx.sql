@@ -0,0 +1,5 @@
+-- Lets the unknown code filter (utils/bloom.py) read the newest "created" from the end of an index, so a code missing
+-- from a process's filter is only rejected once the database shows no code was added since the filter was built.
+-- Run with psql without -1/--single-transaction: create index concurrently cannot run inside a transaction block.
+
+create index concurrently redemption_code_created_idx on redemption_code ("created");
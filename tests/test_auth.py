@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import jwt
+
+from unittest import mock
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+"""
+OktaTokenValidator against a stub JWKS document served from a file:// url, and the introspection fallback of
+app.is_token_active().  Run from the repository root:
+
+    python -m unittest discover tests
+"""
+
+for name, value in {
+        "START_BACKGROUND_SERVICES": "false",
+        "LOG_LEVEL": "ERROR",
+        "OKTA_ORG_URL": "https://tests.invalid",
+        "OKTA_API_TOKEN": "tests",
+        "OKTA_APP_CLIENT_ID": "tests",
+        "OKTA_APP_CLIENT_SECRET": "tests",
+        "DATABASE_HOST": "tests.invalid",
+        "DATABASE_NAME": "tests",
+        "DATABASE_USER": "tests",
+        "DATABASE_PASSWORD": "tests"}.items():
+    os.environ.setdefault(name, value)
+
+from utils.auth import OktaTokenValidator, TokenValidationError, JWKSUnavailableError
+
+ISSUER = "https://tests.invalid/oauth2/default"
+AUDIENCE = "api://tests"
+
+
+def generate_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def get_jwk(private_key, kid):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+
+    return jwk
+
+
+def sign_token(private_key, kid, issuer=ISSUER, audience=AUDIENCE, expires_in=3600):
+    claims = {
+        "iss": issuer,
+        "aud": audience,
+        "sub": "tests",
+        "exp": int(time.time()) + expires_in
+    }
+
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+class JWKSTestCase(unittest.TestCase):
+    """ Writes the stub JWKS document to a temporary directory, write_jwks() replaces its keys """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.jwks_path = os.path.join(self.work_dir, "jwks.json")
+        self.jwks_url = "file://{0}".format(self.jwks_path)
+        self.key = generate_key()
+        self.write_jwks(get_jwk(self.key, "key-1"))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_jwks(self, *jwks):
+        with open(self.jwks_path, mode="w") as jwks_file:
+            json.dump({"keys": list(jwks)}, jwks_file)
+
+    def get_validator(self, **kwargs):
+        settings = {
+            "jwks_url": self.jwks_url,
+            "jwks_min_refresh_interval": 60,
+            "leeway": 30
+        }
+        settings.update(kwargs)
+
+        return OktaTokenValidator(ISSUER, AUDIENCE, **settings)
+
+
+class OktaTokenValidatorTest(JWKSTestCase):
+
+    def test_valid_token(self):
+        claims = self.get_validator().validate(sign_token(self.key, "key-1"))
+
+        self.assertEqual(claims["sub"], "tests")
+        self.assertEqual(claims["iss"], ISSUER)
+
+    def test_wrong_issuer(self):
+        with self.assertRaises(TokenValidationError):
+            self.get_validator().validate(sign_token(self.key, "key-1", issuer="https://other.invalid/oauth2/default"))
+
+    def test_wrong_audience(self):
+        with self.assertRaises(TokenValidationError):
+            self.get_validator().validate(sign_token(self.key, "key-1", audience="api://other"))
+
+    def test_expired_token(self):
+        with self.assertRaises(TokenValidationError):
+            self.get_validator().validate(sign_token(self.key, "key-1", expires_in=-120))
+
+    def test_expired_token_within_leeway(self):
+        self.get_validator().validate(sign_token(self.key, "key-1", expires_in=-10))
+
+    def test_wrong_signing_key(self):
+        with self.assertRaises(TokenValidationError):
+            self.get_validator().validate(sign_token(generate_key(), "key-1"))
+
+    def test_unknown_kid_refreshes_at_most_once_per_interval(self):
+        validator = self.get_validator()
+        validator.validate(sign_token(self.key, "key-1"))
+
+        with mock.patch.object(validator, "load_jwks", wraps=validator.load_jwks) as load_jwks:
+            for _ in range(3):
+                with self.assertRaises(TokenValidationError) as context:
+                    validator.validate(sign_token(self.key, "key-unknown"))
+
+                self.assertNotIsInstance(context.exception, JWKSUnavailableError)
+
+            self.assertEqual(load_jwks.call_count, 0)  # fetched less than jwks_min_refresh_interval ago
+
+            validator._fetched_at -= 61
+            with self.assertRaises(TokenValidationError):
+                validator.validate(sign_token(self.key, "key-unknown"))
+
+            self.assertEqual(load_jwks.call_count, 1)
+
+    def test_key_rotation(self):
+        validator = self.get_validator()
+        validator.validate(sign_token(self.key, "key-1"))
+
+        rotated_key = generate_key()
+        self.write_jwks(get_jwk(self.key, "key-1"), get_jwk(rotated_key, "key-2"))
+        token = sign_token(rotated_key, "key-2")
+
+        # The new kid is only looked up once the minimum refresh interval has passed
+        with self.assertRaises(TokenValidationError):
+            validator.validate(token)
+
+        validator._fetched_at -= 61
+        self.assertEqual(validator.validate(token)["sub"], "tests")
+        self.assertEqual(validator.validate(sign_token(self.key, "key-1"))["sub"], "tests")
+
+    def test_stale_keys_are_refreshed(self):
+        validator = self.get_validator(jwks_cache_ttl=3600)
+        validator.validate(sign_token(self.key, "key-1"))
+
+        rotated_key = generate_key()
+        self.write_jwks(get_jwk(rotated_key, "key-2"))
+        validator._fetched_at -= 3601
+
+        with self.assertRaises(TokenValidationError):
+            validator.validate(sign_token(self.key, "key-1"))  # retired with the refresh
+        validator.validate(sign_token(rotated_key, "key-2"))
+
+    def test_keeps_cached_keys_while_jwks_is_unavailable(self):
+        validator = self.get_validator()
+        validator.validate(sign_token(self.key, "key-1"))
+
+        os.remove(self.jwks_path)
+        validator._fetched_at -= 3601
+
+        self.assertEqual(validator.validate(sign_token(self.key, "key-1"))["sub"], "tests")
+
+    def test_failed_refresh_backs_off(self):
+        validator = self.get_validator()
+        validator.validate(sign_token(self.key, "key-1"))
+
+        os.remove(self.jwks_path)
+        validator._fetched_at -= 3601
+
+        with mock.patch.object(validator, "load_jwks", wraps=validator.load_jwks) as load_jwks:
+            for _ in range(5):
+                validator.validate(sign_token(self.key, "key-1"))
+
+            self.assertEqual(load_jwks.call_count, 1)
+
+            validator._retry_at -= 61
+            validator.validate(sign_token(self.key, "key-1"))
+
+            self.assertEqual(load_jwks.call_count, 2)
+            self.assertGreater(validator._retry_at - time.time(), 61)  # the second failure waits twice as long
+
+    def test_jwks_unavailable(self):
+        os.remove(self.jwks_path)
+
+        with self.assertRaises(JWKSUnavailableError):
+            self.get_validator().validate(sign_token(self.key, "key-1"))
+
+    def test_from_config_derives_issuer(self):
+        auth_config = {
+            "issuer": None,
+            "audience": AUDIENCE,
+            "jwks_url": None,
+            "jwks_cache_ttl": 3600,
+            "jwks_min_refresh_interval": 60,
+            "leeway": 30
+        }
+
+        with mock.patch.dict(os.environ, {"OKTA_ORG_URL": "https://tests.invalid", "OKTA_AUTHSERVER_ID": "default"}):
+            validator = OktaTokenValidator.from_config(auth_config)
+
+        self.assertEqual(validator.issuer, ISSUER)
+        self.assertEqual(validator.jwks_url, ISSUER + "/v1/keys")
+
+
+class IntrospectionFallbackTest(JWKSTestCase):
+    """ app.is_token_active() in "local" auth mode """
+
+    def setUp(self):
+        super().setUp()
+        import app
+
+        self.app = app
+        self.okta_util = mock.Mock()
+        self.okta_util.introspect_oauth_token.return_value = {"active": True, "exp": int(time.time()) + 3600}
+
+    def is_token_active(self, token, introspection_fallback):
+        with mock.patch.object(self.app, "token_validator", self.get_validator()), \
+                mock.patch.dict(self.app.config.auth, {"introspection_fallback": introspection_fallback}):
+            return self.app.is_token_active(self.okta_util, token)
+
+    def test_valid_token_skips_introspection(self):
+        self.assertTrue(self.is_token_active(sign_token(self.key, "key-1"), True))
+        self.okta_util.introspect_oauth_token.assert_not_called()
+
+    def test_rejected_token_skips_introspection(self):
+        self.assertFalse(self.is_token_active(sign_token(self.key, "key-1", audience="api://other"), True))
+        self.okta_util.introspect_oauth_token.assert_not_called()
+
+    def test_falls_back_to_introspection_when_jwks_is_unavailable(self):
+        os.remove(self.jwks_path)
+        token = sign_token(self.key, "key-1")
+
+        self.assertTrue(self.is_token_active(token, True))
+        self.okta_util.introspect_oauth_token.assert_called_once_with(token)
+
+    def test_no_fallback_when_disabled(self):
+        os.remove(self.jwks_path)
+
+        self.assertFalse(self.is_token_active(sign_token(self.key, "key-1"), False))
+        self.okta_util.introspect_oauth_token.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
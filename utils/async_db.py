@@ -0,0 +1,138 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import asyncpg
+import config
+
+from utils import metrics
+from utils.logs import LazyJson
+from utils.db import RedemptionCodeDB
+
+"""
+asyncpg counterpart of RedemptionCodeDB for async_app.py.  Only the statements the public endpoints need live here,
+and they reuse RedemptionCodeDB's SQL so both servers claim codes the same way.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def to_asyncpg_sql(sql):
+    """ Rewrites psycopg2's %s placeholders as asyncpg's numbered $1, $2, ... """
+    counter = iter(range(1, sql.count("%s") + 1))
+
+    return re.sub(r"%s", lambda match: "${0}".format(next(counter)), sql)
+
+
+class AsyncRedemptionCodeDB:
+
+    POOL = None
+    POOL_LOCK = None
+    POOL_SETTINGS = {}
+    CLAIM_REDEMPTION_CODE_SQL = to_asyncpg_sql(RedemptionCodeDB.CLAIM_REDEMPTION_CODE_SQL)
+    ENQUEUE_MAIL_SQL = to_asyncpg_sql(RedemptionCodeDB.ENQUEUE_MAIL_SQL)
+
+    def __init__(self, checkout_timeout=10):
+        self.checkout_timeout = checkout_timeout
+
+    @classmethod
+    async def open_pool(cls, min_size=5, max_size=20, command_timeout=10):
+        """ Call from the event loop that will use the pool, e.g. the aiohttp on_startup hook """
+        cls.POOL_SETTINGS = {
+            "min_size": min_size,
+            "max_size": max_size,
+            "command_timeout": command_timeout
+        }
+
+        return await cls.get_pool()
+
+    @classmethod
+    async def get_pool(cls):
+        if cls.POOL is None:
+            if cls.POOL_LOCK is None:
+                cls.POOL_LOCK = asyncio.Lock()
+
+            async with cls.POOL_LOCK:
+                if cls.POOL is None:
+                    logger.info("AsyncRedemptionCodeDB.get_pool(%s)", LazyJson(cls.POOL_SETTINGS, sort_keys=True))
+                    cls.POOL = await asyncpg.create_pool(
+                        host=os.environ["DATABASE_HOST"],
+                        database=os.environ["DATABASE_NAME"],
+                        user=os.environ["DATABASE_USER"],
+                        password=os.environ["DATABASE_PASSWORD"],
+                        ssl=config.database["sslmode"],  # asyncpg takes the same mode names as libpq
+                        **cls.POOL_SETTINGS)
+
+        return cls.POOL
+
+    @classmethod
+    async def close_pool(cls):
+        if cls.POOL is not None:
+            pool, cls.POOL = cls.POOL, None
+            await pool.close()
+
+    @classmethod
+    def get_pool_stats(cls):
+        if cls.POOL is None:
+            return {}
+
+        return {
+            "size": cls.POOL.get_size(),
+            "idle": cls.POOL.get_idle_size(),
+            "min_size": cls.POOL.get_min_size(),
+            "max_size": cls.POOL.get_max_size()
+        }
+
+    async def acquire(self):
+        started_at = time.time()
+        pool = await self.get_pool()
+        conn = await pool.acquire(timeout=self.checkout_timeout)
+        metrics.record_db_checkout(time.time() - started_at)
+
+        return conn
+
+    async def check_connection(self):
+        conn = await self.acquire()
+        try:
+            metrics.record_db_round_trip()
+            return await conn.fetchval("select 1;")
+        finally:
+            await self.POOL.release(conn)
+
+    async def claim_redemption_code(self, redemption_code_object, template_id, recipients):
+        """
+        RedemptionCodeDB.claim_redemption_code() and enqueue_mail() in one transaction, so the thank you mail is only
+        queued when the claim wins.  Returns a tuple of (REDEMPTION_* status, redemption code record or None)
+        """
+        logger.debug("claim_redemption_code()")
+        started_at = time.time()
+        conn = await self.acquire()
+        try:
+            async with conn.transaction():
+                metrics.record_db_round_trip()
+                row = await conn.fetchrow(
+                    self.CLAIM_REDEMPTION_CODE_SQL, *RedemptionCodeDB.get_claim_params(redemption_code_object))
+
+                if row and row["redemptionStatus"] == RedemptionCodeDB.REDEMPTION_CLAIMED:
+                    metrics.record_db_round_trip()
+                    await conn.fetchval(
+                        self.ENQUEUE_MAIL_SQL, *RedemptionCodeDB.get_enqueue_mail_params(template_id, recipients))
+        finally:
+            await self.POOL.release(conn)
+            metrics.REGISTRY.histogram(
+                "db_query_seconds", "Duration of each RedemptionCodeDB query method", query="async_claim_redemption_code"
+            ).observe(time.time() - started_at)
+
+        if not row:
+            RedemptionCodeDB.cache_redemption_code(redemption_code_object["redeemCode"], None)
+            return RedemptionCodeDB.REDEMPTION_UNKNOWN, None
+
+        result = dict(row)
+        redemption_status = result.pop("redemptionStatus")
+        if redemption_status == RedemptionCodeDB.REDEMPTION_USED:
+            RedemptionCodeDB.cache_redemption_code(redemption_code_object["redeemCode"], result)
+        else:
+            RedemptionCodeDB.invalidate_cached_codes([redemption_code_object["redeemCode"]])
+
+        return redemption_status, result
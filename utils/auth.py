@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import threading
+import logging
+import requests
+import jwt
+
+logger = logging.getLogger(__name__)
+
+
+class TokenValidationError(Exception):
+    """ The token was checked and is not acceptable (bad signature, wrong issuer or audience, expired, ...) """
+    pass
+
+
+class JWKSUnavailableError(TokenValidationError):
+    """ The signing keys could not be loaded, so the token could not be checked locally """
+    pass
+
+
+class OktaTokenValidator:
+    """
+    Validates Okta access tokens locally against the authorization server's JWKS document.
+    Keys are fetched once and cached for jwks_cache_ttl seconds.  A token signed with a key id that is not cached
+    triggers a refresh so key rotation is picked up, at most once every jwks_min_refresh_interval seconds.  A failed
+    refresh keeps the cached keys and is retried with exponential backoff from jwks_min_refresh_interval up to
+    jwks_cache_ttl, and only one thread fetches at a time while the others keep validating.
+    jwks_url may be a file:// path to a stub JWKS document for offline use
+    """
+
+    def __init__(self, issuer, audience, jwks_url=None, jwks_cache_ttl=3600, jwks_min_refresh_interval=60, leeway=30,
+                 algorithms=None, timeout=5):
+        logger.debug("OktaTokenValidator.__init__")
+        self.issuer = issuer
+        self.audience = audience
+        self.jwks_url = jwks_url or "{0}/v1/keys".format(issuer)
+        self.jwks_cache_ttl = jwks_cache_ttl
+        self.jwks_min_refresh_interval = jwks_min_refresh_interval
+        self.leeway = leeway
+        self.algorithms = algorithms or ["RS256"]
+        self.timeout = timeout
+
+        self._keys = {}
+        self._fetched_at = 0
+        self._failures = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, auth_config):
+        """ Builds the validator from config.auth, deriving the issuer from the Okta org and authorization server """
+        issuer = auth_config["issuer"]
+
+        if not issuer:
+            auth_server = ""
+            if "OKTA_AUTHSERVER_ID" in os.environ:
+                auth_server = "/{0}".format(os.environ["OKTA_AUTHSERVER_ID"])
+            issuer = "{0}/oauth2{1}".format(os.environ["OKTA_ORG_URL"], auth_server)
+
+        return cls(
+            issuer,
+            auth_config["audience"],
+            jwks_url=auth_config["jwks_url"],
+            jwks_cache_ttl=auth_config["jwks_cache_ttl"],
+            jwks_min_refresh_interval=auth_config["jwks_min_refresh_interval"],
+            leeway=auth_config["leeway"])
+
+    def load_jwks(self):
+        logger.info("load_jwks(): %s", self.jwks_url)
+        try:
+            if self.jwks_url.startswith("file://"):
+                with open(self.jwks_url[len("file://"):], mode="r") as jwks_file:
+                    jwks = json.load(jwks_file)
+            else:
+                jwks_response = requests.get(self.jwks_url, headers={"Accept": "application/json"}, timeout=self.timeout)
+                jwks_response.raise_for_status()
+                jwks = jwks_response.json()
+        except (IOError, ValueError, requests.RequestException) as ex:
+            raise JWKSUnavailableError("Unable to load JWKS from {0}: {1}".format(self.jwks_url, ex))
+
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("use", "sig") != "sig" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+            except jwt.PyJWTError as ex:
+                logger.warning("Skipping unusable JWK %s: %s", jwk.get("kid"), ex)
+
+        return keys
+
+    def needs_refresh(self, kid, now):
+        if now < self._retry_at:
+            return False
+
+        is_stale = now - self._fetched_at > self.jwks_cache_ttl
+        is_unknown = kid not in self._keys and now - self._fetched_at > self.jwks_min_refresh_interval
+
+        return is_stale or is_unknown
+
+    def refresh_keys(self, kid):
+        """
+        Fetches the JWKS outside the lock and swaps the keys in under it.  While keys are cached a refresh already
+        running elsewhere is not waited for, without any the first request waits for it
+        """
+        if not self._refresh_lock.acquire(blocking=not self._keys):
+            return
+
+        try:
+            now = time.time()
+            if not self.needs_refresh(kid, now):
+                return  # refreshed by the thread this one waited for
+
+            try:
+                keys = self.load_jwks()
+            except JWKSUnavailableError:
+                # Keep serving the keys we have rather than failing every request while the endpoint is down, and
+                # back off instead of refetching on every request
+                with self._lock:
+                    self._failures += 1
+                    self._retry_at = now + min(self.jwks_min_refresh_interval * 2 ** (self._failures - 1), self.jwks_cache_ttl)
+                if not self._keys:
+                    raise
+                return
+
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = now
+                self._failures = 0
+                self._retry_at = 0
+        finally:
+            self._refresh_lock.release()
+
+    def get_signing_key(self, kid):
+        if self.needs_refresh(kid, time.time()):
+            self.refresh_keys(kid)
+
+        with self._lock:
+            keys = self._keys
+
+        if kid not in keys:
+            if not keys:
+                raise JWKSUnavailableError("No signing keys available from {0}".format(self.jwks_url))
+            raise TokenValidationError("Token signed with unknown key id {0}".format(kid))
+
+        return keys[kid]
+
+    def validate(self, token):
+        """ Returns the token's claims, or raises TokenValidationError """
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as ex:
+            raise TokenValidationError("Malformed token: {0}".format(ex))
+
+        if header.get("alg") not in self.algorithms:
+            raise TokenValidationError("Unexpected token algorithm {0}".format(header.get("alg")))
+
+        signing_key = self.get_signing_key(header.get("kid"))
+
+        try:
+            return jwt.decode(
+                token,
+                signing_key,
+                algorithms=self.algorithms,
+                audience=self.audience,
+                issuer=self.issuer,
+                leeway=self.leeway,
+                options={"require": ["exp", "iss", "aud"]})
+        except jwt.PyJWTError as ex:
+            raise TokenValidationError(str(ex))
@@ -0,0 +1,380 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import uuid
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+import jwt
+
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+"""
+Load test and benchmark harness for the redemption and admin paths.  Not a test suite: it serves the app on a local
+port, seeds codes into the configured PostgreSQL database and drives concurrent traffic at it.
+
+    # A disposable database loaded with sql/createdb.sql
+    export DATABASE_HOST=localhost DATABASE_NAME=coupon_bench DATABASE_USER=... DATABASE_PASSWORD=...
+    python3 -m utils.benchmark --codes 20000 --concurrency 16
+    python3 -m utils.benchmark --save-baseline
+
+Okta is not needed, admin requests carry a token signed by a key generated for the run (AUTH_MODE=local) and mail goes
+to the fake SparkPost server.  Every scenario reports throughput, p50/p95/p99 latency and PostgreSQL statements per
+request, and is compared with the numbers stored in benchmarks/baseline.json by --save-baseline.
+Seeded and uploaded codes share a per run prefix and are deleted afterwards unless --keep is given.
+"""
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "benchmarks", "baseline.json")
+BENCH_ISSUER = "https://benchmark.invalid/oauth2/default"
+BENCH_AUDIENCE = "api://default"
+BENCH_KID = "benchmark"
+TABS = ["pendingshippingtab", "shippedtab", "availablecodestab", "alltab"]
+
+
+def setup_environment(args, work_dir):
+    """ Points the app at a generated signing key and the fake SparkPost server, must run before the app is imported """
+    from utils.fake_sparkpost import FakeSparkPostServer
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": BENCH_KID, "use": "sig", "alg": "RS256"})
+    jwks_path = os.path.join(work_dir, "jwks.json")
+    with open(jwks_path, mode="w") as jwks_file:
+        json.dump({"keys": [jwk]}, jwks_file)
+
+    sparkpost_server = FakeSparkPostServer(port=0)
+    sparkpost_server.start()
+
+    environment = {
+        "AUTH_MODE": "local",
+        "AUTH_INTROSPECTION_FALLBACK": "false",
+        "OKTA_ISSUER": BENCH_ISSUER,
+        "OKTA_AUDIENCE": BENCH_AUDIENCE,
+        "OKTA_JWKS_URL": "file://{0}".format(jwks_path),
+        "OKTA_ORG_URL": "https://benchmark.invalid",
+        "OKTA_API_TOKEN": "benchmark",
+        "OKTA_APP_CLIENT_ID": "benchmark",
+        "OKTA_APP_CLIENT_SECRET": "benchmark",
+        "OKTA_OIDC_REDIRECT_URL": "https://benchmark.invalid/oidc",
+        "SPARKPOST_API_URL": sparkpost_server.api_url,
+        "SPARKPOST_API_KEY": "benchmark",
+        "SPARKPOST_THANK_TEMPLATE_ID": "benchmark-thanks",
+        "SPARKPOST_TRACK_TEMPLATE_ID": "benchmark-tracking",
+        "MAIL_DISPATCHER_ENABLED": "true" if args.with_dispatcher else "false",
+        "LOG_LEVEL": args.log_level,
+        "SLOW_REQUEST_THRESHOLD": "0",
+        "RATE_LIMIT_ENABLED": "false"  # every simulated client shares one address
+    }
+    for name, value in environment.items():
+        os.environ[name] = value  # a deployment's own settings would point the run at Okta or SparkPost
+
+    token = jwt.encode(
+        {
+            "iss": BENCH_ISSUER,
+            "aud": BENCH_AUDIENCE,
+            "sub": "benchmark",
+            "exp": int(time.time()) + 24 * 3600
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": BENCH_KID})
+
+    return token, sparkpost_server
+
+
+def start_app_server(host, port):
+    from werkzeug.serving import make_server
+    from app import app
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # one access log line per request would skew the numbers
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name="benchmark-app", daemon=True)
+    thread.start()
+
+    return server, "http://{0}:{1}".format(host, server.server_port)
+
+
+def get_round_trips():
+    from utils import metrics
+
+    return metrics.REGISTRY.counter("db_round_trips_total", "Statements sent to PostgreSQL").value
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest rank percentile of an already sorted list """
+    if not sorted_values:
+        return 0.0
+
+    index = max(0, min(len(sorted_values) - 1, int(math.ceil(fraction * len(sorted_values))) - 1))
+
+    return sorted_values[index]
+
+
+def run_scenario(name, work_items, send, concurrency):
+    """ Calls send(session, item) for every item from concurrency threads and summarizes the latencies """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    local = threading.local()
+
+    def worker(item):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.headers["X-Forwarded-Proto"] = "https"  # keeps SSLify from redirecting plain http
+
+        started_at = time.time()
+        try:
+            ok = send(local.session, item)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.time() - started_at
+
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors[0] += 1
+
+    round_trips_before = get_round_trips()
+    started_at = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, work_items))
+    wall_time = time.time() - started_at
+    round_trips = get_round_trips() - round_trips_before
+
+    latencies.sort()
+    request_count = len(latencies)
+
+    return {
+        "scenario": name,
+        "requests": request_count,
+        "errors": errors[0],
+        "concurrency": concurrency,
+        "throughput": request_count / wall_time if wall_time else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "db_round_trips_per_request": float(round_trips) / request_count if request_count else 0.0
+    }
+
+
+def seed_codes(prefix, count):
+    from utils.db import RedemptionCodeDB
+
+    code_rows = ((line + 2, "{0}{1:08d}".format(prefix, line), "BENCH") for line in range(count))
+    code_results = RedemptionCodeDB().bulk_create_redemption_code(code_rows)
+
+    return ["{0}{1:08d}".format(prefix, line) for line in range(count)], code_results["INSERTED"]
+
+
+def delete_codes(prefix):
+    from utils.db import RedemptionCodeDB, TimedCursor
+
+    with RedemptionCodeDB().connection() as conn:
+        cur = conn.cursor(cursor_factory=TimedCursor)
+        cur.execute("""delete from redemption_code where "redeemCode" like %s;""", (prefix + "%",))
+
+        return cur.rowcount
+
+
+def build_csv(header, rows):
+    csv_data_io = io.StringIO()
+    csv_data_io.write(",".join(header) + "\r\n")
+    for row in rows:
+        csv_data_io.write(",".join(row) + "\r\n")
+
+    return csv_data_io.getvalue().encode("UTF-8")
+
+
+def run_benchmarks(args, base_url, token):
+    run_prefix = "BN" + uuid.uuid4().hex[:6].upper()
+    admin_headers = {"Authorization": "Bearer {0}".format(token)}
+    results = []
+
+    print("Seeding {0} codes with prefix {1}".format(args.codes, run_prefix))
+    codes, inserted = seed_codes(run_prefix, args.codes)
+    print("Seeded {0} codes".format(inserted))
+
+    def redeem(session, code):
+        response = session.post(base_url + "/redeemCode", json={
+            "redeemCode": code,
+            "firstName": "Bench",
+            "lastName": "Mark",
+            "address1": "1 Load Test Way",
+            "address2": "",
+            "city": "Springfield",
+            "state": "OR",
+            "postalCode": "97477",
+            "phone": "5555550100",
+            "email": "bench@example.com"
+        })
+        return response.status_code == 200 and response.json().get("status") == "SUCCESS"
+
+    redeem_codes = codes[:args.redeem_requests]
+    results.append(run_scenario("redeem", redeem_codes, redeem, args.concurrency))
+
+    def tab_page(session, tab):
+        response = session.get(
+            "{0}/admin/{1}".format(base_url, tab),
+            params={"rows_per_page": args.rows_per_page},
+            headers=admin_headers)
+        return response.status_code == 200
+
+    for tab in TABS:
+        results.append(run_scenario("tab_" + tab, [tab] * args.tab_requests, tab_page, args.concurrency))
+
+    def export(session, status):
+        response = session.get("{0}/admin/exportall/{1}".format(base_url, status), headers=admin_headers, stream=True)
+        for _ in response.iter_content(64 * 1024):
+            pass
+        return response.status_code == 200
+
+    results.append(run_scenario("export_all", ["all"] * args.export_requests, export, min(args.concurrency, 4)))
+
+    def upload(session, upload):
+        url, body = upload
+        response = session.post(base_url + url, data=body, headers=dict(admin_headers, **{"Content-Type": "text/csv"}))
+        return response.status_code == 200
+
+    upload_number = 0
+    for size in args.upload_sizes:
+        uploads = []
+        for repeat in range(args.upload_repeats):
+            upload_number += 1
+            upload_prefix = "{0}U{1:02d}".format(run_prefix, upload_number % 100)
+            body = build_csv(
+                ["RedemptionCode", "ProductRef"],
+                [("{0}{1:08d}".format(upload_prefix, line), "BENCH") for line in range(size)])
+            uploads.append(("/admin/codefileupload", body))
+        results.append(run_scenario("upload_codes_{0}".format(size), uploads, upload, 1))
+
+    tracking_body = build_csv(
+        ["RedemptionCode", "Tracking"],
+        [(code, "1Z{0}".format(code)) for code in redeem_codes])
+    results.append(run_scenario(
+        "upload_tracking_{0}".format(len(redeem_codes)), [("/admin/trackingfileupload", tracking_body)], upload, 1))
+
+    if not args.keep:
+        print("Deleted {0} benchmark codes".format(delete_codes(run_prefix)))
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+
+    with open(BASELINE_PATH, mode="r") as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(results, commit):
+    baseline = {"commit": commit, "saved": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "scenarios": {}}
+    for result in results:
+        baseline["scenarios"][result["scenario"]] = result
+
+    os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+    with open(BASELINE_PATH, mode="w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+
+
+def compare(result, baseline_result, tolerance):
+    """ Names the figures that are worse than the baseline by more than tolerance (a fraction) """
+    regressions = []
+    if not baseline_result:
+        return regressions
+
+    if result["p95"] > baseline_result["p95"] * (1 + tolerance):
+        regressions.append("p95")
+    if result["throughput"] < baseline_result["throughput"] * (1 - tolerance):
+        regressions.append("throughput")
+    if result["db_round_trips_per_request"] > baseline_result["db_round_trips_per_request"] * (1 + tolerance):
+        regressions.append("db_round_trips")
+
+    return regressions
+
+
+def report(results, baseline, tolerance):
+    baseline_scenarios = baseline.get("scenarios", {})
+    regression_count = 0
+
+    print("")
+    print("{0:<32} {1:>8} {2:>7} {3:>10} {4:>9} {5:>9} {6:>9} {7:>9}  {8}".format(
+        "scenario", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "db/req",
+        "vs baseline {0}".format(baseline.get("commit") or "-")))
+
+    for result in results:
+        regressions = compare(result, baseline_scenarios.get(result["scenario"]), tolerance)
+        regression_count += len(regressions)
+        print("{0:<32} {1:>8} {2:>7} {3:>10.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>9.1f}  {8}".format(
+            result["scenario"],
+            result["requests"],
+            result["errors"],
+            result["throughput"],
+            result["p50"] * 1000,
+            result["p95"] * 1000,
+            result["p99"] * 1000,
+            result["db_round_trips_per_request"],
+            "REGRESSION: " + ", ".join(regressions) if regressions else ""))
+
+    return regression_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the redemption and admin paths against a local database")
+    parser.add_argument("--codes", type=int, default=5000, help="codes seeded before the run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--redeem-requests", type=int, default=2000, help="at most --codes")
+    parser.add_argument("--tab-requests", type=int, default=200, help="requests per admin tab")
+    parser.add_argument("--rows-per-page", type=int, default=50)
+    parser.add_argument("--export-requests", type=int, default=5)
+    parser.add_argument("--upload-sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1000, 10000])
+    parser.add_argument("--upload-repeats", type=int, default=3)
+    parser.add_argument("--with-dispatcher", action="store_true", help="send the queued mail during the run")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results in " + BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fraction worse than the baseline")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    parser.add_argument("--keep", action="store_true", help="leave the benchmark codes in the database")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        token, sparkpost_server = setup_environment(args, work_dir)
+        app_server, base_url = start_app_server(args.host, args.port)
+        print("Benchmarking {0}".format(base_url))
+
+        try:
+            results = run_benchmarks(args, base_url, token)
+        finally:
+            app_server.shutdown()
+            sparkpost_server.shutdown()
+
+    commit = get_commit()
+    regression_count = report(results, load_baseline(), args.tolerance)
+
+    if args.output:
+        with open(args.output, mode="w") as output_file:
+            json.dump({"commit": commit, "results": results}, output_file, indent=4, sort_keys=True)
+
+    if args.save_baseline:
+        save_baseline(results, commit)
+        print("Baseline saved to {0}".format(BASELINE_PATH))
+
+    if regression_count and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,259 @@
+import math
+import time
+import hashlib
+import logging
+import threading
+
+from utils.db import RedemptionCodeDB
+
+"""
+Bloom filter of every issued redemption code, so /redeemCode can turn away codes that were never issued without
+a query.  A Bloom filter never misses a code it was given, but answers "maybe" for a small fraction (the error rate)
+of codes it was not, which then go on to the database as before.  A miss is only final while the filter holds every
+code the last read of the code watermark (see RedemptionCodeDB.get_code_watermark()) counted, as any other process may
+have added codes since.
+
+At a 0.1% error rate a code costs about 1.8 bytes, 20 million codes fit in about 36MB.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """ Thread safe Bloom filter sized for capacity items at error_rate false positives """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))  # bits
+        self.hash_count = max(1, int(round(self.size / float(self.capacity) * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def get_positions(self, item):
+        # Double hashing: two 64 bit halves of one digest stand in for hash_count independent hashes
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return [(first + index * second) % self.size for index in range(self.hash_count)]
+
+    def add(self, item):
+        self.add_all([item])
+
+    def add_all(self, items):
+        positions_list = [self.get_positions(item) for item in items]
+
+        # Setting a bit is a read, modify, write of its byte, so writers take turns
+        with self._lock:
+            bits = self._bits
+            for positions in positions_list:
+                for position in positions:
+                    bits[position >> 3] |= 1 << (position & 7)
+            self.count += len(positions_list)
+
+    def __contains__(self, item):
+        bits = self._bits
+
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(item))
+
+    def get_stats(self):
+        return {
+            "capacity": self.capacity,
+            "count": self.count,
+            "error_rate": self.error_rate,
+            "hash_count": self.hash_count,
+            "bytes": len(self._bits)
+        }
+
+
+class RedemptionCodeFilter:
+    """
+    Keeps a BloomFilter of redemption_code up to date in a background thread.  Every refresh_interval seconds the
+    code watermark is read: codes created after the newest one the filter holds are added to it, and the filter is
+    rebuilt from the whole table when codes were deleted (the count is lower than the codes loaded), when codes
+    committed late with an older "created", when it outgrew its capacity or every rebuild_interval seconds.  Codes
+    created by this process are added right away.  Until the first build completes every code is let through
+    """
+
+    def __init__(self, enabled=True, error_rate=0.001, min_capacity=100000, capacity_headroom=1.25, refresh_interval=1,
+                 rebuild_interval=3600, batch_size=10000):
+        self.enabled = enabled
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.capacity_headroom = capacity_headroom  # room for codes created before the next rebuild
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+
+        self._filter = None
+        self._building = None
+        self._loaded_count = 0  # codes read from the table into _filter, by the build and every update since
+        self._loaded_created = None  # the newest "created" among them
+        self._built_at = 0
+        self._is_current = False
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.stats = {
+            "builds": 0,
+            "updates": 0,
+            "checks": 0,
+            "rechecked": 0,
+            "rejected": 0
+        }
+
+    @classmethod
+    def from_config(cls, bloom_config):
+        return cls(**bloom_config)
+
+    def start(self):
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+
+        logger.info("RedemptionCodeFilter.start()")
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name="redemption-code-filter", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as ex:
+                self._is_current = False
+                logger.exception("RedemptionCodeFilter.run() failed: %s", ex)
+
+            self._stop_event.wait(self.refresh_interval)
+
+    def refresh(self):
+        """
+        Reads the code watermark and brings the filter up to it.  The filter is only current once a watermark read
+        after the last update matches what was loaded, codes committed in between show up on the next read
+        """
+        total, newest_created = RedemptionCodeDB().get_code_watermark()
+
+        if self._filter is None or time.time() - self._built_at >= self.rebuild_interval:
+            self._is_current = False
+            self.build()
+        elif newest_created is not None and (self._loaded_created is None or newest_created > self._loaded_created):
+            self._is_current = False
+            self.update()
+        elif total == self._loaded_count:
+            self._is_current = True
+        else:
+            # Lower: codes were deleted.  Higher with nothing newer: a transaction committed codes with a "created"
+            # older than what was loaded.  Either way only a full read of the table is exact
+            self._is_current = False
+            self.build()
+
+        self._checked_at = time.time()
+
+    def load(self, bloom_filter, created_after=None):
+        """ Adds the codes (created after created_after) to bloom_filter, returns (codes read, newest "created") """
+        loaded_count = 0
+        loaded_created = created_after
+
+        for rows in RedemptionCodeDB().iterate_redemption_codes(self.batch_size, created_after):
+            bloom_filter.add_all([row[0] for row in rows])
+            loaded_count += len(rows)
+            for row in rows:
+                if row[1] is not None and (loaded_created is None or row[1] > loaded_created):
+                    loaded_created = row[1]
+
+            if self._stop_event.is_set():
+                return None
+
+        return loaded_count, loaded_created
+
+    def build(self):
+        """ Loads every code into a new filter and swaps it in, codes added meanwhile go into both """
+        started_at = time.time()
+        total = RedemptionCodeDB().get_code_watermark()[0]
+        bloom_filter = BloomFilter(max(self.min_capacity, total * self.capacity_headroom), self.error_rate)
+
+        with self._lock:
+            self._building = bloom_filter
+
+        try:
+            loaded = self.load(bloom_filter)
+            if loaded is None:
+                return
+
+            with self._lock:
+                self._filter = bloom_filter
+                self._loaded_count, self._loaded_created = loaded
+                self._built_at = time.time()
+                self.stats["builds"] += 1
+        finally:
+            with self._lock:
+                self._building = None
+
+        logger.info("RedemptionCodeFilter.build() loaded %s codes in %.1fs", bloom_filter.count, time.time() - started_at,
+                    extra=bloom_filter.get_stats())
+
+    def update(self):
+        """ Adds the codes created after the newest one loaded, rebuilding instead once the filter is over capacity """
+        loaded = self.load(self._filter, self._loaded_created)
+        if loaded is None:
+            return
+
+        self._loaded_count += loaded[0]
+        self._loaded_created = loaded[1]
+        self.stats["updates"] += 1
+        logger.debug("RedemptionCodeFilter.update() added %s codes", loaded[0])
+
+        if self._filter.count > self._filter.capacity:
+            self.build()
+
+    def add_all(self, redemption_codes):
+        """
+        Called by RedemptionCodeDB for the codes it creates, so they are let through before the next refresh reads
+        them.  Holding the lock means a build either started before this, and gets the codes too, or starts after and
+        reads them from the table once they are committed
+        """
+        with self._lock:
+            for bloom_filter in [self._filter, self._building]:
+                if bloom_filter is not None:
+                    bloom_filter.add_all(redemption_codes)
+
+    def might_contain(self, redemption_code):
+        """ False only for codes missing from the filter, check is_current() before treating that as final """
+        bloom_filter = self._filter
+        if bloom_filter is None:
+            return True
+
+        self.stats["checks"] += 1
+
+        return redemption_code in bloom_filter
+
+    def is_current(self):
+        """
+        True when the last watermark read, at most a few refresh intervals ago, counted no code the filter is
+        missing, so a might_contain() miss means the code was never issued.  Answered from memory, misses go on to
+        the database while it is False
+        """
+        if self._is_current and time.time() - self._checked_at <= 3 * self.refresh_interval + 1:
+            self.stats["rejected"] += 1
+            return True
+
+        self.stats["rechecked"] += 1
+
+        return False
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["enabled"] = self.enabled
+        stats["ready"] = self._filter is not None
+        stats["current"] = self._is_current
+        if self._filter is not None:
+            stats.update(self._filter.get_stats())
+
+        return stats
@@ -0,0 +1,83 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ Thread safe, size bounded LRU cache whose entries also expire after a per entry time to live """
+
+    def __init__(self, max_size=1000, default_ttl=60):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        # Membership checks do not touch the hit/miss counters or the LRU order
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._entries)
+            stats["max_size"] = self.max_size
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = float(stats["hits"]) / lookups if lookups else 0.0
+
+        return stats
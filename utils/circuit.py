@@ -0,0 +1,84 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """ The upstream's circuit breaker is open, so the call was not attempted """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails fast once an upstream has failed failure_threshold times in a row.  After reset_timeout seconds one trial
+    call is let through (HALF_OPEN), success closes the circuit again and failure re-opens it for another timeout
+    """
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.stats = {
+            "successes": 0,
+            "failures": 0,
+            "rejected": 0,
+            "opened": 0
+        }
+
+    def before_call(self):
+        """ Raises CircuitOpenError when the call should not be attempted """
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+
+            if self.state == self.CLOSED:
+                return
+
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+
+            self.stats["rejected"] += 1
+
+        raise CircuitOpenError("Circuit for {0} is open".format(self.name))
+
+    def record_success(self):
+        with self._lock:
+            self.stats["successes"] += 1
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.stats["failures"] += 1
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+
+            if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats["opened"] += 1
+                    logger.warning("CircuitBreaker %s opened after %s failures", self.name, self._consecutive_failures)
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["state"] = self.state
+            stats["consecutive_failures"] = self._consecutive_failures
+
+        return stats
@@ -1,25 +1,295 @@
 import os
+import time
+import threading
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 import json
+import config
+import logging
+
+from contextlib import contextmanager
+from utils import metrics
+from utils.logs import LazyJson
+from utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+NOT_CACHED = object()
+timed_query = metrics.timed("db_query_seconds", "Duration of each RedemptionCodeDB query method", label="query")
+
+
+class ConnectionPool:
+    """ Process wide pool of PostgreSQL connections shared by every RedemptionCodeDB instance """
+
+    def __init__(self, database_config, min_size=1, max_size=10, checkout_timeout=5, health_check_idle=30):
+        logger.debug("ConnectionPool.__init__")
+        self.DATABASE_CONFIG = database_config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_idle = health_check_idle
+
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, **database_config)
+        self._available = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "discarded": 0,
+            "in_use": 0
+        }
+
+    def _increment(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Left over from a caller that failed mid transaction
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+
+        # Only ping connections that sat idle long enough for the server or a proxy to drop them
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.time() - last_used > self.health_check_idle:
+            try:
+                cur = conn.cursor()
+                cur.execute("select 1;")
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def getconn(self):
+        started_at = time.time()
+        if not self._available.acquire(blocking=False):
+            self._increment("waits")
+            if not self._available.acquire(timeout=self.checkout_timeout):
+                self._increment("timeouts")
+                raise psycopg2.pool.PoolError(
+                    "Timed out after {0}s waiting for a database connection".format(self.checkout_timeout))
+
+        try:
+            conn = self._pool.getconn()
+            while not self._is_healthy(conn):
+                self._increment("discarded")
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
+
+        self._increment("checkouts")
+        self._increment("in_use")
+        metrics.record_db_checkout(time.time() - started_at)
+
+        return conn
+
+    def putconn(self, conn, close=False):
+        close = close or bool(conn.closed)
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.time()
+
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._increment("in_use", -1)
+            self._available.release()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+
+        stats["min_size"] = self.min_size
+        stats["max_size"] = self.max_size
+
+        return stats
+
+    def closeall(self):
+        logger.debug("ConnectionPool.closeall()")
+        self._pool.closeall()
+
+
+class TimedCursor(psycopg2.extras.RealDictCursor):
+    """ RealDictCursor that counts every statement sent to the server, per request and in db_round_trips_total """
+
+    def execute(self, query, vars=None):
+        self._record_round_trip()
+        return super(TimedCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self._record_round_trip()
+        return super(TimedCursor, self).executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self._record_round_trip()
+        return super(TimedCursor, self).copy_expert(sql, file, size)
+
+    def _record_round_trip(self):
+        metrics.REGISTRY.counter("db_round_trips_total", "Statements sent to PostgreSQL").increment()
+        metrics.record_db_round_trip()
+
+
+class CopyStream:
+    """ File like object that feeds an iterable of row tuples to cursor.copy_expert() in COPY text format """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ""
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return "\\N"
+
+        return (str(value)
+                .replace("\\", "\\\\")
+                .replace("\t", "\\t")
+                .replace("\n", "\\n")
+                .replace("\r", "\\r"))
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += "\t".join([self.format_value(value) for value in row]) + "\n"
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return chunk
 
 
 class RedemptionCodeDB:
 
     DATABASE_CONFIG = {}
+    POOL = None
+    POOL_LOCK = threading.Lock()
+    CODE_FILTER = None  # a RedemptionCodeFilter told about every code created here, see utils/bloom.py
+    # Read through cache of get_redemption_code_by_code() for codes that do not exist or are already redeemed, the
+    # rows that no longer change on their own.  Writes made here invalidate it, writes by other processes show after the ttl
+    CODE_CACHE = TTLCache(config.database["code_cache_size"], config.database["code_cache_ttl"])
+    REDEMPTION_CLAIMED = "CLAIMED"
+    REDEMPTION_USED = "USED"
+    REDEMPTION_UNKNOWN = "UNKNOWN"
+    # Values of the "codeStatus" column, kept by the redemption_code_set_status() trigger
+    STATUS_AVAILABLE = "AVAILABLE"
+    STATUS_PENDING_SHIPPING = "PENDING SHIPPING"
+    STATUS_SHIPPED = "SHIPPED"
+    PAGE_NEXT = "next"
+    PAGE_PREVIOUS = "previous"
+    # Keyset sort columns of the admin tabs, page tokens carry one value per column
+    AVAILABLE_KEY_COLUMNS = ["productRef", "redeemCode"]
+    REDEEMED_KEY_COLUMNS = ["created", "redeemCode"]
+    TIMESTAMP_KEY_COLUMNS = ["created"]
+    CODE_WATERMARK_SQL = """select
+            (select coalesce(sum("total"), 0) from redemption_code_status_count)::bigint as "total",
+            (select max("created") from redemption_code) as "newestCreated";"""
+    REDEEMED_SELECT_SQL = """
+        SELECT
+            "productRef",
+            "redeemCode",
+            "firstName",
+            "lastName",
+            "address1",
+            "address2",
+            "city",
+            "state",
+            "postalCode",
+            "phone",
+            "email",
+            "tracking",
+            "created",
+            "updated",
+            "codeStatus" as "status"
+        FROM redemption_code"""
+
+    # The outer select reads the statement snapshot, so it only reports the existing row when the claim missed
+    CLAIM_REDEMPTION_CODE_SQL = """WITH claimed AS (
+            UPDATE redemption_code SET
+                "firstName" = %s,
+                "lastName" = %s,
+                "address1" = %s,
+                "address2" = %s,
+                "city" = %s,
+                "state" = %s,
+                "postalCode" = %s,
+                "phone" = %s,
+                "email" = %s,
+                "updated" = CURRENT_TIMESTAMP
+            WHERE "redeemCode" = %s AND "email" IS NULL
+            RETURNING *
+        )
+        SELECT %s::text AS "redemptionStatus", claimed.* FROM claimed
+        UNION ALL
+        SELECT %s::text AS "redemptionStatus", existing.* FROM redemption_code existing
+        WHERE existing."redeemCode" = %s AND NOT EXISTS (SELECT 1 FROM claimed);"""
+    ENQUEUE_MAIL_SQL = """insert into mail_outbox ("templateId", "recipients", "substitutionData") values (%s, %s, %s) returning "id";"""
 
     def __init__(self):
-        print("RedemptionCodeDB.__init__")
+        logger.debug("RedemptionCodeDB.__init__")
 
         self.DATABASE_CONFIG = {
             "host": os.environ['DATABASE_HOST'],
             "database": os.environ['DATABASE_NAME'],
             "user": os.environ['DATABASE_USER'],
             "password": os.environ['DATABASE_PASSWORD'],
-            "sslmode": "require"
+            "sslmode": config.database["sslmode"]
         }
 
-        print("DATABASE_CONFIG: {0}".format(json.dumps(self.DATABASE_CONFIG, indent=4, sort_keys=True)))
+        logger.debug("DATABASE_CONFIG: %s", LazyJson(self.DATABASE_CONFIG, indent=4, sort_keys=True))
+
+    @classmethod
+    def get_pool(cls, database_config):
+        """ Lazily creates the shared pool so every instance in the process borrows from the same connections """
+        if cls.POOL is None:
+            with cls.POOL_LOCK:
+                if cls.POOL is None:
+                    cls.POOL = ConnectionPool(
+                        database_config,
+                        min_size=config.database["pool_min_size"],
+                        max_size=config.database["pool_max_size"],
+                        checkout_timeout=config.database["pool_checkout_timeout"],
+                        health_check_idle=config.database["pool_health_check_idle"])
+
+        return cls.POOL
+
+    @classmethod
+    def reset_pool(cls):
+        """ Forgets a pool inherited across fork() without closing it, its sockets still belong to the parent process """
+        cls.POOL = None
+        cls.POOL_LOCK = threading.Lock()
+
+    @classmethod
+    def close_pool(cls):
+        with cls.POOL_LOCK:
+            if cls.POOL is not None:
+                cls.POOL.closeall()
+                cls.POOL = None
+
+    @classmethod
+    def get_pool_stats(cls):
+        if cls.POOL is None:
+            return {}
+
+        return cls.POOL.get_stats()
 
     def dict_factory(self, cursor, row):
         d = {}
@@ -28,66 +298,210 @@ class RedemptionCodeDB:
         return d
 
     def get_connection(self):
-        print("get_connection()")
-        conn = psycopg2.connect(**self.DATABASE_CONFIG)
+        logger.debug("get_connection()")
+        conn = self.get_pool(self.DATABASE_CONFIG).getconn()
         #conn.row_factory = self.dict_factory
 
         return conn
 
     def commit_close_connection(self, conn):
-        print("commit_close_connection()")
-        conn.commit()
-        conn.close()
+        logger.debug("commit_close_connection()")
+        try:
+            conn.commit()
+        finally:
+            self.get_pool(self.DATABASE_CONFIG).putconn(conn)
+
+    def rollback_close_connection(self, conn):
+        logger.debug("rollback_close_connection()")
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        finally:
+            self.get_pool(self.DATABASE_CONFIG).putconn(conn)
 
+    @contextmanager
+    def connection(self):
+        """ Borrows a pooled connection, committing on success and rolling back on error before returning it """
+        conn = self.get_connection()
+        try:
+            yield conn
+        except BaseException:
+            # BaseException so an abandoned streaming generator (GeneratorExit) still returns its connection
+            self.rollback_close_connection(conn)
+            raise
+        else:
+            self.commit_close_connection(conn)
+
+    @timed_query
+    def check_connection(self):
+        """ Round trip used by the readiness check """
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("select 1 as \"ok\";")
+
+            return cur.fetchone()["ok"] == 1
+
+    @timed_query
     def delete_redemption_code(self, redemption_code):
-        print("delete_redemption_code()")
+        logger.debug("delete_redemption_code()")
         result = "SUCCESS"
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        params = (
-            redemption_code,
-        )
-        cur.execute("""delete from redemption_code where "redeemCode"=%s;""", params)
-        self.commit_close_connection(conn)
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            params = (
+                redemption_code,
+            )
+            cur.execute("""delete from redemption_code where "redeemCode"=%s;""", params)
+
+        self.invalidate_cached_codes([redemption_code])
 
         return result
 
+    @timed_query
     def create_redemption_code(self, redemption_code, product_ref):
-        print("create_redemption_code()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        params = (
-            redemption_code,
-            product_ref,
-        )
-        cur.execute("""insert into redemption_code ("redeemCode", "productRef") values (%s, %s);""", params)
-        cur.execute("""select * from redemption_code where "redeemCode"=%s;""", (redemption_code,))
+        logger.debug("create_redemption_code()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            params = (
+                redemption_code,
+                product_ref,
+            )
+            cur.execute("""insert into redemption_code ("redeemCode", "productRef") values (%s, %s);""", params)
+            cur.execute("""select * from redemption_code where "redeemCode"=%s;""", (redemption_code,))
 
-        result = cur.fetchone()
+            result = cur.fetchone()
 
-        self.commit_close_connection(conn)
+        self.on_codes_created([redemption_code])
 
         return result
 
-    def batch_create_redemption_code(self, params_list):
-        print("batch_create_redemption_code()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        sql = """insert into redemption_code ("redeemCode", "productRef") values ($1, $2)"""
+    def on_codes_created(self, redemption_codes):
+        """ Adds new codes to CODE_FILTER and drops any cached "does not exist" for them """
+        if self.CODE_FILTER is not None:
+            self.CODE_FILTER.add_all(redemption_codes)
 
-        cur.execute("PREPARE stmt AS {0}".format(sql))
-        psycopg2.extras.execute_batch(cur, "EXECUTE stmt (%s, %s)", params_list, page_size=100)
-        cur.execute("DEALLOCATE stmt")
+        self.invalidate_cached_codes(redemption_codes)
 
-        print("Total Records Inserted")
-        self.commit_close_connection(conn)
+    def track_created_code_rows(self, code_rows, batch_size=1000):
+        """
+        Passes (line, redeemCode, productRef) rows through, calling on_codes_created() on the way so an upload is never
+        held in memory.  Codes that turn out to exist already or be invalid only add harmless filter false positives
+        """
+        redemption_codes = []
+        for code_row in code_rows:
+            redemption_codes.append(code_row[1])
+            if len(redemption_codes) >= batch_size:
+                self.on_codes_created(redemption_codes)
+                redemption_codes = []
 
-    def update_redemption_code(self, redemption_code_object):
-        print("update_redemption_code()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        params = (
-            redemption_code_object["productRef"],
+            yield code_row
+
+        self.on_codes_created(redemption_codes)
+
+    @classmethod
+    def invalidate_cached_codes(cls, redemption_codes):
+        for redemption_code in redemption_codes:
+            cls.CODE_CACHE.delete(redemption_code)
+
+    @classmethod
+    def cache_redemption_code(cls, redemption_code, redemption_code_record):
+        """ Caches a lookup result when it can not change without a write through this class """
+        if redemption_code_record is None:
+            cls.CODE_CACHE.set(redemption_code, None, config.database["code_cache_negative_ttl"])
+        elif redemption_code_record["email"] is not None:
+            cls.CODE_CACHE.set(redemption_code, dict(redemption_code_record))
+        else:
+            # Available codes are about to be claimed
+            cls.CODE_CACHE.delete(redemption_code)
+
+    @classmethod
+    def get_cached_redemption_status(cls, redemption_code):
+        """ REDEMPTION_UNKNOWN or REDEMPTION_USED when the cache already knows the code can not be claimed, else None """
+        cached = cls.CODE_CACHE.get(redemption_code, NOT_CACHED)
+
+        if cached is None:
+            return cls.REDEMPTION_UNKNOWN
+        elif cached is not NOT_CACHED:
+            return cls.REDEMPTION_USED
+
+        return None
+
+    @classmethod
+    def get_code_cache_stats(cls):
+        return cls.CODE_CACHE.get_stats()
+
+    @timed_query
+    def bulk_create_redemption_code(self, code_rows, sample_size=100):
+        """
+        Loads an upload of new codes in one pass.  code_rows is an iterable of (line, redeemCode, productRef) that is
+        streamed into a temp staging table with COPY, then inserted with ON CONFLICT DO NOTHING so codes that already
+        exist are skipped.  Only the first line of a code repeated within the file is inserted.
+        Returns a dict of counts per status (INSERTED, EXISTING, DUPLICATE_IN_FILE, INVALID) and up to sample_size codes
+        for each status under "codes"
+        """
+        logger.debug("bulk_create_redemption_code()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("""create temp table code_staging (
+                "line" integer,
+                "redeemCode" text,
+                "productRef" text
+            ) on commit drop;""")
+            cur.copy_expert(
+                """copy code_staging ("line", "redeemCode", "productRef") from stdin;""",
+                CopyStream(self.track_created_code_rows(code_rows)))
+
+            cur.execute("""WITH ranked AS (
+                    SELECT
+                        "line",
+                        "redeemCode",
+                        "productRef",
+                        row_number() over (partition by "redeemCode" order by "line") as "occurrence",
+                        char_length("redeemCode") <= 20 and char_length("productRef") <= 255 as "isValid"
+                    FROM code_staging
+                ), inserted AS (
+                    INSERT INTO redemption_code ("redeemCode", "productRef")
+                    SELECT "redeemCode", "productRef" FROM ranked
+                    WHERE "occurrence" = 1 and "isValid"
+                    ON CONFLICT ("redeemCode") DO NOTHING
+                    RETURNING "redeemCode"
+                ), outcomes AS (
+                    SELECT
+                        ranked."line",
+                        ranked."redeemCode",
+                        CASE
+                            WHEN not ranked."isValid" THEN 'INVALID'
+                            WHEN ranked."occurrence" > 1 THEN 'DUPLICATE_IN_FILE'
+                            WHEN inserted."redeemCode" is not null THEN 'INSERTED'
+                            ELSE 'EXISTING'
+                        END as "status"
+                    FROM ranked
+                    LEFT JOIN inserted ON inserted."redeemCode" = ranked."redeemCode" and ranked."occurrence" = 1
+                )
+                SELECT
+                    "status",
+                    count(*) as "result_count",
+                    (array_agg("redeemCode" order by "line"))[1:%s] as "codes"
+                FROM outcomes
+                GROUP BY "status";""", (sample_size,))
+
+            result = {
+                "INSERTED": 0,
+                "EXISTING": 0,
+                "DUPLICATE_IN_FILE": 0,
+                "INVALID": 0,
+                "codes": {}
+            }
+            for outcome in cur.fetchall():
+                result[outcome["status"]] = outcome["result_count"]
+                result["codes"][outcome["status"]] = outcome["codes"]
+
+        return result
+
+    @classmethod
+    def get_claim_params(cls, redemption_code_object):
+        """ Parameters for CLAIM_REDEMPTION_CODE_SQL, in placeholder order """
+        return (
             redemption_code_object["firstName"],
             redemption_code_object["lastName"],
             redemption_code_object["address1"],
@@ -95,196 +509,546 @@ class RedemptionCodeDB:
             redemption_code_object["city"],
             redemption_code_object["state"],
             redemption_code_object["postalCode"],
-            redemption_code_object["country"],
             redemption_code_object["phone"],
             redemption_code_object["email"],
-            redemption_code_object["tracking"],
+            redemption_code_object["redeemCode"],
+            cls.REDEMPTION_CLAIMED,
+            cls.REDEMPTION_USED,
             redemption_code_object["redeemCode"],
         )
 
-        sql = """UPDATE redemption_code SET
-            "productRef" = %s,
-            "firstName" = %s,
-            "lastName" = %s,
-            "address1" = %s,
-            "address2" = %s,
-            "city" = %s,
-            "state" = %s,
-            "postalCode" = %s,
-            "country" = %s,
-            "phone" = %s,
-            "email" = %s,
-            "tracking" = %s,
-            "updated" = CURRENT_TIMESTAMP
-            WHERE "redeemCode" = %s;"""
-        cur.execute(sql, params)
-        cur.execute("""select * from redemption_code where "redeemCode"=%s;""", (redemption_code_object["redeemCode"],))
+    @classmethod
+    def get_enqueue_mail_params(cls, template_id, recipients, substitution=None):
+        """ Parameters for ENQUEUE_MAIL_SQL """
+        return (
+            template_id,
+            json.dumps(recipients),
+            json.dumps(substitution) if substitution else None,
+        )
 
-        result = cur.fetchone()
+    @timed_query
+    def claim_redemption_code(self, redemption_code_object, conn=None):
+        """
+        Atomically claims an unused code with the redeemer's details in a single statement.
+        The conditional UPDATE only matches while "email" is still null, so concurrent requests for the same
+        code cannot both win.  Returns a tuple of (REDEMPTION_* status, redemption code record or None)
+        """
+        logger.debug("claim_redemption_code()")
+        sql = self.CLAIM_REDEMPTION_CODE_SQL
+        params = self.get_claim_params(redemption_code_object)
 
-        self.commit_close_connection(conn)
+        if(conn):
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute(sql, params)
+
+            result = cur.fetchone()
+        else:
+            with self.connection() as conn:
+                cur = conn.cursor(cursor_factory = TimedCursor)
+                cur.execute(sql, params)
+
+                result = cur.fetchone()
+
+        if not result:
+            self.cache_redemption_code(redemption_code_object["redeemCode"], None)
+            return self.REDEMPTION_UNKNOWN, None
+
+        redemption_status = result.pop("redemptionStatus")
+        if redemption_status == self.REDEMPTION_USED:
+            self.cache_redemption_code(redemption_code_object["redeemCode"], result)
+        else:
+            self.invalidate_cached_codes([redemption_code_object["redeemCode"]])
+
+        return redemption_status, result
+
+    @timed_query
+    def bulk_update_tracking(self, tracking_rows, on_updated=None, batch_size=1000, sample_size=100):
+        """
+        Applies tracking numbers for an upload in one pass.  tracking_rows is an iterable of (line, redeemCode, tracking)
+        that is streamed into a temp staging table with COPY and applied with a single UPDATE ... FROM, whose per line
+        outcomes stay in a second temp table.  Rows without a code or tracking number are reported as INVALID.
+        The updated codes are read back batch_size at a time with a server side cursor, with the redeemer's name and
+        email, and passed to on_updated(rows, conn) inside the same transaction, e.g. to queue the tracking mail.
+        Returns a dict of counts per status (UPDATED, DUPLICATE, MISSING, INVALID) and up to sample_size of the rows
+        that were not updated, in line order, under "rows"
+        """
+        logger.debug("bulk_update_tracking()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("""create temp table tracking_staging (
+                "line" integer,
+                "redeemCode" text,
+                "tracking" text
+            ) on commit drop;""")
+            cur.execute("""create temp table tracking_outcome (
+                "line" integer,
+                "redeemCode" text,
+                "tracking" text,
+                "email" text,
+                "firstName" text,
+                "lastName" text,
+                "status" text
+            ) on commit drop;""")
+            cur.copy_expert("""copy tracking_staging ("line", "redeemCode", "tracking") from stdin;""", CopyStream(tracking_rows))
+
+            # When a code appears more than once in the file the last line wins
+            cur.execute("""WITH validated AS (
+                    SELECT
+                        "line",
+                        "redeemCode",
+                        "tracking",
+                        coalesce("redeemCode", '') <> '' and coalesce("tracking", '') <> '' and char_length("tracking") <= 100 as "isValid"
+                    FROM tracking_staging
+                ), latest AS (
+                    SELECT DISTINCT ON ("redeemCode") "line", "redeemCode", "tracking"
+                    FROM validated
+                    WHERE "isValid"
+                    ORDER BY "redeemCode", "line" DESC
+                ), updated AS (
+                    UPDATE redemption_code SET
+                        "tracking" = latest."tracking",
+                        "updated" = CURRENT_TIMESTAMP
+                    FROM latest
+                    WHERE redemption_code."redeemCode" = latest."redeemCode"
+                    RETURNING latest."line", latest."redeemCode", redemption_code."email", redemption_code."firstName", redemption_code."lastName"
+                )
+                INSERT INTO tracking_outcome ("line", "redeemCode", "tracking", "email", "firstName", "lastName", "status")
+                SELECT
+                    validated."line",
+                    validated."redeemCode",
+                    validated."tracking",
+                    updated."email",
+                    updated."firstName",
+                    updated."lastName",
+                    CASE
+                        WHEN updated."line" is not null THEN 'UPDATED'
+                        WHEN not validated."isValid" THEN 'INVALID'
+                        WHEN EXISTS (SELECT 1 FROM updated later WHERE later."redeemCode" = validated."redeemCode") THEN 'DUPLICATE'
+                        ELSE 'MISSING'
+                    END
+                FROM validated
+                LEFT JOIN updated ON updated."line" = validated."line";""")
+
+            result = {
+                "UPDATED": 0,
+                "DUPLICATE": 0,
+                "MISSING": 0,
+                "INVALID": 0
+            }
+            cur.execute("""select "status", count(*) as "result_count" from tracking_outcome group by "status";""")
+            for outcome in cur.fetchall():
+                result[outcome["status"]] = outcome["result_count"]
+
+            cur.execute("""select "line", "redeemCode", "tracking", "status" from tracking_outcome
+                where "status" <> 'UPDATED'
+                order by "line"
+                limit %s;""", (sample_size,))
+            result["rows"] = cur.fetchall()
+
+            updated_cur = conn.cursor(name="bulk_update_tracking", cursor_factory = TimedCursor)
+            updated_cur.itersize = batch_size
+            updated_cur.execute("""select "line", "redeemCode", "tracking", "email", "firstName", "lastName" from tracking_outcome
+                where "status" = 'UPDATED';""")
+
+            while True:
+                rows = updated_cur.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                self.invalidate_cached_codes([row["redeemCode"] for row in rows])
+                if on_updated is not None:
+                    on_updated(rows, conn)
+
+            updated_cur.close()
 
         return result
 
+    @timed_query
+    def update_redemption_code(self, redemption_code_object):
+        logger.debug("update_redemption_code()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            params = (
+                redemption_code_object["productRef"],
+                redemption_code_object["firstName"],
+                redemption_code_object["lastName"],
+                redemption_code_object["address1"],
+                redemption_code_object["address2"],
+                redemption_code_object["city"],
+                redemption_code_object["state"],
+                redemption_code_object["postalCode"],
+                redemption_code_object["country"],
+                redemption_code_object["phone"],
+                redemption_code_object["email"],
+                redemption_code_object["tracking"],
+                redemption_code_object["redeemCode"],
+            )
+
+            sql = """UPDATE redemption_code SET
+                "productRef" = %s,
+                "firstName" = %s,
+                "lastName" = %s,
+                "address1" = %s,
+                "address2" = %s,
+                "city" = %s,
+                "state" = %s,
+                "postalCode" = %s,
+                "country" = %s,
+                "phone" = %s,
+                "email" = %s,
+                "tracking" = %s,
+                "updated" = CURRENT_TIMESTAMP
+                WHERE "redeemCode" = %s;"""
+            cur.execute(sql, params)
+            cur.execute("""select * from redemption_code where "redeemCode"=%s;""", (redemption_code_object["redeemCode"],))
+
+            result = cur.fetchone()
+
+        self.invalidate_cached_codes([redemption_code_object["redeemCode"]])
+
+        return result
+
+    @timed_query
+    def update_tracking(self, redemption_code, tracking, conn):
+        """
+        Sets the tracking number of one code inside the caller's transaction, so the tracking mail can be queued in
+        it too.  Returns the updated row, or None when the code does not exist.  The caller invalidates the cached
+        code once the transaction committed
+        """
+        logger.debug("update_tracking()")
+        cur = conn.cursor(cursor_factory = TimedCursor)
+        cur.execute("""UPDATE redemption_code SET
+            "tracking" = %s,
+            "updated" = CURRENT_TIMESTAMP
+            WHERE "redeemCode" = %s
+            RETURNING *;""", (tracking, redemption_code))
+
+        return cur.fetchone()
+
+    @timed_query
     def get_redemption_code_by_code(self, redemption_code, conn=None):
-        print("get_redemption_code_by_code()")
+        logger.debug("get_redemption_code_by_code()")
         sql = """select * from redemption_code where "redeemCode"=%s;"""
         result = None
 
         if(conn):
-            cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+            # Inside the caller's transaction, which may have changed the row
+            cur = conn.cursor(cursor_factory = TimedCursor)
             cur.execute(sql, (redemption_code,))
 
             result = cur.fetchone()
         else:
-            conn = self.get_connection()
-            cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-            cur.execute(sql, (redemption_code,))
+            cached = self.CODE_CACHE.get(redemption_code, NOT_CACHED)
+            if cached is not NOT_CACHED:
+                # Callers may change the record they get back
+                return dict(cached) if cached is not None else None
 
-            result = cur.fetchone()
+            with self.connection() as conn:
+                cur = conn.cursor(cursor_factory = TimedCursor)
+                cur.execute(sql, (redemption_code,))
 
-            self.commit_close_connection(conn)
+                result = cur.fetchone()
+
+            self.cache_redemption_code(redemption_code, result)
 
         return result
 
-    def get_unused_redemption_codes(self, rows_per_page, current_page):
-        print("get_unused_redemption_codes()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        cur.execute("""select "productRef", "redeemCode" from redemption_code
-            where "tracking" is null and "city" is null
-            and "firstName" is null
-            and "state" is null
-            order by "productRef", "redeemCode"
-        LIMIT {rows_per_page} OFFSET {starting_row};""".format(
-            rows_per_page=rows_per_page,
-            starting_row=((current_page - 1) * rows_per_page) # Need to set an offset to get the right records
-        ))
+    def get_keyset_page(self, cur, select_sql, where_sql, key_columns, rows_per_page, page_key=None, direction=None):
+        """
+        Keyset (seek) pagination: instead of an OFFSET that scans and discards earlier rows, the page starts right after
+        (PAGE_NEXT) or right before (PAGE_PREVIOUS) page_key, the key_columns values of the row at the page boundary.
+        Returns the rows plus a dict with "has_next"/"has_previous" and the boundary keys for building page links
+        """
+        params = []
+        descending = direction == self.PAGE_PREVIOUS
+        key_sql = ", ".join(['"{0}"'.format(key_column) for key_column in key_columns])
+
+        if page_key:
+            where_sql = "{0} and ({1}) {2} ({3})".format(
+                where_sql,
+                key_sql,
+                "<" if descending else ">",
+                ", ".join(["%s"] * len(key_columns)))
+            params.extend(page_key)
+
+        order_sql = ", ".join(['"{0}"{1}'.format(key_column, " DESC" if descending else "") for key_column in key_columns])
+
+        # One extra row tells us whether there is another page beyond this one
+        cur.execute("{0} {1} order by {2} LIMIT %s;".format(select_sql, where_sql, order_sql), params + [rows_per_page + 1])
 
         result = cur.fetchall()
+        has_more = len(result) > rows_per_page
+        result = result[:rows_per_page]
 
-        cur.execute("""select count(*) as result_count
-            from redemption_code
-            where "tracking" is null and "city" is null
-            and "firstName" is null
-            and "state" is null""")
+        if descending:
+            result.reverse()
 
-        result_count = cur.fetchone()["result_count"]
+        page = {
+            "has_next": has_more if not descending else bool(page_key),
+            "has_previous": has_more if descending else bool(page_key),
+            "first_key": [result[0][key_column] for key_column in key_columns] if result else None,
+            "last_key": [result[-1][key_column] for key_column in key_columns] if result else None
+        }
 
-        print("result_count: {0}".format(result_count))
+        return result, page
 
-        self.commit_close_connection(conn)
+    def get_status_count(self, cur, where_sql):
+        """
+        Reads a tab's row count from redemption_code_status_count, which triggers keep current on every insert, update
+        and delete.  where_sql is the tab's "codeStatus" filter, the summary table uses the same column name
+        """
+        cur.execute("""select coalesce(sum("total"), 0)::bigint as result_count
+            from redemption_code_status_count
+            {where_sql};""".format(where_sql=where_sql))
 
-        return result, result_count
+        return cur.fetchone()["result_count"]
 
-    def get_pending_shipping_redemption_codes(self, rows_per_page, current_page):
-        print("get_unused_redemption_codes()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        cur.execute("""
-            SELECT
-                "productRef",
-                "redeemCode",
-                "firstName",
-                "lastName",
-                "address1",
-                "address2",
-                "city",
-                "state",
-                "postalCode",
-                "phone",
-                "email",
-                "tracking",
-                "created",
-                "updated",
-                CASE
-                    WHEN "tracking" is null or "tracking" = '' THEN 'PENDING SHIPPING'
-                    ELSE 'SHIPPED'
-                END as "status"
-            FROM redemption_code
-            WHERE "tracking" is null and "city" is not null and "firstName" is not null and "state" is not null order by "created"
-            LIMIT {rows_per_page} OFFSET {starting_row};""".format(
-            rows_per_page=rows_per_page,
-            starting_row=((current_page - 1) * rows_per_page) # Need to set an offset to get the right records
-        ))
+    @timed_query
+    def get_status_counts(self):
+        logger.debug("get_status_counts()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("""select "codeStatus", sum("total")::bigint as "total"
+                from redemption_code_status_count
+                group by "codeStatus";""")
 
-        result = cur.fetchall()
-        
-        cur.execute("""select count(*) as result_count
-            FROM redemption_code
-            WHERE "tracking" is null and "city" is not null and "firstName" is not null and "state" is not null""")
+            result = dict([(row["codeStatus"], row["total"]) for row in cur.fetchall()])
 
-        result_count = cur.fetchone()["result_count"]
+        return result
 
-        print("result_count: {0}".format(result_count))
+    @timed_query
+    def get_code_watermark(self):
+        """
+        Returns (number of codes, newest "created"), which changes whenever any process inserts or deletes codes.
+        Two index reads, the unknown code filter polls it about once a second, see utils/bloom.py
+        """
+        logger.debug("get_code_watermark()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute(self.CODE_WATERMARK_SQL)
 
-        self.commit_close_connection(conn)
+            row = cur.fetchone()
 
-        return result, result_count
+        return row["total"], row["newestCreated"]
 
-    def get_shipped_redemption_codes(self):
-        print("get_unused_redemption_codes()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        cur.execute("""
-            SELECT
-                "productRef",
-                "redeemCode",
-                "firstName",
-                "lastName",
-                "address1",
-                "address2",
-                "city",
-                "state",
-                "postalCode",
-                "phone",
-                "email",
-                "tracking",
-                "created",
-                "updated",
-                CASE
-                    WHEN "tracking" is null or "tracking" = '' THEN 'PENDING SHIPPING'
-                    ELSE 'SHIPPED'
-                END as "status"
-            FROM redemption_code
-            WHERE "tracking" is not null;""")
+    @timed_query
+    def recount_redemption_code_status(self):
+        """ Rebuilds the status counters from the table in case they drift, writers wait for the count to finish """
+        logger.debug("recount_redemption_code_status()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("lock table redemption_code in share mode;")
+            cur.execute("delete from redemption_code_status_count;")
+            cur.execute("""insert into redemption_code_status_count ("codeStatus", "shard", "total")
+                select "codeStatus", 0, count(*) from redemption_code group by "codeStatus";""")
 
-        result = cur.fetchall()
+        return self.get_status_counts()
 
-        self.commit_close_connection(conn)
+    @timed_query
+    def get_unused_redemption_codes(self, rows_per_page, page_key=None, direction=None):
+        logger.debug("get_unused_redemption_codes()")
+        where_sql = """where "codeStatus" = '{0}'""".format(self.STATUS_AVAILABLE)
 
-        return result
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            result, page = self.get_keyset_page(
+                cur,
+                """select "productRef", "redeemCode" from redemption_code""",
+                where_sql,
+                self.AVAILABLE_KEY_COLUMNS,
+                rows_per_page,
+                page_key,
+                direction)
 
-    def get_all_used_redemption_codes(self):
-        print("get_all_used_redemption_codes()")
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        cur.execute("""
-            SELECT
-                "productRef",
-                "redeemCode",
-                "firstName",
-                "lastName",
-                "address1",
-                "address2",
-                "city",
-                "state",
-                "postalCode",
-                "phone",
-                "email",
-                "tracking",
-                "created",
-                "updated",
-                CASE
-                    WHEN "tracking" is null or "tracking" = '' THEN 'PENDING SHIPPING'
-                    ELSE 'SHIPPED'
-                END as "status"
-            FROM redemption_code
-            WHERE "firstName" is not null and "state" is not null order by "created";""")
+            result_count = self.get_status_count(cur, where_sql)
 
-        result = cur.fetchall()
+            logger.debug("result_count: %s", result_count)
+
+        return result, result_count, page
+
+    @timed_query
+    def get_pending_shipping_redemption_codes(self, rows_per_page, page_key=None, direction=None):
+        logger.debug("get_pending_shipping_redemption_codes()")
+        where_sql = """WHERE "codeStatus" = '{0}'""".format(self.STATUS_PENDING_SHIPPING)
+
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            result, page = self.get_keyset_page(
+                cur,
+                self.REDEEMED_SELECT_SQL,
+                where_sql,
+                self.REDEEMED_KEY_COLUMNS,
+                rows_per_page,
+                page_key,
+                direction)
+
+            result_count = self.get_status_count(cur, where_sql)
+
+            logger.debug("result_count: %s", result_count)
+
+        return result, result_count, page
+
+    @timed_query
+    def get_shipped_redemption_codes(self, rows_per_page, page_key=None, direction=None):
+        logger.debug("get_shipped_redemption_codes()")
+        where_sql = """WHERE "codeStatus" = '{0}'""".format(self.STATUS_SHIPPED)
+
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            result, page = self.get_keyset_page(
+                cur,
+                self.REDEEMED_SELECT_SQL,
+                where_sql,
+                self.REDEEMED_KEY_COLUMNS,
+                rows_per_page,
+                page_key,
+                direction)
+
+            result_count = self.get_status_count(cur, where_sql)
+
+            logger.debug("result_count: %s", result_count)
+
+        return result, result_count, page
+
+    @timed_query
+    def get_all_used_redemption_codes(self, rows_per_page, page_key=None, direction=None):
+        logger.debug("get_all_used_redemption_codes()")
+        where_sql = """WHERE "codeStatus" <> '{0}'""".format(self.STATUS_AVAILABLE)
+
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            result, page = self.get_keyset_page(
+                cur,
+                self.REDEEMED_SELECT_SQL,
+                where_sql,
+                self.REDEEMED_KEY_COLUMNS,
+                rows_per_page,
+                page_key,
+                direction)
+
+            result_count = self.get_status_count(cur, where_sql)
+
+            logger.debug("result_count: %s", result_count)
 
-        self.commit_close_connection(conn)
+        return result, result_count, page
+
+    @timed_query
+    def enqueue_mail(self, template_id, recipients, substitution=None, conn=None):
+        """ Adds a SparkPost transmission to the mail outbox, pass conn to commit it with the change that triggered it """
+        logger.debug("enqueue_mail()")
+        sql = self.ENQUEUE_MAIL_SQL
+        params = self.get_enqueue_mail_params(template_id, recipients, substitution)
+
+        if(conn):
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute(sql, params)
+
+            result = cur.fetchone()["id"]
+        else:
+            with self.connection() as conn:
+                cur = conn.cursor(cursor_factory = TimedCursor)
+                cur.execute(sql, params)
+
+                result = cur.fetchone()["id"]
+
+        return result
+
+    @timed_query
+    def claim_pending_mail(self, batch_size, lease_timeout):
+        """
+        Marks up to batch_size due outbox rows as SENDING and returns them.  SKIP LOCKED lets several dispatchers
+        drain the outbox without sending the same row twice, and rows left in SENDING by a dispatcher that died are
+        picked up again once their lease_timeout (seconds) has passed
+        """
+        logger.debug("claim_pending_mail()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("""UPDATE mail_outbox SET
+                    "status" = 'SENDING',
+                    "attempts" = "attempts" + 1,
+                    "updated" = CURRENT_TIMESTAMP
+                WHERE "id" IN (
+                    SELECT "id" FROM mail_outbox
+                    WHERE ("status" = 'PENDING' AND "nextAttempt" <= CURRENT_TIMESTAMP)
+                    OR ("status" = 'SENDING' AND "updated" < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                    ORDER BY "nextAttempt"
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *;""", (lease_timeout, batch_size))
+
+            result = cur.fetchall()
 
         return result
 
+    @timed_query
+    def mark_mail_sent(self, mail_ids):
+        logger.debug("mark_mail_sent()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            cur.execute("""UPDATE mail_outbox SET
+                    "status" = 'SENT',
+                    "lastError" = NULL,
+                    "updated" = CURRENT_TIMESTAMP
+                WHERE "id" = ANY(%s);""", (list(mail_ids),))
+
+    @timed_query
+    def mark_mail_failed(self, failures):
+        """ failures is a list of (status, retry_delay_seconds, error, id) where status is PENDING to retry or DEAD """
+        logger.debug("mark_mail_failed()")
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = TimedCursor)
+            psycopg2.extras.execute_batch(cur, """UPDATE mail_outbox SET
+                    "status" = %s,
+                    "nextAttempt" = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    "lastError" = %s,
+                    "updated" = CURRENT_TIMESTAMP
+                WHERE "id" = %s;""", failures, page_size=100)
+
+    @timed_query
+    def iterate_export_redemption_codes(self, status=None, batch_size=2000):
+        """
+        Yields redemption codes for the CSV export through a server side named cursor, so only batch_size rows are
+        held in memory at a time.  status is "pending", "shipped" or anything else for all used codes
+        """
+        logger.debug("iterate_export_redemption_codes()")
+        if status == "pending":
+            where_clause = """WHERE "codeStatus" = '{0}' order by "created", "redeemCode" """.format(self.STATUS_PENDING_SHIPPING)
+        elif status == "shipped":
+            where_clause = """WHERE "codeStatus" = '{0}' order by "created", "redeemCode" """.format(self.STATUS_SHIPPED)
+        else:
+            where_clause = """WHERE "codeStatus" <> '{0}' order by "created", "redeemCode" """.format(self.STATUS_AVAILABLE)
+
+        with self.connection() as conn:
+            cur = conn.cursor(name="export_redemption_codes", cursor_factory = TimedCursor)
+            cur.itersize = batch_size
+            cur.execute("{0} {1};".format(self.REDEEMED_SELECT_SQL, where_clause))
+
+            for row in cur:
+                yield row
+
+            cur.close()
+
+    def iterate_redemption_codes(self, batch_size=10000, created_after=None):
+        """
+        Yields ("redeemCode", "created") tuples in lists of up to batch_size, streamed with a server side cursor.
+        Every code, or with created_after only the codes created later than it
+        """
+        logger.debug("iterate_redemption_codes(%s)", created_after)
+        with self.connection() as conn:
+            # Plain tuples, this reads the whole table
+            cur = conn.cursor(name="iterate_redemption_codes")
+            cur.itersize = batch_size
+            if created_after is None:
+                cur.execute("""select "redeemCode", "created" from redemption_code;""")
+            else:
+                cur.execute("""select "redeemCode", "created" from redemption_code where "created" > %s;""", (created_after,))
+
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                yield rows
+
+            cur.close()
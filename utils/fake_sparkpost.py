@@ -0,0 +1,118 @@
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Local stand in for the SparkPost transmissions API so mail can be exercised offline.
+
+    python3 -m utils.fake_sparkpost --port 8025 --failure-rate 0.2 --delay 0.5
+    export SPARKPOST_API_URL=http://localhost:8025/api/v1
+
+Accepted transmissions are kept in memory and can be listed with GET /api/v1/transmissions.
+A --delay longer than REST_SPARKPOST_READ_TIMEOUT, or a high --failure-rate, trips the client's circuit breaker.
+"""
+
+
+class FakeSparkPostHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/transmissions"):
+            return self.send_json(404, {"errors": [{"message": "resource not found"}]})
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if random.random() < self.server.failure_rate:
+            return self.send_json(503, {"errors": [{"message": "Service Unavailable", "code": "1902"}]})
+
+        recipients = body.get("recipients", [])
+        transmission = {
+            "id": str(uuid.uuid4().int)[:18],
+            "authorization": self.headers.get("Authorization"),
+            "body": body
+        }
+        with self.server.lock:
+            self.server.transmissions.append(transmission)
+
+        self.send_json(200, {
+            "results": {
+                "total_rejected_recipients": 0,
+                "total_accepted_recipients": len(recipients),
+                "id": transmission["id"]
+            }
+        })
+
+    def do_GET(self):
+        # Delays and failures apply here too so retries of idempotent calls can be exercised
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if random.random() < self.server.failure_rate:
+            return self.send_json(503, {"errors": [{"message": "Service Unavailable", "code": "1902"}]})
+
+        with self.server.lock:
+            transmissions = list(self.server.transmissions)
+
+        self.send_json(200, {"results": transmissions})
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except BrokenPipeError:
+            pass  # the client gave up, e.g. its read timeout is shorter than --delay
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeSparkPostServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=8025, failure_rate=0.0, delay=0.0, verbose=False):
+        ThreadingHTTPServer.__init__(self, (host, port), FakeSparkPostHandler)
+        self.failure_rate = failure_rate
+        self.delay = delay
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.transmissions = []
+
+    @property
+    def api_url(self):
+        return "http://{0}:{1}/api/v1".format(self.server_address[0], self.server_address[1])
+
+    def start(self):
+        """ Serves from a daemon thread, handy when driving the dispatcher from a script """
+        thread = threading.Thread(target=self.serve_forever, name="fake-sparkpost", daemon=True)
+        thread.start()
+
+        return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake SparkPost transmissions endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of transmissions answered with a 503")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering")
+    args = parser.parse_args()
+
+    server = FakeSparkPostServer(args.host, args.port, args.failure_rate, args.delay, verbose=True)
+    print("Fake SparkPost listening on {0}".format(server.api_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,137 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextvars
+
+"""
+Logging setup shared by the web app, the mail dispatcher and the scripts.
+
+Records are put on an in memory queue by a QueueHandler and written to stdout by a QueueListener thread, so a request
+never blocks on a slow stdout.  Every record carries the current request id.  Expensive arguments such as JSON dumps
+should be wrapped in LazyJson so they are only serialized when the record is actually emitted.
+"""
+
+# A context variable is per thread for the Flask workers and per task for the asyncio app (async_app.py)
+_request_id = contextvars.ContextVar("request_id", default=None)
+_listener = None
+_settings = None
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+def set_request_id(request_id):
+    _request_id.set(request_id)
+
+
+def clear_request_id():
+    _request_id.set(None)
+
+
+class LazyJson:
+    """ Defers json.dumps until a handler formats the record """
+
+    def __init__(self, obj, **kwargs):
+        self.obj = obj
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return json.dumps(self.obj, **self.kwargs)
+
+
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = get_request_id() or "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line, with any extra={...} fields passed to the logger call """
+
+    RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+    def format(self, record):
+        log_entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".{0:03d}Z".format(int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-")
+        }
+
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED_ATTRS and not key.startswith("_"):
+                log_entry[key] = value
+
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(log_entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Drops records instead of blocking the caller when the queue is full, i.e. stdout can not keep up """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler.prepare formats the message here, keep the raw args so formatting stays on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def configure_logging(level="INFO", log_format="json", queue_size=10000):
+    """ Routes the root logger through a bounded queue to stdout.  Safe to call more than once """
+    global _listener, _settings
+
+    if _listener is not None:
+        return
+
+    _settings = (level, log_format, queue_size)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+
+    # Records are formatted by the listener thread, so the lazy arguments are evaluated off the request thread
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [queue_handler]
+    root_logger.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """ Flushes whatever is still queued """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def restart_logging_after_fork():
+    """ The writer thread does not survive fork(), a forked worker starts its own with the same settings """
+    global _listener
+
+    if _settings is not None:
+        _listener = None
+        configure_logging(*_settings)
@@ -0,0 +1,178 @@
+import time
+import random
+import threading
+import config
+import logging
+
+from utils.db import RedemptionCodeDB
+from utils.rest import OktaUtil
+from utils.logs import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+class MailDispatcher:
+    """ Background sender that drains the mail_outbox table into SparkPost transmissions """
+
+    def __init__(self, batch_size=100, max_recipients_per_transmission=1000, poll_interval=5, max_attempts=8,
+                 backoff_base=2, backoff_max=900, lease_timeout=300):
+        logger.debug("MailDispatcher.__init__")
+        self.batch_size = batch_size
+        self.max_recipients_per_transmission = max_recipients_per_transmission
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_timeout = lease_timeout
+
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._okta_util = None
+        self.stats = {
+            "transmissions": 0,
+            "sent": 0,
+            "retried": 0,
+            "dead": 0
+        }
+
+    @classmethod
+    def from_config(cls):
+        settings = dict(config.mail)
+        settings.pop("dispatcher_enabled", None)
+
+        return cls(**settings)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        logger.info("MailDispatcher.start()")
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name="mail-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        logger.info("MailDispatcher.stop()")
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self):
+        """ Lets a request nudge the dispatcher right after it commits new mail instead of waiting for the next poll """
+        self._wake_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                # Keep draining while full batches come back
+                while self.run_once() >= self.batch_size and not self._stop_event.is_set():
+                    pass
+            except Exception as ex:
+                logger.exception("MailDispatcher.run() failed: %s", ex)
+
+            self._wake_event.wait(self.poll_interval)
+            self._wake_event.clear()
+
+    def run_once(self):
+        """ Claims one batch from the outbox, sends it and records the outcome. Returns the number of rows claimed """
+        redemption_code_db = RedemptionCodeDB()
+        mail_items = redemption_code_db.claim_pending_mail(self.batch_size, self.lease_timeout)
+
+        if not mail_items:
+            return 0
+
+        if self._okta_util is None:
+            self._okta_util = OktaUtil()
+
+        okta_util = self._okta_util
+        sent_ids = []
+        failures = []
+
+        for template_id, transmission_items in self.group_transmissions(mail_items):
+            recipients = []
+            for mail_item in transmission_items:
+                recipients.extend(self.get_recipients(mail_item))
+
+            error = None
+            try:
+                mail_response = okta_util.send_mail(template_id, recipients)
+                self.stats["transmissions"] += 1
+                if "errors" in mail_response:
+                    error = str(mail_response["errors"])
+            except Exception as ex:
+                error = str(ex)
+
+            if error:
+                logger.warning("MailDispatcher transmission failed for template %s: %s", template_id, error)
+                failures.extend([self.get_failure(mail_item, error) for mail_item in transmission_items])
+            else:
+                sent_ids.extend([mail_item["id"] for mail_item in transmission_items])
+
+        if sent_ids:
+            redemption_code_db.mark_mail_sent(sent_ids)
+            self.stats["sent"] += len(sent_ids)
+
+        if failures:
+            redemption_code_db.mark_mail_failed(failures)
+
+        return len(mail_items)
+
+    def group_transmissions(self, mail_items):
+        """ Merges outbox rows that share a template into multi recipient transmissions """
+        transmissions = {}
+        for mail_item in mail_items:
+            transmissions.setdefault(mail_item["templateId"], []).append(mail_item)
+
+        for template_id, template_items in transmissions.items():
+            transmission_items = []
+            recipient_count = 0
+            for mail_item in template_items:
+                item_recipient_count = len(mail_item["recipients"])
+                if transmission_items and recipient_count + item_recipient_count > self.max_recipients_per_transmission:
+                    yield template_id, transmission_items
+                    transmission_items = []
+                    recipient_count = 0
+
+                transmission_items.append(mail_item)
+                recipient_count += item_recipient_count
+
+            if transmission_items:
+                yield template_id, transmission_items
+
+    def get_recipients(self, mail_item):
+        """ Moves message level substitution data onto each recipient so differing messages can share a transmission """
+        recipients = []
+        for recipient in mail_item["recipients"]:
+            recipient = dict(recipient)
+            if mail_item["substitutionData"]:
+                substitution_data = dict(mail_item["substitutionData"])
+                substitution_data.update(recipient.get("substitution_data", {}))
+                recipient["substitution_data"] = substitution_data
+            recipients.append(recipient)
+
+        return recipients
+
+    def get_failure(self, mail_item, error):
+        if mail_item["attempts"] >= self.max_attempts:
+            self.stats["dead"] += 1
+            return ("DEAD", 0, error, mail_item["id"])
+
+        self.stats["retried"] += 1
+        # Exponential backoff with full jitter so a recovering SparkPost is not hit by every message at once
+        retry_delay = random.uniform(0, min(self.backoff_max, self.backoff_base ** mail_item["attempts"]))
+
+        return ("PENDING", retry_delay, error, mail_item["id"])
+
+
+if __name__ == "__main__":
+    # Run the dispatcher as its own process, e.g. with MAIL_DISPATCHER_ENABLED=false on the web processes
+    configure_logging(config.logging["level"], config.logging["format"], config.logging["queue_size"])
+    mail_dispatcher = MailDispatcher.from_config()
+    mail_dispatcher.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        mail_dispatcher.stop()
@@ -0,0 +1,252 @@
+import time
+import functools
+import inspect
+import threading
+import contextvars
+
+from contextlib import contextmanager
+
+"""
+In process metrics: latency histograms and counters kept in REGISTRY and rendered in the Prometheus text format by
+/metrics, plus a per request record of phase timings, database round trips and upstream calls used for the slow
+request log.  Every process keeps its own numbers, scrape each worker or aggregate them in Prometheus.
+"""
+
+
+class LatencyHistogram:
+    """ Thread safe cumulative histogram of durations in seconds, bucketed the way Prometheus histograms are """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = len(self.buckets)
+        for bucket_index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = bucket_index
+                break
+
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += seconds
+
+    def get_stats(self):
+        with self._lock:
+            counts = list(self._counts)
+            stats = {
+                "count": self._count,
+                "sum": self._sum
+            }
+
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+
+        stats["buckets"] = buckets
+
+        return stats
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class MetricsRegistry:
+    """ Histograms and counters keyed by metric name and labels, created on first use """
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, metric_type, name, description, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = factory()
+                    self._metrics[key] = metric
+                    self._help.setdefault(name, (metric_type, description))
+
+        return metric
+
+    def histogram(self, name, description="", buckets=None, **labels):
+        return self._get("histogram", name, description, labels, lambda: LatencyHistogram(buckets))
+
+    def counter(self, name, description="", **labels):
+        return self._get("counter", name, description, labels, Counter)
+
+    def register_collector(self, collector):
+        """
+        collector() is called on every render and returns (name, type, description, labels, value) tuples,
+        for values that already live elsewhere such as the connection pool or cache statistics
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """ Prometheus text exposition format """
+        families = {}
+        with self._lock:
+            metrics = list(self._metrics.items())
+            help_text = dict(self._help)
+
+        for (name, labels), metric in metrics:
+            metric_type, description = help_text[name]
+            lines = families.setdefault(name, (metric_type, description, []))[2]
+            labels = dict(labels)
+
+            if isinstance(metric, LatencyHistogram):
+                stats = metric.get_stats()
+                for bound, count in stats["buckets"]:
+                    bucket_labels = dict(labels)
+                    bucket_labels["le"] = bound
+                    lines.append("{0}_bucket{1} {2}".format(name, format_labels(bucket_labels), count))
+                lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), stats["sum"]))
+                lines.append("{0}_count{1} {2}".format(name, format_labels(labels), stats["count"]))
+            else:
+                lines.append("{0}{1} {2}".format(name, format_labels(labels), metric.value))
+
+        for collector in list(self._collectors):
+            for name, metric_type, description, labels, value in collector():
+                lines = families.setdefault(name, (metric_type, description, []))[2]
+                lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+
+        output = []
+        for name in sorted(families):
+            metric_type, description, lines = families[name]
+            if description:
+                output.append("# HELP {0} {1}".format(name, description))
+            output.append("# TYPE {0} {1}".format(name, metric_type))
+            output.extend(lines)
+
+        return "\n".join(output) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(
+        '{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in sorted(labels.items())) + "}"
+
+
+REGISTRY = MetricsRegistry()
+
+_request_state = contextvars.ContextVar("request_state", default=None)  # per thread, or per asyncio task
+
+
+def start_request(endpoint):
+    """ Starts the per request record that phase(), record_db_round_trip() and record_upstream_call() add to """
+    _request_state.set({
+        "endpoint": endpoint or "unknown",
+        "started_at": time.time(),
+        "phases": {},
+        "db_round_trips": 0,
+        "db_checkout_seconds": 0.0,
+        "upstream_calls": 0,
+        "upstream_seconds": 0.0
+    })
+
+
+def get_request_state():
+    return _request_state.get()
+
+
+def end_request():
+    state = get_request_state()
+    _request_state.set(None)
+
+    return state
+
+
+@contextmanager
+def phase(name):
+    """ Times one named step of the current request into request_phase_seconds """
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started_at
+        state = get_request_state()
+        endpoint = state["endpoint"] if state else "none"
+        REGISTRY.histogram(
+            "request_phase_seconds", "Time spent in each phase of a request", endpoint=endpoint, phase=name).observe(elapsed)
+        if state:
+            state["phases"][name] = state["phases"].get(name, 0.0) + elapsed
+
+
+def record_db_round_trip():
+    state = get_request_state()
+    if state:
+        state["db_round_trips"] += 1
+
+
+def record_db_checkout(seconds):
+    REGISTRY.histogram("db_pool_checkout_seconds", "Time waiting for a pooled database connection").observe(seconds)
+    state = get_request_state()
+    if state:
+        state["db_checkout_seconds"] += seconds
+
+
+def record_upstream_call(seconds):
+    state = get_request_state()
+    if state:
+        state["upstream_calls"] += 1
+        state["upstream_seconds"] += seconds
+
+
+def timed(metric_name, description="", label="name"):
+    """
+    Decorator that observes the wrapped function's duration in metric_name, labelled with the function's name.
+    Generators are timed until they are exhausted or closed
+    """
+
+    def decorator(func):
+        histogram_labels = {label: func.__name__}
+
+        def observe(started_at):
+            REGISTRY.histogram(metric_name, description, **histogram_labels).observe(time.time() - started_at)
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                started_at = time.time()
+                try:
+                    yield from func(*args, **kwargs)
+                finally:
+                    observe(started_at)
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(started_at)
+
+        return wrapper
+
+    return decorator
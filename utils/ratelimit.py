@@ -0,0 +1,172 @@
+import time
+import logging
+import importlib
+import threading
+
+from collections import OrderedDict
+from utils import metrics
+
+"""
+Admission control for /redeemCode: token buckets per client IP and, when turned on, per redemption code prefix, and a
+cap on the requests a process works on at once.  Both run before validation, so shed requests never reach the database.
+
+Bucket state lives in a backend.  MemoryRateLimitBackend keeps it per process; a backend shared by every worker (e.g.
+one backed by Redis) only needs consume() and get_stats() and is selected with RATE_LIMIT_BACKEND=package.module:Class.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryRateLimitBackend:
+    """ Token buckets in a size bounded LRU dict, the least recently used buckets are dropped first """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst, cost=1):
+        """
+        Takes cost tokens from the bucket for key, which refills at rate tokens per second up to burst.
+        Returns 0 when they were taken, otherwise the seconds until enough tokens will be available
+        """
+        now = time.time()
+
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0
+            else:
+                retry_after = (cost - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return retry_after
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._buckets),
+                "max_keys": self.max_keys
+            }
+
+
+class ConcurrencyLimiter:
+    """ Non blocking counter of in flight requests, try_acquire() fails instead of queueing once max_in_flight is reached """
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+
+            self.in_flight += 1
+
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class RedemptionRateLimiter:
+    """ Decides whether a /redeemCode request is admitted, see admit() """
+
+    REASON_CONCURRENCY = "concurrency"
+    REASON_CLIENT_IP = "client_ip"
+    REASON_CODE_PREFIX = "code_prefix"
+
+    def __init__(self, backend, enabled=True, ip_rate=0.5, ip_burst=10, code_prefix_length=0, code_prefix_rate=10,
+                 code_prefix_burst=50, max_in_flight=200, trusted_proxies=1):
+        self.backend = backend
+        self.enabled = enabled
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.code_prefix_length = code_prefix_length
+        self.code_prefix_rate = code_prefix_rate
+        self.code_prefix_burst = code_prefix_burst
+        self.trusted_proxies = trusted_proxies
+        self.concurrency = ConcurrencyLimiter(max_in_flight)
+
+    @classmethod
+    def from_config(cls, rate_limit_config):
+        settings = dict(rate_limit_config)
+        backend_name = settings.pop("backend")
+        max_keys = settings.pop("max_keys")
+
+        if backend_name == "memory":
+            backend = MemoryRateLimitBackend(max_keys)
+        else:
+            module_name, class_name = backend_name.split(":")
+            backend = getattr(importlib.import_module(module_name), class_name)()
+
+        return cls(backend, **settings)
+
+    def get_client_ip(self, forwarded_for, remote_addr):
+        """
+        The client address as seen by the outermost trusted proxy.  Each proxy appends the address it received the
+        request from to X-Forwarded-For, so entries left of the trusted ones may have been made up by the client
+        """
+        addresses = [address.strip() for address in (forwarded_for or "").split(",") if address.strip()]
+
+        if self.trusted_proxies and len(addresses) >= self.trusted_proxies:
+            return addresses[-self.trusted_proxies]
+
+        return remote_addr or "unknown"
+
+    def get_code_prefix(self, redemption_code):
+        return str(redemption_code or "")[:self.code_prefix_length].upper()
+
+    def admit(self, client_ip, redemption_code):
+        """
+        Returns a tuple of (reason, retry_after seconds), reason is None when the request may go ahead.  An admitted
+        request holds a concurrency slot and must call release() once it is done
+        """
+        if not self.enabled:
+            return None, 0
+
+        if not self.concurrency.try_acquire():
+            return self.reject(self.REASON_CONCURRENCY, 1)
+
+        retry_after = self.backend.consume("ip:" + client_ip, self.ip_rate, self.ip_burst)
+        if retry_after:
+            self.concurrency.release()
+            return self.reject(self.REASON_CLIENT_IP, retry_after)
+
+        if self.code_prefix_length:
+            retry_after = self.backend.consume(
+                "code:" + self.get_code_prefix(redemption_code), self.code_prefix_rate, self.code_prefix_burst)
+            if retry_after:
+                self.concurrency.release()
+                return self.reject(self.REASON_CODE_PREFIX, retry_after)
+
+        return None, 0
+
+    def release(self):
+        if self.enabled:
+            self.concurrency.release()
+
+    def reject(self, reason, retry_after):
+        logger.debug("RedemptionRateLimiter.reject(%s, %.1f)", reason, retry_after)
+        metrics.REGISTRY.counter("redeem_rejected_total", "Redemption requests shed by admission control", reason=reason).increment()
+
+        return reason, retry_after
+
+    def get_stats(self):
+        stats = self.backend.get_stats()
+        stats["enabled"] = self.enabled
+        stats["in_flight"] = self.concurrency.in_flight
+        stats["max_in_flight"] = self.concurrency.max_in_flight
+
+        return stats
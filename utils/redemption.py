@@ -0,0 +1,185 @@
+import re
+import datetime
+import logging
+
+from email.utils import parseaddr
+from utils.db import RedemptionCodeDB
+
+"""
+Request handling shared by the Flask app (app.py) and the asyncio public endpoints (async_app.py), so both serve
+/redeemCode with the same validation, record mapping and responses.
+"""
+
+logger = logging.getLogger(__name__)
+
+# The redemption payload, one entry per field: (name, required, max length, pattern, message when the pattern does
+# not match).  Max lengths are the varchar sizes in sql/createdb.sql, so anything that passes also fits the table
+REDEMPTION_FIELDS = [
+    ("redeemCode", True, 20, None, None),
+    ("firstName", True, 100, None, None),
+    ("lastName", True, 100, None, None),
+    ("address1", True, 255, None, None),
+    ("address2", False, 255, None, None),
+    ("city", True, 100, None, None),
+    ("state", True, 2, r"[A-Za-z]{2}", "state must be a two letter state code."),
+    ("postalCode", True, 10, r"\d{5}(-\d{4})?", "postalCode must be a 5 digit ZIP code or ZIP+4."),
+    ("phone", True, 16, None, None),
+    ("email", True, 255, None, None)
+]
+
+
+def json_converter(o):
+    if isinstance(o, datetime.datetime):
+        return o.__str__()
+
+
+def is_email(value):
+    return "@" in parseaddr(value)[1]
+
+
+def compile_validator(fields, checks=None):
+    """
+    Builds a validator for a JSON object from (name, required, max length, pattern, pattern message) entries, with
+    the patterns compiled once.  checks are extra (name, function, message) tests run on non empty values.
+    The validator returns a list of {"field": name, "message": message} with at most one error per field
+    """
+    rules = [
+        (name, required, max_length, re.compile(pattern).fullmatch if pattern else None, pattern_message)
+        for name, required, max_length, pattern, pattern_message in fields]
+    extra_checks = dict([(name, (check, message)) for name, check, message in (checks or [])])
+
+    def validate(json):
+        if not isinstance(json, dict):
+            return [{"field": None, "message": "The request body must be a JSON object."}]
+
+        errors = []
+        for name, required, max_length, matches, pattern_message in rules:
+            value = json.get(name)
+
+            if value is None or value == "":
+                if required:
+                    errors.append({"field": name, "message": "{0} is required.".format(name)})
+            elif not isinstance(value, str):
+                errors.append({"field": name, "message": "{0} must be text.".format(name)})
+            elif len(value) > max_length:
+                errors.append({"field": name, "message": "{0} must be at most {1} characters.".format(name, max_length)})
+            elif matches and not matches(value):
+                errors.append({"field": name, "message": pattern_message})
+            elif name in extra_checks and not extra_checks[name][0](value):
+                errors.append({"field": name, "message": extra_checks[name][1]})
+
+        return errors
+
+    return validate
+
+
+validate_redemption_fields = compile_validator(
+    REDEMPTION_FIELDS, [("email", is_email, "Email is not properly formatted.")])
+
+
+def get_redemption_code(request_json):
+    """ The submitted code for admission control, which runs before the payload is validated """
+    if isinstance(request_json, dict):
+        return request_json.get("redeemCode")
+
+    return None
+
+
+def get_redemption_response(request_json):
+    """ The /redeemCode response, FAILED until the claim succeeds """
+    return {
+        "status": "FAILED",
+        "message": "Please correct the following: ",
+        "request_json": request_json
+    }
+
+
+def get_rate_limited_response(request_json):
+    """ The /redeemCode response for a request shed by admission control, sent with a 429 """
+    response = get_redemption_response(request_json)
+    response["message"] = "Too many requests, please try again in a moment."
+
+    return response
+
+
+def validate_redemption_request(request_json, response):
+    """
+    Checks the whole payload in one pass before any query, adding the per field errors to response["errors"] and
+    their messages to response["message"].  Returns True when there were any
+    """
+    errors = validate_redemption_fields(request_json)
+
+    if errors:
+        logger.debug("validate_redemption_request(): %s", errors)
+        response["errors"] = errors
+        response["message"] += "\n" + "\n".join([error["message"] for error in errors])
+
+    return len(errors) > 0
+
+
+def check_redemption_code_issued(redemption_code_filter, request_json, response):
+    """
+    Rejects a code the filter knows was never issued without a query, returns True when it did.  A miss is only
+    trusted while the filter has every code the last watermark read counted, see RedemptionCodeFilter.is_current()
+    """
+    if redemption_code_filter.might_contain(request_json["redeemCode"]) or not redemption_code_filter.is_current():
+        return False
+
+    return apply_redemption_status(response, RedemptionCodeDB.REDEMPTION_UNKNOWN)
+
+
+def check_cached_redemption_status(request_json, response):
+    """ Answers repeated attempts at a used or unknown code from the code cache, returns True when it did """
+    redemption_status = RedemptionCodeDB.get_cached_redemption_status(request_json["redeemCode"])
+    if redemption_status is None:
+        return False
+
+    return apply_redemption_status(response, redemption_status)
+
+
+def map_redemption_code_record(request_json, redemption_code_record):
+    logger.debug("map_redemption_code_record()")
+
+    # logger.debug("redemption_code_record: %s", LazyJson(redemption_code_record, indent=4, sort_keys=True, default=json_converter))
+
+    redemption_code_record["redeemCode"] = request_json["redeemCode"]
+    redemption_code_record["firstName"] = request_json["firstName"]
+    redemption_code_record["lastName"] = request_json["lastName"]
+    redemption_code_record["address1"] = request_json["address1"]
+    redemption_code_record["address2"] = request_json.get("address2")
+    redemption_code_record["city"] = request_json["city"]
+    redemption_code_record["state"] = request_json["state"]
+    redemption_code_record["postalCode"] = request_json["postalCode"]
+    redemption_code_record["phone"] = request_json["phone"]
+    redemption_code_record["email"] = request_json["email"]
+
+    # logger.debug("redemption_code_record: %s", LazyJson(redemption_code_record, indent=4, sort_keys=True, default=json_converter))
+
+
+def get_redemption_recipients(request_json):
+    """ SparkPost recipients for the thank you mail sent once a code is claimed """
+    return [
+        {
+            "address": {
+                "email": request_json["email"],
+                "name": "{0} {1}".format(request_json["firstName"], request_json["lastName"])
+            }
+        }
+    ]
+
+
+def apply_redemption_status(response, redemption_status):
+    """ Reports a claim that did not succeed in response, returns True when it did not """
+    if redemption_status == RedemptionCodeDB.REDEMPTION_UNKNOWN:
+        response["message"] += "\nInvalid redemption code."
+        return True
+    elif redemption_status == RedemptionCodeDB.REDEMPTION_USED:
+        response["message"] += "\nRedemption code has already been used."
+        return True
+
+    return False
+
+
+def set_redemption_success(response):
+    response["status"] = "SUCCESS"
+    response["message"] = "Your request is being processed.  Please check your email for a status update."
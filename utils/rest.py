@@ -1,7 +1,17 @@
 import os
 import requests
 import base64
-import json
+import time
+import random
+import threading
+import config
+import logging
+
+from requests.adapters import HTTPAdapter
+from utils.circuit import CircuitBreaker
+from utils import metrics
+
+logger = logging.getLogger(__name__)
 
 # from requests.packages.urllib3.exceptions import InsecurePlatformWarning
 # from requests.packages.urllib3.exceptions import SNIMissingWarning
@@ -19,56 +29,152 @@ class OktaUtil:
     OIDC_CLIENT_ID = None
     OIDC_CLIENT_SECRET = None
     AUTH_SERVER_ID = None
-
-    def __init__(self, headers):
+    FORWARDED_HEADERS = ["X-Forwarded-For", "X-Forwarded-Port", "X-Forwarded-Proto"]
+
+    # Shared by every instance in the process so settings are read once and connections to Okta/SparkPost are reused
+    SETTINGS = None
+    SESSION = None
+    SHARED_LOCK = threading.Lock()
+
+    # Upstreams get their own timeouts, circuit breaker and latency histogram
+    ENDPOINT_OKTA = "okta"
+    ENDPOINT_OKTA_OAUTH = "okta_oauth"
+    ENDPOINT_SPARKPOST = "sparkpost"
+    ENDPOINTS = {}
+    IDEMPOTENT_METHODS = ["GET", "PUT", "DELETE"]
+    RETRY_STATUS_CODES = [502, 503, 504]
+
+    def __init__(self, headers=None):
         # This is to supress the warnings for the older version
         # requests.packages.urllib3.disable_warnings((InsecurePlatformWarning, SNIMissingWarning))
 
-        self.REST_HOST = os.environ["OKTA_ORG_URL"]
-        self.REST_TOKEN = os.environ["OKTA_API_TOKEN"]
-        self.OIDC_CLIENT_ID = os.environ["OKTA_APP_CLIENT_ID"]
-        self.OIDC_CLIENT_SECRET = os.environ["OKTA_APP_CLIENT_SECRET"]
-        self.OIDC_REDIRECT_URL = os.environ["OKTA_OIDC_REDIRECT_URL"]
-        if "OKTA_AUTHSERVER_ID" in os.environ:
-            self.AUTH_SERVER_ID = os.environ["OKTA_AUTHSERVER_ID"]
-            print("HAS AUTH SERVER: {0}".format(self.AUTH_SERVER_ID))
-
-        user_agent = ""
-        if "User-Agent" in headers:
-            user_agent = headers["User-Agent"]
-
-
-
-        self.OKTA_HEADERS = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "Authorization": "SSWS {api_token}".format(api_token=self.REST_TOKEN),
-            "User-Agent": user_agent
-        }
-
-        if "X-Forwarded-For" in headers:
-            self.OKTA_HEADERS["X-Forwarded-For"] = headers["X-Forwarded-For"]
-
-        if "X-Forwarded-Port" in headers:
-            self.OKTA_HEADERS["X-Forwarded-Port"] = headers["X-Forwarded-Port"]
-
-        if "X-Forwarded-Proto" in headers:
-            self.OKTA_HEADERS["X-Forwarded-Proto"] = headers["X-Forwarded-Proto"]
-
-        self.OKTA_OAUTH_HEADERS = {
-            "Accept": "application/json",
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": "Basic {encoded_auth}".format(
-                encoded_auth=self.get_encoded_auth(
-                    client_id=self.OIDC_CLIENT_ID,
-                    client_secret=self.OIDC_CLIENT_SECRET))
-        }
-
-        print("OKTA_OAUTH_HEADERS: {0}".format(json.dumps(self.OKTA_OAUTH_HEADERS, indent=4, sort_keys=True)))
+        settings = self.get_settings()
+        self.REST_HOST = settings["REST_HOST"]
+        self.REST_TOKEN = settings["REST_TOKEN"]
+        self.OIDC_CLIENT_ID = settings["OIDC_CLIENT_ID"]
+        self.OIDC_CLIENT_SECRET = settings["OIDC_CLIENT_SECRET"]
+        self.OIDC_REDIRECT_URL = settings["OIDC_REDIRECT_URL"]
+        self.AUTH_SERVER_ID = settings["AUTH_SERVER_ID"]
+        self.OKTA_OAUTH_HEADERS = settings["OKTA_OAUTH_HEADERS"]
+        self.OKTA_HEADERS = self.get_request_headers(settings["OKTA_HEADERS"], headers)
+        self.session = self.get_session()
+
+    @classmethod
+    def get_settings(cls):
+        """ Reads the Okta configuration and builds the static headers once per process """
+        if cls.SETTINGS is None:
+            with cls.SHARED_LOCK:
+                if cls.SETTINGS is None:
+                    logger.debug("OktaUtil.get_settings()")
+                    settings = {
+                        "REST_HOST": os.environ["OKTA_ORG_URL"],
+                        "REST_TOKEN": os.environ["OKTA_API_TOKEN"],
+                        "OIDC_CLIENT_ID": os.environ["OKTA_APP_CLIENT_ID"],
+                        "OIDC_CLIENT_SECRET": os.environ["OKTA_APP_CLIENT_SECRET"],
+                        "OIDC_REDIRECT_URL": os.environ["OKTA_OIDC_REDIRECT_URL"],
+                        "AUTH_SERVER_ID": os.environ.get("OKTA_AUTHSERVER_ID")
+                    }
+                    if settings["AUTH_SERVER_ID"]:
+                        logger.info("HAS AUTH SERVER: %s", settings["AUTH_SERVER_ID"])
+
+                    settings["OKTA_HEADERS"] = {
+                        "Accept": "application/json",
+                        "Content-Type": "application/json",
+                        "Authorization": "SSWS {api_token}".format(api_token=settings["REST_TOKEN"])
+                    }
+
+                    settings["OKTA_OAUTH_HEADERS"] = {
+                        "Accept": "application/json",
+                        "Content-Type": "application/x-www-form-urlencoded",
+                        "Authorization": "Basic {encoded_auth}".format(
+                            encoded_auth=cls.get_encoded_auth(
+                                client_id=settings["OIDC_CLIENT_ID"],
+                                client_secret=settings["OIDC_CLIENT_SECRET"]))
+                    }
+
+                    cls.SETTINGS = settings
+
+        return cls.SETTINGS
+
+    @classmethod
+    def get_session(cls):
+        """ Process wide requests.Session whose pooled keep-alive connections are shared by every instance """
+        if cls.SESSION is None:
+            with cls.SHARED_LOCK:
+                if cls.SESSION is None:
+                    logger.debug("OktaUtil.get_session()")
+                    # Retries are done in execute_request so they can be jittered and counted by the circuit breaker
+                    adapter = HTTPAdapter(
+                        pool_connections=config.rest["pool_connections"],
+                        pool_maxsize=config.rest["pool_maxsize"],
+                        max_retries=0)
+
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    cls.SESSION = session
+
+        return cls.SESSION
+
+    @classmethod
+    def reset_session(cls):
+        """ Drops a session inherited across fork() so the worker opens its own keep-alive connections """
+        cls.SESSION = None
+        cls.SHARED_LOCK = threading.Lock()
+
+    @classmethod
+    def get_endpoint(cls, name):
+        """ Returns the circuit breaker and latency histogram for an upstream, creating them on first use """
+        endpoint = cls.ENDPOINTS.get(name)
+
+        if endpoint is None:
+            with cls.SHARED_LOCK:
+                endpoint = cls.ENDPOINTS.get(name)
+                if endpoint is None:
+                    endpoint = {
+                        "breaker": CircuitBreaker(
+                            name,
+                            failure_threshold=config.rest["breaker_failure_threshold"],
+                            reset_timeout=config.rest["breaker_reset_timeout"]),
+                        "latency": metrics.REGISTRY.histogram(
+                            "upstream_request_seconds", "Duration of each Okta and SparkPost HTTP call", upstream=name),
+                        "retries": 0
+                    }
+                    cls.ENDPOINTS[name] = endpoint
+
+        return endpoint
+
+    @classmethod
+    def get_endpoint_stats(cls):
+        """ Breaker state, retry count and latency histogram per upstream """
+        endpoint_stats = {}
+        for name, endpoint in list(cls.ENDPOINTS.items()):
+            endpoint_stats[name] = {
+                "breaker": endpoint["breaker"].get_stats(),
+                "latency": endpoint["latency"].get_stats(),
+                "retries": endpoint["retries"]
+            }
+
+        return endpoint_stats
+
+    def get_request_headers(self, base_headers, headers=None):
+        """ Copies the base headers and adds the caller's User-Agent and X-Forwarded-* headers """
+        request_headers = dict(base_headers)
+        request_headers["User-Agent"] = ""
+
+        if headers:
+            if "User-Agent" in headers:
+                request_headers["User-Agent"] = headers["User-Agent"]
+
+            for forwarded_header in self.FORWARDED_HEADERS:
+                if forwarded_header in headers:
+                    request_headers[forwarded_header] = headers[forwarded_header]
+
+        return request_headers
 
 
     def get_user(self, user_id):
-        print("get_user()")
+        logger.debug("get_user()")
         url = "{host}/api/v1/users/{user_id}".format(host=self.REST_HOST, user_id=user_id)
         body = {}
 
@@ -76,14 +182,14 @@ class OktaUtil:
 
 
     def update_user(self, user):
-        print("update_user()")
+        logger.debug("update_user()")
         url = "{host}/api/v1/users/{user_id}".format(host=self.REST_HOST, user_id=user["id"])
 
         return self.execute_post(url, user)
 
 
     def userinfo_oauth(self, oauth_token):
-        print("userinfo_oauth()")
+        logger.debug("userinfo_oauth()")
         auth_server = ""
 
         if self.AUTH_SERVER_ID:
@@ -100,11 +206,11 @@ class OktaUtil:
             "Authorization": "Bearer {0}".format(oauth_token)
         }
 
-        return self.execute_get(url, body, headers)
+        return self.execute_get(url, body, headers, endpoint=self.ENDPOINT_OKTA_OAUTH)
 
 
     def introspect_oauth_token(self, oauth_token):
-        print("introspect_oauth_token()")
+        logger.debug("introspect_oauth_token()")
 
         auth_server = ""
 
@@ -117,25 +223,26 @@ class OktaUtil:
             token=oauth_token)
         body = {}
 
-        return self.execute_post(url, body, self.OKTA_OAUTH_HEADERS)
+        # Introspection only reads token state, so it is safe to retry
+        return self.execute_post(url, body, self.OKTA_OAUTH_HEADERS, endpoint=self.ENDPOINT_OKTA_OAUTH, idempotent=True)
 
 
     def get_user_application_profile(self, app_id, user_id):
-        print("get_user_application_profile()")
+        logger.debug("get_user_application_profile()")
         url = "{host}/api/v1/apps/{app_id}/users/{user_id}".format(host=self.REST_HOST, app_id=app_id, user_id=user_id)
         body = {}
         return self.execute_get(url, body)
 
 
     def update_user_application_profile(self, app_id, user_id, user_app_profile):
-        print("update_user_application_profile()")
+        logger.debug("update_user_application_profile()")
         url = "{host}/api/v1/apps/{app_id}/users/{user_id}".format(host=self.REST_HOST, app_id=app_id, user_id=user_id)
         body = user_app_profile
         return self.execute_post(url, body)
 
 
     def send_mail(self, template_id, recipients, substitution=None):
-        print("send_mail()")
+        logger.debug("send_mail()")
         url = "{0}/transmissions".format(os.environ["SPARKPOST_API_URL"])
         headers = {
             "Authorization": os.environ["SPARKPOST_API_KEY"],
@@ -155,40 +262,23 @@ class OktaUtil:
         if substitution:
             body["substitution_data"] = substitution
 
-        return self.execute_post(url, body, headers=headers)
+        return self.execute_post(url, body, headers=headers, endpoint=self.ENDPOINT_SPARKPOST)
 
 
-    def execute_post(self, url, body, headers=None):
-        print("execute_post(): ", url)
-        print(body)
+    def execute_post(self, url, body, headers=None, request_headers=None, endpoint=ENDPOINT_OKTA, idempotent=False):
+        logger.debug("execute_post(): %s %s", url, body)
 
-        headers = self.reconcile_headers(headers)
-
-        rest_response = requests.post(url, headers=headers, json=body)
-        response_json = rest_response.json()
-
-        # print json.dumps(response_json, indent=4, sort_keys=True)
-        return response_json
-
-    def execute_put(self, url, body, headers=None):
-        print("execute_put(): ", url)
-        print(body)
-
-        headers = self.reconcile_headers(headers)
+        return self.execute_request("POST", url, body, headers, request_headers, endpoint, idempotent).json()
 
-        rest_response = requests.put(url, headers=headers, json=body)
-        response_json = rest_response.json()
+    def execute_put(self, url, body, headers=None, request_headers=None, endpoint=ENDPOINT_OKTA):
+        logger.debug("execute_put(): %s %s", url, body)
 
-        # print json.dumps(response_json, indent=4, sort_keys=True)
-        return response_json
+        return self.execute_request("PUT", url, body, headers, request_headers, endpoint).json()
 
-    def execute_delete(self, url, body, headers=None):
-        print("execute_delete(): ", url)
-        print(body)
-
-        headers = self.reconcile_headers(headers)
+    def execute_delete(self, url, body, headers=None, request_headers=None, endpoint=ENDPOINT_OKTA):
+        logger.debug("execute_delete(): %s %s", url, body)
 
-        rest_response = requests.delete(url, headers=headers, json=body)
+        rest_response = self.execute_request("DELETE", url, body, headers, request_headers, endpoint)
         try:
             response_json = rest_response.json()
         except:
@@ -197,17 +287,75 @@ class OktaUtil:
         # print json.dumps(response_json, indent=4, sort_keys=True)
         return response_json
 
-    def execute_get(self, url, body, headers=None):
-        print("execute_get(): ", url)
-        print(body)
+    def execute_get(self, url, body, headers=None, request_headers=None, endpoint=ENDPOINT_OKTA):
+        logger.debug("execute_get(): %s %s", url, body)
 
-        headers = self.reconcile_headers(headers)
+        return self.execute_request("GET", url, body, headers, request_headers, endpoint).json()
 
-        rest_response = requests.get(url, headers=headers, json=body)
-        response_json = rest_response.json()
+    def execute_request(self, method, url, body, headers=None, request_headers=None, endpoint=ENDPOINT_OKTA,
+                        idempotent=None):
+        """
+        Sends the request with the endpoint's connect/read timeouts, behind the endpoint's circuit breaker.
+        Idempotent calls are retried on connection errors, timeouts and 502/503/504 with full jitter backoff.
+        request_headers (e.g. the incoming Flask request headers) override the forwarded headers for this call.
+        Raises CircuitOpenError without calling the upstream while its breaker is open
+        """
+        headers = self.reconcile_headers(headers)
 
-        # print json.dumps(response_json, indent=4, sort_keys=True)
-        return response_json
+        if request_headers is not None:
+            headers = self.get_request_headers(headers, request_headers)
+
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+
+        endpoint_state = self.get_endpoint(endpoint)
+        breaker = endpoint_state["breaker"]
+        timeout = config.rest["timeouts"].get(endpoint, (config.rest["connect_timeout"], config.rest["read_timeout"]))
+        max_attempts = config.rest["retries"] + 1 if idempotent else 1
+        attempt = 0
+
+        while True:
+            attempt += 1
+            breaker.before_call()
+
+            started_at = time.time()
+            outcome_recorded = False
+            try:
+                rest_response = self.session.request(method, url, headers=headers, json=body, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                self.record_latency(endpoint_state, started_at)
+                breaker.record_failure()
+                outcome_recorded = True
+                if attempt >= max_attempts:
+                    raise
+                logger.warning("execute_request() %s %s failed, retrying: %s", method, endpoint, ex)
+            else:
+                self.record_latency(endpoint_state, started_at)
+                outcome_recorded = True
+                if rest_response.status_code < 500:
+                    breaker.record_success()
+                    return rest_response
+
+                breaker.record_failure()
+                if rest_response.status_code not in self.RETRY_STATUS_CODES or attempt >= max_attempts:
+                    return rest_response
+                logger.warning("execute_request() %s %s returned %s, retrying", method, endpoint, rest_response.status_code)
+            finally:
+                if not outcome_recorded:
+                    # Any other error (e.g. ChunkedEncodingError, TooManyRedirects) still ends the call, otherwise a
+                    # HALF_OPEN breaker would wait for its trial call forever
+                    self.record_latency(endpoint_state, started_at)
+                    breaker.record_failure()
+
+            endpoint_state["retries"] += 1
+            time.sleep(random.uniform(0, min(
+                config.rest["retry_backoff_max"],
+                config.rest["retry_backoff_factor"] * (2 ** (attempt - 1)))))
+
+    def record_latency(self, endpoint_state, started_at):
+        elapsed = time.time() - started_at
+        endpoint_state["latency"].observe(elapsed)
+        metrics.record_upstream_call(elapsed)
 
     def reconcile_headers(self, headers):
 
@@ -216,23 +364,22 @@ class OktaUtil:
 
         return headers
 
-    def get_encoded_auth(self, client_id, client_secret):
-        print("get_encoded_auth()")
+    @staticmethod
+    def get_encoded_auth(client_id, client_secret):
+        logger.debug("get_encoded_auth()")
         auth_raw = "{client_id}:{client_secret}".format(
             client_id=client_id,
             client_secret=client_secret
         )
 
-        print("auth_raw: {0}".format(auth_raw))
         encoded_auth = base64.b64encode(bytes(auth_raw, 'UTF-8')).decode("UTF-8")
-        print("encoded_auth: {0}".format(encoded_auth))
 
         return encoded_auth
 
 
     def create_oidc_auth_code_url(self, state, nonce, session_token=None):
-        print("create_oidc_auth_code_url()")
-        print("session_token: {0}".format(session_token))
+        logger.debug("create_oidc_auth_code_url()")
+        logger.debug("session_token: %s", session_token)
         session_option = ""
         auth_server = ""
 
@@ -265,8 +412,8 @@ class OktaUtil:
 
 
     def get_oauth_token(self, oauth_code):
-        print("get_oauth_token()")
-        print("oauth_code: {0}".format(oauth_code))
+        logger.debug("get_oauth_token()")
+        logger.debug("oauth_code: %s", oauth_code)
         auth_server = ""
 
         if self.AUTH_SERVER_ID:
@@ -288,4 +435,4 @@ class OktaUtil:
             "authorization_code": oauth_code
         }
 
-        return self.execute_post(url, body, self.OKTA_OAUTH_HEADERS)
+        return self.execute_post(url, body, self.OKTA_OAUTH_HEADERS, endpoint=self.ENDPOINT_OKTA_OAUTH)